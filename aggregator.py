@@ -0,0 +1,170 @@
+"""Central aggregator that merges bark events pushed by detector nodes."""
+
+import argparse
+import gzip
+import json
+import sqlite3
+import threading
+import zlib
+
+from flask import Flask, g, request
+
+app = Flask(__name__)
+dbname = "aggregator.db"
+writeLock = threading.Lock()
+
+
+def createTables(dbConn: sqlite3.Connection):
+    cur = dbConn.cursor()
+    cur.execute(
+        "CREATE TABLE if NOT EXISTS barks(\
+            id  INTEGER PRIMARY KEY  NOT NULL,\
+            node_id     TEXT    NOT NULL,\
+            source_id   INT     NOT NULL,\
+            timestamp   REAL    NOT NULL,\
+            confidence  REAL    NOT NULL,\
+            UNIQUE(node_id, source_id)\
+        )"
+    )
+
+    cur.execute(
+        "CREATE TABLE if NOT EXISTS audio_files(\
+            id  INTEGER PRIMARY KEY  NOT NULL,\
+            node_id     TEXT    NOT NULL,\
+            source_id   INT     NOT NULL,\
+            name        TEXT    NOT NULL,\
+            timestamp   REAL    NOT NULL,\
+            length      REAL    NOT NULL,\
+            day_id      INT     NOT NULL,\
+            UNIQUE(node_id, source_id)\
+        )"
+    )
+
+    cur.execute(
+        "CREATE TABLE if NOT EXISTS nodes(\
+            node_id     TEXT    PRIMARY KEY  NOT NULL,\
+            last_batch  INT     NOT NULL,\
+            last_seen   REAL    NOT NULL\
+        )"
+    )
+
+    cur.execute("CREATE INDEX if NOT EXISTS barks_timestamp ON barks(timestamp)")
+    cur.execute(
+        "CREATE INDEX if NOT EXISTS audio_files_timestamp ON audio_files(timestamp)"
+    )
+
+    dbConn.commit()
+
+
+def getDb() -> sqlite3.Connection:
+    if "db" not in g:
+        g.db = sqlite3.connect(dbname)
+    return g.db
+
+
+@app.teardown_appcontext
+def closeDb(_):
+    dbConn = g.pop("db", None)
+    if dbConn is not None:
+        dbConn.close()
+
+
+def ingestBatch(dbConn: sqlite3.Connection, batch: dict) -> dict:
+    """Merges one node batch. Rows already seen from that node are ignored."""
+    nodeId = batch["node_id"]
+    cur = dbConn.cursor()
+
+    before = dbConn.total_changes
+    cur.executemany(
+        "INSERT OR IGNORE INTO barks (node_id, source_id, timestamp, confidence)\
+            VALUES(?, ?, ?, ?)",
+        [(nodeId, *row) for row in batch.get("barks", [])],
+    )
+    barks = dbConn.total_changes - before
+
+    before = dbConn.total_changes
+    cur.executemany(
+        "INSERT OR IGNORE INTO audio_files\
+            (node_id, source_id, name, timestamp, length, day_id)\
+            VALUES(?, ?, ?, ?, ?, ?)",
+        [(nodeId, *row) for row in batch.get("audio_files", [])],
+    )
+    recordings = dbConn.total_changes - before
+
+    cur.execute(
+        "INSERT INTO nodes (node_id, last_batch, last_seen)\
+            VALUES(?, ?, strftime('%s', 'now'))\
+            ON CONFLICT(node_id) DO UPDATE SET\
+                last_batch = max(last_batch, excluded.last_batch),\
+                last_seen = excluded.last_seen",
+        (nodeId, batch.get("batch_id", 0)),
+    )
+    dbConn.commit()
+
+    return {"barks": barks, "audio_files": recordings}
+
+
+@app.route("/ingest", methods=["POST"])
+def ingest():
+    body = request.get_data()
+    try:
+        if request.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        batch = json.loads(body)
+    # a corrupt gzip body raises any of the first three
+    except (OSError, EOFError, zlib.error, ValueError):
+        return {"status": "error", "message": "invalid batch"}, 400
+    if "node_id" not in batch:
+        return {"status": "error", "message": "node_id missing"}, 400
+
+    with writeLock:
+        added = ingestBatch(getDb(), batch)
+    return {"status": "success", **added}
+
+
+@app.route("/barks", methods=["GET"])
+def get_barks():
+    since = request.args.get("since", 0.0, type=float)
+    until = request.args.get("until", float("inf"), type=float)
+    node = request.args.get("node")
+
+    query = "SELECT node_id, timestamp, confidence FROM barks\
+        WHERE timestamp >= ? AND timestamp < ?"
+    params = [since, until]
+    if node:
+        query += " AND node_id = ?"
+        params.append(node)
+    query += " ORDER BY timestamp"
+
+    rows = getDb().execute(query, params).fetchall()
+    return {"barks": rows}
+
+
+@app.route("/nodes", methods=["GET"])
+def get_nodes():
+    rows = getDb().execute(
+        "SELECT n.node_id, n.last_batch, n.last_seen,\
+            (SELECT count(*) FROM barks b WHERE b.node_id = n.node_id)\
+        FROM nodes n ORDER BY n.node_id"
+    ).fetchall()
+    return {
+        "nodes": [
+            {"node_id": r[0], "last_batch": r[1], "last_seen": r[2], "barks": r[3]}
+            for r in rows
+        ]
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bark event aggregator")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--db", default=dbname)
+    args = parser.parse_args()
+
+    dbname = args.db
+    dbConn = sqlite3.connect(dbname)
+    createTables(dbConn)
+    dbConn.close()
+
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,79 @@
+"""A module to stream tar archives without building them in memory or on disk."""
+
+import io
+import os
+import tarfile
+import time
+
+blockSize = tarfile.BLOCKSIZE
+readChunkSize = 64 * 1024
+
+
+def _padding(size: int) -> bytes:
+    remainder = size % blockSize
+    if remainder == 0:
+        return b""
+    return b"\0" * (blockSize - remainder)
+
+
+def _header(name: str, size: int, mtime: float) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def streamTar(entries):
+    """Yields a tar archive chunk by chunk.
+
+    Args:
+      entries: Iterable of (arcname, source) pairs. `source` is either a
+        bytes object or the path of a file to read in fixed-size chunks.
+
+    Yields:
+      Byte strings that together form a valid tar archive.
+    """
+    for arcname, source in entries:
+        if isinstance(source, (bytes, bytearray)):
+            yield _header(arcname, len(source), time.time())
+            yield bytes(source)
+            yield _padding(len(source))
+            continue
+
+        try:
+            f = open(source, "rb")
+        except OSError:
+            # file was removed between listing and reading, leave it out
+            continue
+
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            yield _header(arcname, size, stat.st_mtime)
+
+            remaining = size
+            while remaining > 0:
+                chunk = f.read(min(readChunkSize, remaining))
+                if not chunk:
+                    # file shrank while reading, keep the header size valid
+                    chunk = b"\0" * min(readChunkSize, remaining)
+                remaining -= len(chunk)
+                yield chunk
+            yield _padding(size)
+
+    # end of archive marker
+    yield b"\0" * (blockSize * 2)
+
+
+def readTar(stream: io.RawIOBase):
+    """Iterates (member, fileobj) pairs of a tar archive read from a stream.
+
+    The archive is consumed sequentially, so `fileobj` is only valid until
+    the next pair is requested.
+    """
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            yield (member, tar.extractfile(member))
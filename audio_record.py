@@ -15,24 +15,99 @@
 
 import queue
 import threading
+import time
 import datetime
 import numpy as np
 
-try:
-    import sounddevice as sd
-except OSError as oe:
-    sd = None
-    sd_error = oe
-except ImportError as ie:
-    sd = None
-    sd_error = ie
+from audio_source import AudioSource, DeviceSource, defaultBlockSize
+from bufferpool import Block, BlockRing, BufferPool
+from profiler import tracer
+
+
+class SampleClock(object):
+    """Maps the running sample index of a capture to wall time.
+
+    Time advances with the samples, not with the callbacks, so it doesn't
+    jitter with scheduling. Device clocks run a little fast or slow though:
+    every `reanchor_interval` seconds the seconds per sample are re-estimated
+    from the callback times, steering the error towards zero without a jump.
+    Only lost input or a wall clock change of more than `max_step` seconds
+    re-anchors hard.
+    """
+
+    def __init__(
+        self,
+        sampling_rate: int,
+        reanchor_interval: float = 60.0,
+        max_skew: float = 1e-3,
+        max_step: float = 0.5,
+    ) -> None:
+        self._nominal = 1.0 / sampling_rate
+        self._reanchor_interval = reanchor_interval
+        self._max_skew = max_skew
+        self._max_step = max_step
+        # (sample index, wall time, seconds per sample), replaced as a whole
+        self._anchor = None
+        # the callback the current estimate started from
+        self._observed = None
+        self.steps = 0
+
+    def observe(self, index: int, wall_time: float) -> None:
+        """Adds a callback that delivered samples up to `index` at `wall_time`."""
+        if self._anchor is None:
+            self._anchor = (index, wall_time, self._nominal)
+            self._observed = (index, wall_time)
+            return
+
+        error = wall_time - self.to_wall(index)
+        if abs(error) > self._max_step:
+            self._anchor = (index, wall_time, self._anchor[2])
+            self._observed = (index, wall_time)
+            self.steps += 1
+            return
+
+        (observed_index, observed_time) = self._observed
+        if wall_time - observed_time < self._reanchor_interval or index <= observed_index:
+            return
+        samples = index - observed_index
+        # the measured rate, plus what it takes to cancel the error by the
+        # next re-anchor
+        period = (wall_time - observed_time + error) / samples
+        period = min(
+            max(period, self._nominal * (1 - self._max_skew)),
+            self._nominal * (1 + self._max_skew),
+        )
+        self._anchor = (index, self.to_wall(index), period)
+        self._observed = (index, wall_time)
+
+    def to_wall(self, index: int) -> float:
+        """Wall time (seconds) at which sample `index` was captured."""
+        anchor = self._anchor
+        if anchor is None:
+            return time.time()
+        (anchor_index, anchor_time, period) = anchor
+        return anchor_time + (index - anchor_index) * period
+
+    def status(self) -> dict:
+        period = self._anchor[2] if self._anchor is not None else self._nominal
+        return {
+            "skew_ppm": round((period / self._nominal - 1) * 1e6, 1),
+            "steps": self.steps,
+        }
 
 
 class AudioRecord(object):
     """A class to record audio in a streaming basis."""
 
     def __init__(
-        self, channels: int, sampling_rate: int, buffer_size: int, device_id: int
+        self,
+        channels: int,
+        sampling_rate: int,
+        buffer_size: int,
+        device_id: int,
+        max_queued_samples: int = 0,
+        block_size: int = defaultBlockSize,
+        source: AudioSource = None,
     ) -> None:
         """Creates an AudioRecord instance.
 
@@ -40,15 +115,19 @@ class AudioRecord(object):
           channels: Number of input channels.
           sampling_rate: Sampling rate in Hertz.
           buffer_size: Size of the ring buffer in number of samples.
+          device_id: Sounddevice input device ID.
+          max_queued_samples: Upper bound of samples waiting in the audio
+            queue. Chunks arriving above it are dropped and counted. 0 means
+            unbounded.
+          block_size: Number of frames per pooled audio block.
+          source: Where the audio comes from. Defaults to the sounddevice
+            input `device_id`.
 
         Raises:
           ValueError: if any of the arguments is non-positive.
           ImportError: if failed to import `sounddevice`.
           OSError: if failed to load `PortAudio`.
         """
-        if sd is None:
-            raise sd_error
-
         if channels <= 0:
             raise ValueError("channels must be positive.")
         if sampling_rate <= 0:
@@ -56,40 +135,62 @@ class AudioRecord(object):
         if buffer_size <= 0:
             raise ValueError("buffer_size must be positive.")
 
-        self._audio_buffer = []
         self._audio_queue = queue.Queue()
         self._buffer_size = buffer_size
         self._channels = channels
         self._sampling_rate = sampling_rate
 
-        # Create a ring buffer to store the input audio.
-        self._buffer = np.zeros([buffer_size, channels], dtype=np.float32)
-        self._cur_data = (np.ndarray([buffer_size, channels], dtype=np.float32), 0.0)
+        # Every chunk is copied exactly once, out of PortAudio's memory into a
+        # pooled block. The ring, the audio queue and the file writer all hold
+        # references to that same block.
+        ring_blocks = -(-buffer_size // block_size) + 1
+        queue_blocks = -(-max_queued_samples // block_size) if max_queued_samples else 64
+        self._pool = BufferPool(block_size, channels, ring_blocks + queue_blocks)
+        self._ring = BlockRing(buffer_size)
+        self._clock = SampleClock(sampling_rate)
+        self._last_callback = 0.0
+        self._sample_count = 0
+        self._max_queued_samples = max_queued_samples
+        self._queued_samples = 0
+        self._dropped_samples = 0
+        self._bytes_copied = 0
         self._lock = threading.Lock()
 
-        def audio_callback(data, *_):
-            """A callback to receive recorded audio data from sounddevice."""
+        def audio_callback(data):
+            """A callback to receive recorded audio data from the source."""
+            spanStart = time.perf_counter_ns()
             self._lock.acquire()
-            timestamp = datetime.datetime.now()
-            shift = len(data)
-            if shift > buffer_size:
-                self._buffer = np.copy(data[:buffer_size])
-            else:
-                self._buffer = np.roll(self._buffer, -shift, axis=0)
-                self._buffer[-shift:, :] = np.copy(data)
-
-            self._cur_data = (self._buffer, timestamp)
+            self._clock.observe(self._sample_count + len(data), time.time())
+            for start in range(0, len(data), block_size):
+                block = self._pool.acquire(data[start : start + block_size])
+                block.index = self._sample_count
+                shift = block.frames
+                self._bytes_copied += block.data[:shift].nbytes
+                self._ring.push(block)
+                self._sample_count += shift
 
-            self._audio_queue.put((data.copy(), timestamp))
+                if (
+                    self._max_queued_samples > 0
+                    and self._queued_samples + shift > self._max_queued_samples
+                ):
+                    # the consumer stalled, never block the audio callback
+                    self._dropped_samples += shift
+                    block.release()
+                else:
+                    self._queued_samples += shift
+                    timestamp = datetime.datetime.fromtimestamp(
+                        self._clock.to_wall(block.index)
+                    )
+                    self._audio_queue.put((block, timestamp))
+            self._last_callback = time.monotonic()
             self._lock.release()
+            tracer.complete("audio_callback", spanStart, time.perf_counter_ns())
 
         # Create an input stream to continuously capture the audio data.
-        self._stream = sd.InputStream(
-            device=device_id,
-            channels=channels,
-            samplerate=sampling_rate,
-            callback=audio_callback,
-        )
+        if source is None:
+            source = DeviceSource(channels, sampling_rate, block_size, device_id)
+        self._source = source
+        self._source.setCallback(audio_callback)
 
     @property
     def channels(self) -> int:
@@ -106,23 +207,28 @@ class AudioRecord(object):
     def start_recording(self) -> None:
         """Starts the audio recording."""
         # Clear the internal ring buffer.
-        self._buffer.fill(0)
+        with self._lock:
+            self._ring.clear()
 
-        # Start recording using sounddevice's InputStream.
-        self._stream.start()
+        # Start recording from the audio source.
+        self._source.start()
 
     def stop(self) -> None:
         """Stops the audio recording."""
-        self._stream.stop()
+        self._source.stop()
 
-    def read_rolled_buffer(self, size: int) -> np.ndarray:
+    def read_rolled_buffer(self, size: int, out: np.ndarray = None) -> np.ndarray:
         """Reads the latest audio data captured in the buffer.
 
         Args:
           size: Number of samples to read from the buffer.
+          out: Optional preallocated [size, channels] float32 array to read
+            into, avoids allocating a new window on every call.
 
         Returns:
-          A NumPy array containing the audio data.
+          A tuple of a NumPy array containing the audio data, the capture time
+          of its end and the total number of samples captured so far (the
+          sample index just past the window).
 
         Raises:
           ValueError: Raised if `size` is larger than the buffer size.
@@ -132,17 +238,63 @@ class AudioRecord(object):
         elif size <= 0:
             raise ValueError("Size must be positive.")
 
-        start_index = self._buffer_size - size
-        return (np.copy(self._cur_data[0][start_index:]), self._cur_data[1])
+        if out is None:
+            out = np.empty([size, self._channels], dtype=np.float32)
+        with self._lock:
+            self._ring.readInto(out[:size])
+            self._bytes_copied += out[:size].nbytes
+            timestamp = datetime.datetime.fromtimestamp(
+                self._clock.to_wall(self._sample_count)
+            )
+            return (out[:size], timestamp, self._sample_count)
+
+    def sample_time(self, index: int) -> float:
+        """Wall time (seconds) at which sample `index` was captured."""
+        with self._lock:
+            return self._clock.to_wall(index)
+
+    def clock_status(self) -> dict:
+        with self._lock:
+            return self._clock.status()
+
+    @property
+    def last_callback(self) -> float:
+        """time.monotonic() of the latest audio callback, 0 before the first."""
+        return self._last_callback
+
+    @property
+    def dropped_samples(self) -> int:
+        """Number of samples dropped because the audio queue was full."""
+        return self._dropped_samples
+
+    @property
+    def queued_samples(self) -> int:
+        return self._queued_samples
+
+    @property
+    def bytes_copied(self) -> int:
+        """Number of audio bytes copied by capture and window reads."""
+        return self._bytes_copied
+
+    def pool_stats(self) -> dict:
+        return self._pool.stats()
 
     def queue_size(self):
         return self._audio_queue.qsize()
 
-    def read_queue(self) -> np.ndarray:
-        return self._audio_queue.get()
+    def read_queue(self) -> tuple[Block, datetime.datetime]:
+        """Returns the next captured (block, timestamp of its first sample).
+
+        The caller owns the block's reference and must release it.
+        """
+        item = self._audio_queue.get()
+        with self._lock:
+            self._queued_samples -= item[0].frames
+        return item
 
     def flush_queue(self) -> None:
         self._lock.acquire()
         while not self._audio_queue.empty():
-            self._audio_queue.get()
+            self._audio_queue.get()[0].release()
+        self._queued_samples = 0
         self._lock.release()
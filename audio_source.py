@@ -0,0 +1,342 @@
+"""Audio sources that can feed an AudioRecord.
+
+Besides the real input device there are sources reading a WAV file,
+synthesizing test signals and receiving raw audio over a local socket, so
+the detector and the server can run and be load tested without a
+microphone.
+"""
+
+import abc
+import os
+import socket
+import threading
+import time
+import numpy as np
+
+# frames per callback when a caller doesn't choose
+defaultBlockSize = 1024
+
+
+class AudioSource(abc.ABC):
+    """Base class. Calls `callback(data)` with [frames, channels] float32 chunks."""
+
+    def __init__(self, channels: int, sampling_rate: int, block_size: int) -> None:
+        self._channels = channels
+        self._sampling_rate = sampling_rate
+        self._block_size = block_size
+        self._callback = None
+
+    def setCallback(self, callback) -> None:
+        self._callback = callback
+
+    @abc.abstractmethod
+    def start(self) -> None:
+        """Starts delivering audio to the callback."""
+
+    @abc.abstractmethod
+    def stop(self) -> None:
+        """Stops delivering audio."""
+
+
+def importSounddevice():
+    """Imports sounddevice on first use.
+
+    PortAudio lists the devices present when it is initialized, which is on
+    import. The forkserver preloads this module once, so importing here
+    instead lets every (re)started detector process see the devices that
+    are connected now.
+    """
+    import sounddevice
+
+    return sounddevice
+
+
+def findDevice(sd, device_id: int, device_name: str = "") -> int:
+    """Returns the current index of the configured input device.
+
+    Indexes shift when a device is unplugged and plugged back in, so the
+    device is looked up by name when one is known.
+
+    Raises:
+      ValueError: if the named device is not connected.
+    """
+    if not device_name:
+        return device_id
+
+    devices = sd.query_devices()
+    if 0 <= device_id < len(devices) and devices[device_id]["name"] == device_name:
+        return device_id
+    for index, device in enumerate(devices):
+        if device["name"] == device_name and device["max_input_channels"] > 0:
+            return index
+    raise ValueError(f"input device {device_name!r} is not connected")
+
+
+class DeviceSource(AudioSource):
+    """Captures from a sounddevice input device."""
+
+    def __init__(
+        self,
+        channels: int,
+        sampling_rate: int,
+        block_size: int,
+        device_id: int,
+        device_name: str = "",
+    ) -> None:
+        """Creates a DeviceSource instance.
+
+        Raises:
+          ImportError: if failed to import `sounddevice`.
+          OSError: if failed to load `PortAudio`.
+          ValueError: if the named device is not connected.
+        """
+        sd = importSounddevice()
+
+        super().__init__(channels, sampling_rate, block_size)
+        self._stream = sd.InputStream(
+            device=findDevice(sd, device_id, device_name),
+            channels=channels,
+            samplerate=sampling_rate,
+            blocksize=block_size,
+            callback=lambda data, *_: self._callback(data),
+        )
+
+    def start(self) -> None:
+        self._stream.start()
+
+    def stop(self) -> None:
+        self._stream.stop()
+
+
+class ThreadedSource(AudioSource):
+    """A source producing blocks on its own thread, paced to real time."""
+
+    def __init__(
+        self, channels: int, sampling_rate: int, block_size: int, realtime: bool = True
+    ) -> None:
+        super().__init__(channels, sampling_rate, block_size)
+        self._realtime = realtime
+        self._running = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name="audioSource", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+
+    @abc.abstractmethod
+    def nextBlock(self) -> np.ndarray | None:
+        """Returns the next block, or None when the source is exhausted."""
+
+    def _run(self) -> None:
+        period = self._block_size / self._sampling_rate
+        deadline = time.monotonic()
+        while self._running.is_set():
+            block = self.nextBlock()
+            if block is None:
+                return
+            self._callback(block)
+            if self._realtime:
+                deadline += period
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class WavFileSource(ThreadedSource):
+    """Plays a WAV file as if it was captured live, optionally looping."""
+
+    def __init__(
+        self,
+        channels: int,
+        sampling_rate: int,
+        block_size: int,
+        path: str,
+        loop: bool = True,
+        realtime: bool = True,
+    ) -> None:
+        from soundfile import SoundFile
+
+        super().__init__(channels, sampling_rate, block_size, realtime)
+        self._file = SoundFile(path)
+        if self._file.samplerate != sampling_rate:
+            raise ValueError(
+                f"{path} is {self._file.samplerate}Hz, expected {sampling_rate}Hz"
+            )
+        self._loop = loop
+
+    def nextBlock(self) -> np.ndarray | None:
+        data = self._file.read(self._block_size, dtype="float32", always_2d=True)
+        if data.shape[0] < self._block_size:
+            if not self._loop:
+                return data if data.shape[0] else None
+            self._file.seek(0)
+            rest = self._file.read(
+                self._block_size - data.shape[0], dtype="float32", always_2d=True
+            )
+            data = np.concatenate((data, rest))
+        return self._matchChannels(data)
+
+    def _matchChannels(self, data: np.ndarray) -> np.ndarray:
+        if data.shape[1] == self._channels:
+            return data
+        mono = data.mean(axis=1, keepdims=True)
+        return np.repeat(mono, self._channels, axis=1)
+
+
+class SynthSource(ThreadedSource):
+    """Generates a tone, white noise, or noise with synthetic bark bursts."""
+
+    kinds = ("tone", "noise", "bark")
+
+    def __init__(
+        self,
+        channels: int,
+        sampling_rate: int,
+        block_size: int,
+        kind: str = "bark",
+        level: float = 0.05,
+        bark_every: float = 5.0,
+        seed: int = 0,
+        realtime: bool = True,
+    ) -> None:
+        if kind not in self.kinds:
+            raise ValueError(f"kind must be one of {self.kinds}")
+
+        super().__init__(channels, sampling_rate, block_size, realtime)
+        self._kind = kind
+        self._level = level
+        self._bark_every = int(bark_every * sampling_rate)
+        self._rng = np.random.default_rng(seed)
+        self._position = 0
+
+        # one bark: a 250 ms harmonic burst around 600 Hz with a fast decay
+        t = np.arange(int(0.25 * sampling_rate)) / sampling_rate
+        envelope = np.exp(-t * 18.0) * (1 - np.exp(-t * 400.0))
+        pitch = 600.0 * (1 - 0.3 * t / t[-1])
+        phase = 2 * np.pi * np.cumsum(pitch) / sampling_rate
+        self._bark = (
+            0.6
+            * envelope
+            * (np.sin(phase) + 0.5 * np.sin(2 * phase) + 0.25 * np.sin(3 * phase))
+        ).astype(np.float32)
+
+    def nextBlock(self) -> np.ndarray:
+        n = self._block_size
+        idx = self._position + np.arange(n)
+        if self._kind == "tone":
+            mono = self._level * np.sin(2 * np.pi * 440.0 * idx / self._sampling_rate)
+        else:
+            mono = self._level * self._rng.standard_normal(n)
+            if self._kind == "bark":
+                offset = idx % self._bark_every
+                inBark = offset < self._bark.shape[0]
+                mono[inBark] += self._bark[offset[inBark]]
+
+        self._position += n
+        block = mono.astype(np.float32)[:, None]
+        return np.repeat(block, self._channels, axis=1)
+
+
+class SocketSource(AudioSource):
+    """Receives raw interleaved float32 frames on a local Unix socket.
+
+    Any process can connect to `path` and stream audio; one sender at a time
+    is read, and a new connection replaces the previous one.
+    """
+
+    def __init__(
+        self, channels: int, sampling_rate: int, block_size: int, path: str
+    ) -> None:
+        super().__init__(channels, sampling_rate, block_size)
+        self._path = path
+        self._server = None
+        self._running = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self._path)
+        self._server.listen(1)
+        self._server.settimeout(0.5)
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name="audioSource", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+        self._server.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    def _run(self) -> None:
+        frameBytes = 4 * self._channels
+        blockBytes = frameBytes * self._block_size
+        while self._running.is_set():
+            try:
+                conn, _ = self._server.accept()
+            except socket.timeout:
+                continue
+
+            with conn:
+                conn.settimeout(0.5)
+                pending = bytearray()
+                while self._running.is_set():
+                    try:
+                        chunk = conn.recv(blockBytes)
+                    except socket.timeout:
+                        continue
+                    if not chunk:
+                        break
+                    pending += chunk
+                    usable = len(pending) - len(pending) % blockBytes
+                    if usable:
+                        data = np.frombuffer(bytes(pending[:usable]), dtype=np.float32)
+                        del pending[:usable]
+                        self._callback(data.reshape(-1, self._channels))
+
+
+def sendToSocket(path: str, source: ThreadedSource, seconds: float) -> None:
+    """Streams `seconds` of audio from `source` into a SocketSource at `path`."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    source.setCallback(lambda data: client.sendall(data.astype(np.float32).tobytes()))
+    source.start()
+    time.sleep(seconds)
+    source.stop()
+    client.close()
+
+
+def createSource(
+    spec: str,
+    channels: int,
+    sampling_rate: int,
+    block_size: int,
+    device_id: int,
+    device_name: str = "",
+) -> AudioSource:
+    """Builds a source from the `audio_source` setting.
+
+    `spec` is "device", "wav:<path>", "synth:<tone|noise|bark>" or
+    "socket:<path>".
+    """
+    kind, _, arg = spec.partition(":")
+    if kind == "device":
+        return DeviceSource(channels, sampling_rate, block_size, device_id, device_name)
+    elif kind == "wav":
+        return WavFileSource(channels, sampling_rate, block_size, arg)
+    elif kind == "synth":
+        return SynthSource(channels, sampling_rate, block_size, arg or "bark")
+    elif kind == "socket":
+        return SocketSource(channels, sampling_rate, block_size, arg)
+
+    raise ValueError(f"unknown audio source {spec!r}")
@@ -0,0 +1,170 @@
+"""Benchmark of the capture -> inference -> disk audio path.
+
+Feeds synthetic audio chunks through the previous copy-per-stage path and the
+pooled-block path and reports, per second of audio, how much memory each path
+allocates, how many bytes it copies, how many file writes it issues, and the
+CPU time it takes. Both paths are measured the same way: tracemalloc's peak
+above the traced memory at the start of every chunk adds up to the bytes the
+chunk allocated, and sys.getallocatedblocks() counts the blocks a path still
+holds when it is done.
+
+    python bench_pipeline.py [--seconds 600]
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from bufferpool import BlockRing, BufferPool, Pcm16BatchWriter
+
+sampleRate = 16000
+chunkSize = 1024
+windowSize = 15600
+hop = windowSize // 2
+writeBufferLength = 3
+
+
+class NullSoundFile(object):
+    def __init__(self):
+        self.writes = 0
+        self.frames = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.frames += data.shape[0]
+
+    def flush(self):
+        pass
+
+
+def makeChunks(seconds: float):
+    rng = np.random.default_rng(0)
+    chunk = (rng.standard_normal([chunkSize, 1]) * 0.1).astype(np.float32)
+    for _ in range(int(seconds * sampleRate / chunkSize)):
+        yield chunk
+
+
+def legacyPath(chunks):
+    """Mirrors the copies the detector made before the buffer pool.
+
+    Yields once per chunk, the stats are the generator's return value.
+    """
+    stats = {"bytes_copied": 0}
+    sf = NullSoundFile()
+    buffer = np.zeros([windowSize, 1], dtype=np.float32)
+    captured = 0
+    for data in chunks:
+        # audio_callback: roll, copy into the ring, copy into the queue
+        buffer = np.roll(buffer, -len(data), axis=0)
+        buffer[-len(data) :, :] = np.copy(data)
+        queued = data.copy()
+        stats["bytes_copied"] += buffer.nbytes + 2 * data.nbytes
+        captured += len(data)
+
+        # detectorListen: copy of the window, then astype(float32)
+        if captured >= hop:
+            captured -= hop
+            window = np.copy(buffer).astype(np.float32)
+            stats["bytes_copied"] += 2 * window.nbytes
+
+        # saveRecording: one write (and PCM_16 conversion) per chunk
+        sf.write(queued)
+        yield
+
+    stats["writes"] = sf.writes
+    return stats
+
+
+def pooledPath(chunks):
+    pool = BufferPool(chunkSize, 1, windowSize // chunkSize + 64)
+    ring = BlockRing(windowSize)
+    window = np.zeros([windowSize, 1], dtype=np.float32)
+    sf = NullSoundFile()
+    writer = Pcm16BatchWriter(sf, sampleRate * writeBufferLength, 1)
+    stats = {"bytes_copied": 0}
+    captured = 0
+    for data in chunks:
+        block = pool.acquire(data)
+        stats["bytes_copied"] += data.nbytes
+        ring.push(block)
+        captured += block.frames
+
+        if captured >= hop:
+            captured -= hop
+            ring.readInto(window)
+            stats["bytes_copied"] += window.nbytes
+
+        # the queue hands the same block to the writer
+        writer.write(block.view())
+        stats["bytes_copied"] += block.view().nbytes
+        block.release()
+        yield
+
+    writer.flush()
+    stats["pool_growth"] = pool.allocations
+    stats["writes"] = sf.writes
+    return stats
+
+
+def drain(steps):
+    try:
+        while True:
+            next(steps)
+    except StopIteration as stop:
+        return stop.value
+
+
+def measureAllocations(path, seconds):
+    """Returns (bytes allocated, blocks held, peak bytes) of a path.
+
+    The first chunk also sets the path up, its allocations only count
+    towards the peak. Blocks held are those still allocated after the
+    last chunk, buffers the path keeps across chunks.
+    """
+    chunks = list(makeChunks(seconds))
+    tracemalloc.start()
+    steps = path(chunks)
+    next(steps)
+    blocksBefore = sys.getallocatedblocks()
+    blocksHeld = 0
+    allocated = 0
+    while True:
+        (current, _) = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        try:
+            next(steps)
+        except StopIteration:
+            break
+        allocated += tracemalloc.get_traced_memory()[1] - current
+        blocksHeld = sys.getallocatedblocks() - blocksBefore
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (allocated, blocksHeld, peak)
+
+
+def run(name, path, seconds):
+    # timed without tracemalloc, tracing every allocation slows both paths
+    start = time.process_time()
+    stats = drain(path(makeChunks(seconds)))
+    cpu = time.process_time() - start
+    (allocated, heldBlocks, peak) = measureAllocations(path, seconds)
+
+    print(
+        f"{name:>8}: {allocated / seconds / 1024:8.1f} KiB allocated/s"
+        f"  {heldBlocks:6d} blocks held"
+        f"  {stats['bytes_copied'] / seconds / 1024:8.1f} KiB copied/s"
+        f"  {stats['writes'] / seconds:6.2f} writes/s"
+        f"  {cpu / seconds * 1000:6.3f} ms cpu/s"
+        f"  {peak / 1024:8.1f} KiB peak"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=600)
+    args = parser.parse_args()
+
+    run("legacy", legacyPath, args.seconds)
+    run("pooled", pooledPath, args.seconds)
@@ -0,0 +1,180 @@
+"""A module with preallocated audio buffers shared by capture, inference and disk."""
+
+import collections
+import threading
+import numpy as np
+
+
+class Block(object):
+    """A reference-counted audio block handed out by a BufferPool.
+
+    The first `frames` rows of `data` hold valid audio, `index` is the capture
+    sample index of the first row. Every holder that keeps the block beyond
+    the call it received it in must `retain` it, and every holder must
+    `release` it when done; the last release recycles the block.
+    """
+
+    __slots__ = ("data", "frames", "index", "_refs", "_pool")
+
+    def __init__(self, pool, blockSize: int, channels: int) -> None:
+        self.data = np.zeros([blockSize, channels], dtype=np.float32)
+        self.frames = 0
+        self.index = 0
+        self._refs = 0
+        self._pool = pool
+
+    def view(self) -> np.ndarray:
+        return self.data[: self.frames]
+
+    def retain(self) -> "Block":
+        self._pool._retain(self)
+        return self
+
+    def release(self) -> None:
+        self._pool._release(self)
+
+
+class BufferPool(object):
+    """A free list of fixed-size audio blocks.
+
+    Blocks are preallocated up front; if the pool runs dry it grows by one
+    block at a time and counts the allocation, so steady state runs without
+    allocating.
+    """
+
+    def __init__(self, blockSize: int, channels: int, numBlocks: int) -> None:
+        if blockSize <= 0:
+            raise ValueError("blockSize must be positive.")
+        if numBlocks <= 0:
+            raise ValueError("numBlocks must be positive.")
+
+        self._blockSize = blockSize
+        self._channels = channels
+        self._lock = threading.Lock()
+        self._free = [Block(self, blockSize, channels) for _ in range(numBlocks)]
+        self._total = numBlocks
+        self.allocations = 0
+
+    @property
+    def block_size(self) -> int:
+        return self._blockSize
+
+    def acquire(self, data: np.ndarray) -> Block:
+        """Copies `data` (at most block_size frames) into a free block.
+
+        The returned block has a reference count of one.
+        """
+        with self._lock:
+            if self._free:
+                block = self._free.pop()
+            else:
+                block = Block(self, self._blockSize, self._channels)
+                self._total += 1
+                self.allocations += 1
+            block._refs = 1
+
+        frames = min(data.shape[0], self._blockSize)
+        block.data[:frames] = data[:frames]
+        block.frames = frames
+        return block
+
+    def _retain(self, block: Block) -> None:
+        with self._lock:
+            block._refs += 1
+
+    def _release(self, block: Block) -> None:
+        with self._lock:
+            block._refs -= 1
+            if block._refs == 0:
+                self._free.append(block)
+            elif block._refs < 0:
+                raise RuntimeError("audio block released more often than retained")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "blocks": self._total,
+                "free_blocks": len(self._free),
+                "allocations": self.allocations,
+            }
+
+
+class BlockRing(object):
+    """A ring of the most recent blocks, sharing memory with the audio queue.
+
+    Instead of copying every chunk into a contiguous buffer, the ring keeps a
+    reference to the last blocks covering `size` frames. The window is only
+    assembled when it is read.
+    """
+
+    def __init__(self, size: int) -> None:
+        self._blocks = collections.deque()
+        self._frames = 0
+        self._size = size
+
+    def push(self, block: Block) -> None:
+        self._blocks.append(block.retain())
+        self._frames += block.frames
+        while self._frames - self._blocks[0].frames >= self._size:
+            old = self._blocks.popleft()
+            self._frames -= old.frames
+            old.release()
+
+    def clear(self) -> None:
+        while self._blocks:
+            self._blocks.popleft().release()
+        self._frames = 0
+
+    def readInto(self, out: np.ndarray) -> np.ndarray:
+        """Copies the latest len(out) frames into `out`, oldest first.
+
+        Frames not captured yet are zero.
+        """
+        pos = out.shape[0]
+        for block in reversed(self._blocks):
+            if pos <= 0:
+                break
+            n = min(block.frames, pos)
+            out[pos - n : pos] = block.data[block.frames - n : block.frames]
+            pos -= n
+        if pos > 0:
+            out[:pos] = 0
+        return out
+
+
+class Pcm16BatchWriter(object):
+    """Converts float blocks to int16 into one preallocated batch.
+
+    The batch is handed to the sound file in a single large write once full,
+    instead of letting the file convert and write every small chunk.
+    """
+
+    def __init__(self, soundFile, batchFrames: int, channels: int) -> None:
+        self._soundFile = soundFile
+        self._batch = np.empty([max(1, batchFrames), channels], dtype=np.int16)
+        self._scratch = np.empty([0, channels], dtype=np.float32)
+        self._pos = 0
+
+    def write(self, data: np.ndarray) -> None:
+        while data.shape[0] > 0:
+            n = min(data.shape[0], self._batch.shape[0] - self._pos)
+            if self._scratch.shape[0] < n:
+                self._scratch = np.empty([n, data.shape[1]], dtype=np.float32)
+            scratch = self._scratch[:n]
+            # float32 operands and an in-place rint keep numpy from buffering
+            # a casting loop, the final copy casts without a temporary
+            np.clip(data[:n], np.float32(-1.0), np.float32(1.0), out=scratch)
+            np.multiply(scratch, np.float32(32767.0), out=scratch)
+            # round like libsndfile does, a plain cast truncates towards zero
+            np.rint(scratch, out=scratch)
+            np.copyto(self._batch[self._pos : self._pos + n], scratch, casting="unsafe")
+            self._pos += n
+            data = data[n:]
+            if self._pos == self._batch.shape[0]:
+                self.flush()
+
+    def flush(self) -> None:
+        if self._pos > 0:
+            self._soundFile.write(self._batch[: self._pos])
+            self._pos = 0
+        self._soundFile.flush()
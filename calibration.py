@@ -0,0 +1,193 @@
+"""A module to learn score distributions and suggest detection thresholds."""
+
+import json
+import math
+import os
+import threading
+
+# quantile levels tracked for every class and hour
+quantileLevels = (0.5, 0.9, 0.95, 0.99, 0.995, 0.999)
+combinedKey = "combined"
+
+
+class P2Quantile(object):
+    """Streaming estimate of one quantile in constant memory (the P² algorithm).
+
+    Keeps five markers whose heights approximate the minimum, the p/2, p and
+    (1+p)/2 quantiles and the maximum, adjusted with a piecewise parabolic
+    fit as values arrive.
+    """
+
+    __slots__ = ("p", "count", "heights", "positions", "desired", "increments")
+
+    def __init__(self, p: float) -> None:
+        self.p = p
+        self.count = 0
+        self.heights = []
+        self.positions = [1.0, 2.0, 3.0, 4.0, 5.0]
+        self.desired = [1.0, 1.0 + 2 * p, 1.0 + 4 * p, 3.0 + 2 * p, 5.0]
+        self.increments = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        if self.count <= 5:
+            self.heights.append(x)
+            if self.count == 5:
+                self.heights.sort()
+            return
+
+        q = self.heights
+        n = self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                candidate = self._parabolic(i, d)
+                if not q[i - 1] < candidate < q[i + 1]:
+                    candidate = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = candidate
+                n[i] += d
+
+    def _parabolic(self, i: int, d: int) -> float:
+        q = self.heights
+        n = self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self) -> float | None:
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            ordered = sorted(self.heights)
+            return ordered[min(len(ordered) - 1, int(self.p * len(ordered)))]
+        return self.heights[2]
+
+    def toDict(self) -> dict:
+        return {
+            "p": self.p,
+            "count": self.count,
+            "heights": self.heights,
+            "positions": self.positions,
+            "desired": self.desired,
+        }
+
+    @classmethod
+    def fromDict(cls, data: dict) -> "P2Quantile":
+        est = cls(data["p"])
+        est.count = data["count"]
+        est.heights = list(data["heights"])
+        est.positions = list(data["positions"])
+        est.desired = list(data["desired"])
+        return est
+
+
+def interpolateThreshold(quantiles: dict, rate: float) -> float | None:
+    """Estimates the score exceeded by a fraction `rate` of windows.
+
+    Interpolates between the tracked levels on a log scale of the tail
+    probability, and clamps to the outermost level outside that range.
+    """
+    points = sorted(
+        (1.0 - level, value) for level, value in quantiles.items() if value is not None
+    )
+    if not points:
+        return None
+    if rate <= points[0][0]:
+        return points[0][1]
+    if rate >= points[-1][0]:
+        return points[-1][1]
+
+    for (tailA, valueA), (tailB, valueB) in zip(points, points[1:]):
+        if tailA <= rate <= tailB:
+            t = (math.log(rate) - math.log(tailA)) / (math.log(tailB) - math.log(tailA))
+            return valueA + t * (valueB - valueA)
+    return None
+
+
+class ScoreCalibrator(object):
+    """Per-class, per-hour-of-day score quantiles.
+
+    Most windows don't contain a bark, so the score exceeded by a fraction r
+    of all windows is a threshold giving about r false triggers per window.
+    """
+
+    def __init__(self, classNames: list) -> None:
+        self._keys = list(classNames) + [combinedKey]
+        self._lock = threading.Lock()
+        self._sketches = [
+            {key: [P2Quantile(p) for p in quantileLevels] for key in self._keys}
+            for _ in range(24)
+        ]
+
+    def add(self, hour: int, scores: list, combined: float) -> None:
+        with self._lock:
+            sketch = self._sketches[hour]
+            for key, score in zip(self._keys, list(scores) + [combined]):
+                for est in sketch[key]:
+                    est.add(float(score))
+
+    def samples(self, hour: int) -> int:
+        return self._sketches[hour][combinedKey][0].count
+
+    def quantiles(self, hour: int, key: str = combinedKey) -> dict:
+        with self._lock:
+            return {est.p: est.value() for est in self._sketches[hour][key]}
+
+    def suggest(self, hour: int, rate: float, key: str = combinedKey) -> float | None:
+        return interpolateThreshold(self.quantiles(hour, key), rate)
+
+    def report(self, rate: float) -> dict:
+        report = {}
+        for hour in range(24):
+            if self.samples(hour) == 0:
+                continue
+            report[hour] = {
+                "samples": self.samples(hour),
+                "suggested_threshold": {
+                    key: self.suggest(hour, rate, key) for key in self._keys
+                },
+                "quantiles": {key: self.quantiles(hour, key) for key in self._keys},
+            }
+        return report
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            data = [
+                {key: [est.toDict() for est in ests] for key, ests in sketch.items()}
+                for sketch in self._sketches
+            ]
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        with self._lock:
+            for hour, sketch in enumerate(data[:24]):
+                for key, ests in sketch.items():
+                    if key in self._keys:
+                        self._sketches[hour][key] = [P2Quantile.fromDict(e) for e in ests]
@@ -0,0 +1,225 @@
+"""Cuts bark clips out of recordings.
+
+Every bark row that fell into a saved recording knows the file and the offset
+of its inference window, so a clip is one seek and one read instead of a scan
+from the start of the file. Offsets are in seconds, so they still hold after
+retention resampled the file. Within the window the onset is the first
+short frame that comes close to the window's loudest frame, which places it
+to about 10 ms instead of the window's ~1 s.
+
+A day's clips are cut on a pool of workers, one recording per task so each
+file is opened once:
+
+    python clips.py --day 2024-05-01 --out clips/
+"""
+
+import argparse
+import datetime
+import io
+import json
+import multiprocessing as mp
+import multiprocessing.pool
+import os
+import sqlite3
+import numpy as np
+
+import db
+from soundfile import SoundFile
+from utils import Settings, readSettings, resolveRecordingPath
+
+# seconds of audio kept before and after the onset by default
+defaultBefore = 0.5
+defaultAfter = 1.5
+# frame length of the onset search
+onsetFrameSeconds = 0.01
+# the onset is the first frame at most this far below the loudest frame
+onsetRangeDb = 12.0
+
+
+def findOnset(window: np.ndarray, samplerate: int) -> int:
+    """Returns the offset of the onset within a [frames, channels] window."""
+    frameSize = max(1, round(samplerate * onsetFrameSeconds))
+    count = window.shape[0] // frameSize
+    if count == 0:
+        return 0
+    mono = window[: count * frameSize].mean(axis=1)
+    energy = np.square(mono).reshape(count, frameSize).mean(axis=1)
+    peak = energy.max()
+    if peak <= 0:
+        return 0
+    loud = np.flatnonzero(energy >= peak * 10 ** (-onsetRangeDb / 10))
+    return int(loud[0]) * frameSize
+
+
+def readClip(
+    f: SoundFile,
+    offset: float,
+    length: float,
+    before: float = defaultBefore,
+    after: float = defaultAfter,
+    refine: bool = True,
+) -> tuple[np.ndarray, int]:
+    """Reads a clip around a bark from an open recording.
+
+    Args:
+      f: The recording.
+      offset: Offset (seconds) of the bark's inference window in the file.
+      length: Length (seconds) of the window.
+      before: Seconds to keep before the onset.
+      after: Seconds to keep after the onset.
+      refine: Search the onset within the window, else the window start is
+        used.
+
+    Returns:
+      The [frames, channels] float32 clip and the onset's sample offset in
+      the file.
+    """
+    onset = min(round(offset * f.samplerate), f.frames)
+    frames = min(round(length * f.samplerate), f.frames - onset)
+    if refine and frames > 0:
+        f.seek(onset)
+        window = f.read(frames, dtype="float32", always_2d=True)
+        onset += findOnset(window, f.samplerate)
+
+    start = max(0, onset - round(before * f.samplerate))
+    end = min(f.frames, onset + round(after * f.samplerate))
+    f.seek(start)
+    clip = f.read(max(0, end - start), dtype="float32", always_2d=True)
+    return (clip, onset)
+
+
+def encodeWav(clip: np.ndarray, samplerate: int) -> bytes:
+    out = io.BytesIO()
+    with SoundFile(
+        out,
+        "w",
+        samplerate=samplerate,
+        channels=clip.shape[1],
+        subtype="PCM_16",
+        format="WAV",
+    ) as f:
+        f.write(clip)
+    return out.getvalue()
+
+
+def clipName(barkId: int, timestamp: float) -> str:
+    stamp = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d_%H-%M-%S")
+    return f"{stamp}_bark{barkId}.wav"
+
+
+def extractRecording(task: tuple) -> list:
+    """Cuts every bark of one recording.
+
+    Args:
+      task: (wav path, bark rows as returned by db.getBarkPositionsBetween,
+        before, after).
+
+    Returns:
+      (clip file name, WAV bytes, index entry) per bark, an empty list if the
+      recording is gone.
+    """
+    (wavPath, barks, before, after) = task
+    clips = []
+    try:
+        f = SoundFile(wavPath)
+    except (OSError, RuntimeError):
+        # removed by retention since the rows were read
+        return clips
+
+    with f:
+        for barkId, timestamp, confidence, name, offset, length in barks:
+            (clip, onset) = readClip(f, offset, length, before, after)
+            clipFile = clipName(barkId, timestamp)
+            clips.append(
+                (
+                    clipFile,
+                    encodeWav(clip, f.samplerate),
+                    {
+                        "id": barkId,
+                        "timestamp": timestamp,
+                        "confidence": confidence,
+                        "recording": name,
+                        "onset": onset / f.samplerate,
+                        "clip": clipFile,
+                    },
+                )
+            )
+    return clips
+
+
+def extractBarks(
+    recordingPath: str,
+    barks: list,
+    before: float = defaultBefore,
+    after: float = defaultAfter,
+    workers: int = 4,
+    processes: bool = False,
+):
+    """Cuts clips of many barks in parallel.
+
+    Reading and encoding release the GIL, so threads keep several cores
+    busy without the startup cost of processes. `processes` spawns worker
+    processes instead, for large batches run from the command line.
+
+    Yields:
+      (clip file name, WAV bytes, index entry), grouped by recording in the
+      order the recordings finish.
+    """
+    byFile = {}
+    for bark in barks:
+        byFile.setdefault(bark[3], []).append(bark)
+    tasks = [
+        (os.path.join(recordingPath, f"{name}.wav"), rows, before, after)
+        for name, rows in byFile.items()
+    ]
+    if not tasks:
+        return
+
+    workers = max(1, min(workers, len(tasks)))
+    if processes:
+        pool = mp.get_context("spawn").Pool(workers)
+    else:
+        pool = multiprocessing.pool.ThreadPool(workers)
+    with pool:
+        for clips in pool.imap_unordered(extractRecording, tasks):
+            yield from clips
+
+
+def dayBounds(day: str) -> tuple[float, float]:
+    """Start and end timestamps of a YYYY-MM-DD day, raises ValueError."""
+    start = datetime.datetime.strptime(day, "%Y-%m-%d")
+    return (start.timestamp(), (start + datetime.timedelta(days=1)).timestamp())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cut the bark clips of a day")
+    parser.add_argument("--day", default=datetime.date.today().isoformat())
+    parser.add_argument("--out", required=True, help="directory for the clips")
+    parser.add_argument("--recordings", help="recording directory (default from settings)")
+    parser.add_argument("--before", type=float, default=defaultBefore)
+    parser.add_argument("--after", type=float, default=defaultAfter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    recordingPath = args.recordings or resolveRecordingPath(
+        (readSettings() or {}).get(Settings.RECORDING_FILE_PATH.value, "")
+    )
+    (start, end) = dayBounds(args.day)
+    dbConn = sqlite3.connect(db.dbname)
+    db.createTables(dbConn)
+    barks = db.getBarkPositionsBetween(dbConn, start, end)
+    dbConn.close()
+
+    os.makedirs(args.out, exist_ok=True)
+    index = []
+    for clipFile, data, entry in extractBarks(
+        recordingPath, barks, args.before, args.after, args.workers, processes=True
+    ):
+        with open(os.path.join(args.out, clipFile), "wb") as f:
+            f.write(data)
+        index.append(entry)
+
+    index.sort(key=lambda e: e["timestamp"])
+    with open(os.path.join(args.out, "clips.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    print(f"cut {len(index)} clips of {len(barks)} located barks into {args.out}")
@@ -1,30 +1,124 @@
 import sqlite3
 import datetime
+import glob
+import json
+import os
+import re
+import threading
 from utils import getTodaysFirstTimestamp
 
 dbname = "barking_detector.db"
 
 
+def useAutoincrement(dbConn: sqlite3.Connection, table: str, createSql: str):
+    """Rebuilds `table` of an older database with an AUTOINCREMENT id.
+
+    Plain INTEGER PRIMARY KEY ids are reused once retention deleted the
+    newest rows, which id cursors like the uplink's and the export's would
+    then skip. Ids are copied as they are, so existing cursors stay valid.
+    The write lock is only taken when the table still needs the rebuild.
+    """
+
+    def tableSql() -> str:
+        return cur.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()[0]
+
+    dbConn.commit()
+    cur = dbConn.cursor()
+    if "AUTOINCREMENT" in tableSql().upper():
+        return
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        # another process may have rebuilt it in the meantime
+        if "AUTOINCREMENT" not in tableSql().upper():
+            columns = ", ".join(
+                row[1] for row in cur.execute(f"PRAGMA table_info({table})")
+            )
+            cur.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+            cur.execute(createSql)
+            cur.execute(
+                f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_old"
+            )
+            # drops its indexes too, they are created again below
+            cur.execute(f"DROP TABLE {table}_old")
+            print(f"rebuilt {table} with AUTOINCREMENT ids")
+        dbConn.commit()
+    except BaseException:
+        dbConn.rollback()
+        raise
+
+
 def createTables(dbConn: sqlite3.Connection):
     cur = dbConn.cursor()
-    cur.execute(
-        "CREATE TABLE if NOT EXISTS audio_files(\
-            id  INTEGER PRIMARY KEY  NOT NULL,\
+    # only takes effect on a new database, the retention job converts old ones
+    cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # AUTOINCREMENT never hands out an id twice, even after the newest rows
+    # were deleted, so reading rows by id never misses any
+    audioFilesSql = "CREATE TABLE if NOT EXISTS audio_files(\
+            id  INTEGER PRIMARY KEY AUTOINCREMENT  NOT NULL,\
             name        TEXT    NOT NULL,\
             timestamp   REAL    NOT NULL,\
             length      REAL    NOT NULL,\
             day_id      INT     NOT NULL\
         )"
+    cur.execute(audioFilesSql)
+
+    # file, file_offset and window_length (seconds) locate the bark's inference
+    # window in its recording, they stay NULL for barks outside of a saved
+    # recording. Seconds stay valid when retention resamples the file.
+    barksSql = "CREATE TABLE if NOT EXISTS barks(\
+            id  INTEGER PRIMARY KEY AUTOINCREMENT  NOT NULL,\
+            timestamp   REAL    NOT NULL,\
+            confidence  REAL    NOT NULL,\
+            file        TEXT,\
+            file_offset     REAL,\
+            window_length   REAL\
+        )"
+    cur.execute(barksSql)
+    # databases created before barks were located in their recordings
+    barkColumns = [row[1] for row in cur.execute("PRAGMA table_info(barks)")]
+    for column, columnType in (
+        ("file", "TEXT"),
+        ("file_offset", "REAL"),
+        ("window_length", "REAL"),
+    ):
+        if column not in barkColumns:
+            cur.execute(f"ALTER TABLE barks ADD COLUMN {column} {columnType}")
+    useAutoincrement(dbConn, "audio_files", audioFilesSql)
+    useAutoincrement(dbConn, "barks", barksSql)
+
+    cur.execute(
+        "CREATE TABLE if NOT EXISTS bark_aggregates(\
+            minute          REAL    PRIMARY KEY  NOT NULL,\
+            count           INT     NOT NULL,\
+            max_confidence  REAL    NOT NULL,\
+            sum_confidence  REAL    NOT NULL\
+        )"
     )
 
+    # per-episode summary of the spectral features, as JSON
     cur.execute(
-        "CREATE TABLE if NOT EXISTS barks(\
-            id  INTEGER PRIMARY KEY  NOT NULL,\
-            timestamp   REAL    NOT NULL,\
-            confidence  REAL    NOT NULL\
+        "CREATE TABLE if NOT EXISTS recording_features(\
+            name        TEXT    PRIMARY KEY  NOT NULL,\
+            features    TEXT    NOT NULL\
         )"
     )
 
+    cur.execute(
+        "CREATE INDEX if NOT EXISTS audio_files_timestamp ON audio_files(timestamp)"
+    )
+    cur.execute("CREATE INDEX if NOT EXISTS barks_timestamp ON barks(timestamp)")
+    cur.execute("CREATE INDEX if NOT EXISTS barks_file ON barks(file)")
+
+    # the name embeds the date and day_id, so this rejects a reused day_id
+    try:
+        cur.execute(
+            "CREATE UNIQUE INDEX if NOT EXISTS audio_files_name ON audio_files(name)"
+        )
+    except sqlite3.IntegrityError:
+        print("audio_files has duplicate names, recording names are not enforced unique")
+
     dbConn.commit()
 
 
@@ -33,7 +127,7 @@ def getNextDayId(dbConn: sqlite3.Connection):
     today = getTodaysFirstTimestamp()
 
     lastDayId = cur.execute(
-        f"SELECT max(day_id) from audio_files WHERE timestamp >= {today}"
+        "SELECT max(day_id) from audio_files WHERE timestamp >= ?", (today,)
     ).fetchone()[0]
 
     nextDayId = 1
@@ -50,26 +144,350 @@ def insertRecording(
     length: float,
     nextDayId: int,
 ):
+    tsseconds = timestamp.timestamp()
+
+    with dbConn:
+        dbConn.execute(
+            "INSERT INTO audio_files (name, timestamp, length, day_id)\
+                VALUES(?, ?, ?, ?)",
+            (name, tsseconds, length, nextDayId),
+        )
+
+
+def recordingName(timestamp: datetime.datetime, dayId: int) -> str:
+    return f"{timestamp.strftime('%b-%d-%Y_%I:%M%p')}_#{dayId}"
+
+
+class DayIdAllocator(object):
+    """Hands out per-day recording ids from memory.
+
+    Seeded once at startup, after which allocating an id needs no database
+    round trip and can't race with another allocation. The counter starts
+    over at 1 when the date changes.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._day = None
+        self._next = 1
+
+    def seed(self, dbConn: sqlite3.Connection, recordingPath: str) -> None:
+        """Continues after the highest id used today.
+
+        Files on disk are checked too, so a recording that was cut off before
+        its row was written doesn't get its name reused.
+        """
+        today = datetime.date.today()
+        nextDayId = getNextDayId(dbConn)
+
+        prefix = datetime.datetime.now().strftime("%b-%d-%Y_")
+        for path in glob.glob(os.path.join(glob.escape(recordingPath), f"{prefix}*.wav")):
+            match = re.search(r"_#(\d+)\.wav$", path)
+            if match:
+                nextDayId = max(nextDayId, int(match.group(1)) + 1)
+
+        with self._lock:
+            self._day = today
+            self._next = nextDayId
+
+    def allocate(self, now: datetime.datetime) -> int:
+        with self._lock:
+            if now.date() != self._day:
+                self._day = now.date()
+                self._next = 1
+            dayId = self._next
+            self._next += 1
+            return dayId
+
+
+def insertBark(
+    dbConn: sqlite3.Connection, timestamp: datetime.datetime, confidence: float
+) -> int:
     cur = dbConn.cursor()
     tsseconds = timestamp.timestamp()
 
     cur.execute(
-        f"INSERT INTO audio_files (name, timestamp, length, day_id)\
-                VALUES({name!r}, {tsseconds}, {length}, {nextDayId})\
-            "
+        "INSERT INTO barks (timestamp, confidence) VALUES(?, ?)",
+        (tsseconds, confidence),
     )
 
     dbConn.commit()
+    return cur.lastrowid
 
 
-def insertBark(
-    dbConn: sqlite3.Connection, timestamp: datetime.datetime, confidence: float
-):
+def setBarkPositions(dbConn: sqlite3.Connection, name: str, rows) -> None:
+    """Stores (bark id, file_offset, window_length) rows of recording `name`."""
+    with dbConn:
+        dbConn.executemany(
+            "UPDATE barks SET file = ?, file_offset = ?, window_length = ?\
+                WHERE id = ?",
+            [(name, offset, length, barkId) for barkId, offset, length in rows],
+        )
+
+
+def getBark(dbConn: sqlite3.Connection, barkId: int):
     cur = dbConn.cursor()
-    tsseconds = timestamp.timestamp()
+    return cur.execute(
+        "SELECT id, timestamp, confidence, file, file_offset, window_length\
+            FROM barks WHERE id = ?",
+        (barkId,),
+    ).fetchone()
+
+
+def getBarkPositionsBetween(dbConn: sqlite3.Connection, start: float, end: float):
+    """Barks located in a recording, ordered by file and offset."""
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT id, timestamp, confidence, file, file_offset, window_length\
+            FROM barks WHERE timestamp >= ? AND timestamp < ? AND file IS NOT NULL\
+            ORDER BY file, file_offset",
+        (start, end),
+    ).fetchall()
 
+
+def snapshot(dbConn: sqlite3.Connection, path: str) -> sqlite3.Connection:
+    """Copies the database to `path` with the SQLite online backup API.
+
+    The copy is a consistent view even while the detector keeps writing.
+    """
+    snapshotConn = sqlite3.connect(path)
+    dbConn.backup(snapshotConn)
+    return snapshotConn
+
+
+def getRecordingsSince(dbConn: sqlite3.Connection, since: float):
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT name, timestamp, length, day_id FROM audio_files\
+            WHERE timestamp > ? ORDER BY timestamp",
+        (since,),
+    ).fetchall()
+
+
+def getExportWatermark(dbConn: sqlite3.Connection) -> tuple[int, int]:
+    """The highest audio_files and barks ids, rows are exported up to these."""
+    cur = dbConn.cursor()
+    recordingId = cur.execute("SELECT max(id) FROM audio_files").fetchone()[0]
+    barkId = cur.execute("SELECT max(id) FROM barks").fetchone()[0]
+    return (recordingId or 0, barkId or 0)
+
+
+def getRecordingsAfterIdUpTo(dbConn: sqlite3.Connection, afterId: int, upToId: int):
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT name, timestamp, length, day_id FROM audio_files\
+            WHERE id > ? AND id <= ? ORDER BY id",
+        (afterId, upToId),
+    ).fetchall()
+
+
+def getBarksAfterIdUpTo(dbConn: sqlite3.Connection, afterId: int, upToId: int):
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT timestamp, confidence, file, file_offset, window_length FROM barks\
+            WHERE id > ? AND id <= ? ORDER BY id",
+        (afterId, upToId),
+    ).fetchall()
+
+
+def getBarkPositionsOf(dbConn: sqlite3.Connection, names: list):
+    """(timestamp, confidence, file, file_offset, window_length) of the barks
+    located in recordings `names`."""
+    cur = dbConn.cursor()
+    rows = []
+    for name in names:
+        rows += cur.execute(
+            "SELECT timestamp, confidence, file, file_offset, window_length\
+                FROM barks WHERE file = ?",
+            (name,),
+        ).fetchall()
+    return rows
+
+
+def getRecordingFeaturesOf(dbConn: sqlite3.Connection, names: list):
+    cur = dbConn.cursor()
+    rows = []
+    for name in names:
+        rows += cur.execute(
+            "SELECT name, features FROM recording_features WHERE name = ?", (name,)
+        ).fetchall()
+    return rows
+
+
+def getBarkAggregates(dbConn: sqlite3.Connection):
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT minute, count, max_confidence, sum_confidence FROM bark_aggregates\
+            ORDER BY minute"
+    ).fetchall()
+
+
+def bulkInsertRecordings(dbConn: sqlite3.Connection, rows) -> int:
+    """Inserts (name, timestamp, length, day_id) rows, skipping known names."""
+    cur = dbConn.cursor()
+    before = dbConn.total_changes
+    cur.executemany(
+        "INSERT INTO audio_files (name, timestamp, length, day_id)\
+            SELECT ?1, ?2, ?3, ?4 WHERE NOT EXISTS\
+            (SELECT 1 FROM audio_files WHERE name = ?1)",
+        rows,
+    )
+    dbConn.commit()
+    return dbConn.total_changes - before
+
+
+def bulkInsertBarks(dbConn: sqlite3.Connection, rows) -> int:
+    """Inserts (timestamp, confidence[, file, file_offset, window_length]) rows,
+    skipping barks already known by timestamp and confidence."""
+    cur = dbConn.cursor()
+    before = dbConn.total_changes
+    cur.executemany(
+        "INSERT INTO barks (timestamp, confidence, file, file_offset, window_length)\
+            SELECT ?1, ?2, ?3, ?4, ?5 WHERE NOT EXISTS\
+            (SELECT 1 FROM barks WHERE timestamp = ?1 AND confidence = ?2)",
+        # archives written before barks were located have two columns
+        [tuple(row) + (None,) * (5 - len(row)) for row in rows],
+    )
+    dbConn.commit()
+    return dbConn.total_changes - before
+
+
+def bulkSetBarkPositions(dbConn: sqlite3.Connection, rows) -> None:
+    """Locates known barks from (timestamp, confidence, file, file_offset,
+    window_length) rows."""
+    with dbConn:
+        dbConn.executemany(
+            "UPDATE barks SET file = ?3, file_offset = ?4, window_length = ?5\
+                WHERE timestamp = ?1 AND confidence = ?2 AND file IS NULL",
+            rows,
+        )
+
+
+def bulkInsertRecordingFeatures(dbConn: sqlite3.Connection, rows) -> None:
+    with dbConn:
+        dbConn.executemany(
+            "INSERT OR IGNORE INTO recording_features (name, features) VALUES(?, ?)",
+            rows,
+        )
+
+
+def mergeBarkAggregates(dbConn: sqlite3.Connection, rows) -> None:
+    """Merges (minute, count, max_confidence, sum_confidence) rows.
+
+    The larger value wins, so importing the same archive twice, or minutes
+    this instance compacted from the same imported barks, don't count twice.
+    """
+    with dbConn:
+        dbConn.executemany(
+            "INSERT INTO bark_aggregates (minute, count, max_confidence, sum_confidence)\
+                VALUES(?, ?, ?, ?)\
+                ON CONFLICT(minute) DO UPDATE SET\
+                    count = max(count, excluded.count),\
+                    max_confidence = max(max_confidence, excluded.max_confidence),\
+                    sum_confidence = max(sum_confidence, excluded.sum_confidence)",
+            rows,
+        )
+
+
+def getRecordingsBetween(dbConn: sqlite3.Connection, start: float, end: float):
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT name, timestamp, length, day_id FROM audio_files\
+            WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+        (start, end),
+    ).fetchall()
+
+
+def getRecordingByName(dbConn: sqlite3.Connection, name: str):
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT name, timestamp, length, day_id FROM audio_files WHERE name = ?",
+        (name,),
+    ).fetchone()
+
+
+def getRecordingsBefore(dbConn: sqlite3.Connection, before: float):
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT name, timestamp, length, day_id FROM audio_files\
+            WHERE timestamp < ? ORDER BY timestamp",
+        (before,),
+    ).fetchall()
+
+
+def deleteRecording(dbConn: sqlite3.Connection, name: str):
+    cur = dbConn.cursor()
+    cur.execute("DELETE FROM audio_files WHERE name = ?", (name,))
+    cur.execute("DELETE FROM recording_features WHERE name = ?", (name,))
     cur.execute(
-        f"INSERT INTO barks (timestamp, confidence) VALUES({tsseconds}, {confidence})"
+        "UPDATE barks SET file = NULL, file_offset = NULL, window_length = NULL\
+            WHERE file = ?",
+        (name,),
     )
+    dbConn.commit()
+
+
+def insertRecordingFeatures(dbConn: sqlite3.Connection, name: str, features: dict):
+    with dbConn:
+        dbConn.execute(
+            "INSERT OR REPLACE INTO recording_features (name, features) VALUES(?, ?)",
+            (name, json.dumps(features)),
+        )
+
+
+def getRecordingFeatures(dbConn: sqlite3.Connection, name: str) -> dict | None:
+    cur = dbConn.cursor()
+    row = cur.execute(
+        "SELECT features FROM recording_features WHERE name = ?", (name,)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
 
+
+def compactBarks(dbConn: sqlite3.Connection, before: float, limit: int) -> int:
+    """Folds up to `limit` of the oldest barks before `before` into bark_aggregates.
+
+    Returns the number of bark rows removed.
+    """
+    cur = dbConn.cursor()
+    cur.execute(
+        "SELECT max(timestamp) FROM (SELECT timestamp FROM barks\
+            WHERE timestamp < ? ORDER BY timestamp LIMIT ?)",
+        (before, limit),
+    )
+    upTo = cur.fetchone()[0]
+    if upTo is None:
+        return 0
+
+    cur.execute(
+        "INSERT INTO bark_aggregates (minute, count, max_confidence, sum_confidence)\
+            SELECT CAST(timestamp / 60 AS INT) * 60 AS m, count(*),\
+                max(confidence), sum(confidence)\
+            FROM barks WHERE timestamp <= ? GROUP BY m\
+            ON CONFLICT(minute) DO UPDATE SET\
+                count = count + excluded.count,\
+                max_confidence = max(max_confidence, excluded.max_confidence),\
+                sum_confidence = sum_confidence + excluded.sum_confidence",
+        (upTo,),
+    )
+    cur.execute("DELETE FROM barks WHERE timestamp <= ?", (upTo,))
+    removed = cur.rowcount
     dbConn.commit()
+    return removed
+
+
+def getBarksAfterId(dbConn: sqlite3.Connection, lastId: int, limit: int):
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT id, timestamp, confidence FROM barks WHERE id > ?\
+            ORDER BY id LIMIT ?",
+        (lastId, limit),
+    ).fetchall()
+
+
+def getRecordingsAfterId(dbConn: sqlite3.Connection, lastId: int, limit: int):
+    cur = dbConn.cursor()
+    return cur.execute(
+        "SELECT id, name, timestamp, length, day_id FROM audio_files WHERE id > ?\
+            ORDER BY id LIMIT ?",
+        (lastId, limit),
+    ).fetchall()
@@ -3,28 +3,51 @@
 import datetime
 import time
 import queue
+import numpy as np
 
 import os
 import threading
 import sqlite3
 import db
 
-from numpy import float32
 import audio_record
 
+from audio_source import createSource, defaultBlockSize
 from pathlib import Path
 from soundfile import SoundFile
+from scoring import ScoreHistory, Smoothing, CombineRule
+from thumbnails import ThumbnailCache, ThumbnailWorker
+from retention import RetentionManager
+from overload import LoadMonitor
+from bufferpool import Pcm16BatchWriter
+from scheduler import ProfileScheduler
+from calibration import ScoreCalibrator
+from uplink import Uplink
+from timeline import TimelineWriter
+from recovery import recoverRecordings, removeMarker, writeMarker
+from supervisor import Beat, beat
+from profiler import ProfileSession, tracer
+from features import EpisodeFeatures, SpectralFeatures
 from mediapipe.tasks import python
 from mediapipe.tasks.python.components import containers
 from mediapipe.tasks.python import audio
 from utils import (
     getScoreByNames,
+    scoreDictToList,
     scoreNames,
     checkSettingsFile,
     readSettings,
     Settings,
     maxTimestamp,
     updateSetting,
+    defaultSettings,
+    getThumbnailPath,
+    fixedSettings,
+    calibrationPath,
+    checkSetting,
+    checkSettingOrder,
+    scoreHistorySize,
+    settingOrder,
 )
 from message import (
     MsgAttr,
@@ -37,9 +60,9 @@ from message import (
 )
 
 
-def runDetector(model: str, msgHandler: MsgHandler) -> None:
+def runDetector(model: str, msgHandler: MsgHandler, heartbeat=None) -> None:
     checkSettingsFile()
-    detector = Detector(model, msgHandler)
+    detector = Detector(model, msgHandler, heartbeat)
     detector.run()
 
 
@@ -59,33 +82,89 @@ class Detector:
     barking_stopped_at_q: queue.Queue
     is_writing: bool
     bufferSum: int
+    scoreHistory: ScoreHistory
+    thumbnailWorker: ThumbnailWorker
+    retention: RetentionManager
+    loadMonitor: LoadMonitor
+    uplink: Uplink
+    inference_started: dict
+    recording_dropped_samples: int
+    window: np.ndarray
+    modelPath: str
+    defaultModel: str
+    profileLock: threading.Lock
+    scheduler: ProfileScheduler
+    dayIds: db.DayIdAllocator
+    calibrator: ScoreCalibrator
+    heartbeat: object
+    profile: ProfileSession
+    features: SpectralFeatures
+    latest_features: dict
+    episodeFeatures: EpisodeFeatures
+    episodeBarks: list
+    baseSettings: {}
     settings: {}
 
-    def __init__(self, model: str, msgHandler: MsgHandler):
+    def __init__(self, model: str, msgHandler: MsgHandler, heartbeat=None):
         self.settings = {}
         self.loadSettings()
+        # settings from the file, self.settings additionally holds the
+        # overrides of the active profile
+        self.baseSettings = dict(self.settings)
         self.msgHandler = msgHandler
+        # shared with the supervisor in the server process, if any
+        self.heartbeat = heartbeat
+        self.profile = None
         self.recording_q = queue.Queue()
         self.barking_stopped_at_q = queue.Queue()
         self.is_recording = False
         self.is_writing = False
         self.bufferSum = 0
+        self.loadMonitor = LoadMonitor()
+        self.inference_started = {}
+        self.recording_dropped_samples = 0
+        self.thumbnailWorker = ThumbnailWorker(
+            ThumbnailCache(
+                getThumbnailPath(self.settings[Settings.RECORDING_FILE_PATH]),
+                self.settings[Settings.THUMBNAIL_CACHE_SIZE],
+            )
+        )
 
         # create tables in db if not already
         db_conn = sqlite3.connect(db.dbname)
         db.createTables(db_conn)
+        # a previous run that died mid-recording left its file unfinished
+        for name, path in recoverRecordings(
+            self.settings[Settings.RECORDING_FILE_PATH], db_conn
+        ):
+            self.thumbnailWorker.submit(name, path)
+        self.dayIds = db.DayIdAllocator()
+        self.dayIds.seed(db_conn, self.settings[Settings.RECORDING_FILE_PATH])
         db_conn.close()
 
+        # retention steps wait while a recording is being written
+        self.retention = RetentionManager(
+            self.settings, lambda: self.is_writing, self.thumbnailWorker.refresh
+        )
+        # idles until uplink_url is set, so it can be turned on at runtime
+        self.uplink = Uplink(self.settings)
+        self.timeline = None
+        if self.settings[Settings.TIMELINE_PATH]:
+            self.timeline = TimelineWriter(
+                self.settings[Settings.TIMELINE_PATH], scoreNames
+            )
+
         # Initialize the audio classification model.
-        base_options = python.BaseOptions(model_asset_path=model)
-        options = audio.AudioClassifierOptions(
-            base_options=base_options,
-            running_mode=audio.RunningMode.AUDIO_STREAM,
-            max_results=4,
-            score_threshold=0.0,
-            result_callback=self.save_result,
+        self.defaultModel = model
+        self.modelPath = self.settings[Settings.MODEL_PATH] or model
+        self.classifier = self.createClassifier(self.modelPath)
+        self.profileLock = threading.Lock()
+        self.scheduler = ProfileScheduler(
+            lambda: self.baseSettings[Settings.SCHEDULE],
+            self.prepareProfile,
+            self.applyProfile,
+            self.discardProfile,
         )
-        self.classifier = audio.AudioClassifier.create_from_options(options)
 
         # Initialize the audio recorder and a tensor to store the audio input.
         # The sample rate may need to be changed to match your input device.
@@ -98,41 +177,264 @@ class Detector:
             self.settings[Settings.SAMPLE_RATE],
             self.settings[Settings.REC_BUFFER_SIZE],
             self.settings[Settings.REC_DEVICE_ID],
+            self.maxQueuedSamples(),
+            source=createSource(
+                self.settings[Settings.AUDIO_SOURCE],
+                self.settings[Settings.NUM_CHANNELS],
+                self.settings[Settings.SAMPLE_RATE],
+                defaultBlockSize,
+                self.settings[Settings.REC_DEVICE_ID],
+                self.settings[Settings.REC_DEVICE_NAME],
+            ),
         )
 
         self.audio_data = containers.AudioData(
             self.settings[Settings.REC_BUFFER_SIZE], self.audio_format
         )
+        # reused by every inference, the recorder fills it in place
+        self.window = np.zeros(
+            [
+                self.settings[Settings.REC_BUFFER_SIZE],
+                self.settings[Settings.NUM_CHANNELS],
+            ],
+            dtype=np.float32,
+        )
+        # level, centroid and band energies of every window, cheap enough to
+        # run even when inference is off or shed
+        self.features = SpectralFeatures(
+            self.settings[Settings.REC_BUFFER_SIZE],
+            self.settings[Settings.SAMPLE_RATE],
+            self.settings[Settings.FEATURE_BANDS],
+        )
+        self.latest_features = None
+        self.episodeFeatures = EpisodeFeatures()
+        # the current episode's barks, {"window": (start sample, length),
+        # "thread": its insert thread, "id": set by the thread}
+        self.episodeBarks = []
 
         # We'll try to run inference every interval_between_inference seconds.
-        # This is usually half of the model's input length to create an overlapping
-        # between incoming audio segments to improve classification accuracy.
-        input_length_in_second = (
-            float(len(self.audio_data.buffer))
-            / self.audio_data.audio_format.sample_rate
+        # By default this is half of the model's input length to create an
+        # overlapping between incoming audio segments to improve classification
+        # accuracy.
+        self.scoreHistory = ScoreHistory(len(scoreNames), scoreHistorySize)
+        self.calibrator = ScoreCalibrator(scoreNames)
+        self.calibrator.load(calibrationPath)
+        self.updateDerivedSettings()
+
+        self.runLoop = True
+
+    def createClassifier(self, model: str) -> audio.AudioClassifier:
+        base_options = python.BaseOptions(model_asset_path=model)
+        options = audio.AudioClassifierOptions(
+            base_options=base_options,
+            running_mode=audio.RunningMode.AUDIO_STREAM,
+            max_results=4,
+            score_threshold=0.0,
+            result_callback=self.save_result,
         )
-        self.interval_between_inference = input_length_in_second * (0.5)
+        return audio.AudioClassifier.create_from_options(options)
+
+    def profileSettings(self, name: str | None) -> dict:
+        """Returns the base settings with the overrides of profile `name`."""
+        settings = self.mergeProfile(name, self.baseSettings)
+        error = checkSettingOrder(settings)
+        if error:
+            print(f"settings profile {name}: {error}, using the base settings")
+            return dict(self.baseSettings)
+        return settings
+
+    def mergeProfile(self, name: str | None, base: dict) -> dict:
+        """Returns `base` with the overrides of profile `name`, unchecked."""
+        settings = dict(base)
+        if name is None:
+            return settings
+
+        overrides = base[Settings.PROFILES].get(name)
+        if overrides is None:
+            print(f"settings profile {name} not found, using defaults")
+            return settings
+
+        for key, value in overrides.items():
+            try:
+                setting = Settings(key)
+            except ValueError:
+                print(f"unknown setting {key} in profile {name}")
+                continue
+            if setting in fixedSettings:
+                print(f"{key} can't be changed by a profile, ignoring")
+                continue
+            settings[setting] = value
+        return settings
+
+    def prepareProfile(self, name: str | None) -> dict:
+        """Builds the classifier profile `name` needs before it becomes active.
+
+        Only the expensive part is prepared, the settings are taken when the
+        profile is applied so values changed in between are not overwritten.
+        """
+        settings = self.profileSettings(name)
+        prepared = {}
+        model = settings[Settings.MODEL_PATH] or self.defaultModel
+        if model != self.modelPath:
+            prepared["model"] = model
+            prepared["classifier"] = self.createClassifier(model)
+        return prepared
+
+    def discardProfile(self, prepared: dict):
+        """Releases a prepared profile that will not be applied."""
+        if "classifier" in prepared:
+            prepared["classifier"].close()
+
+    def applyProfile(self, name: str | None, prepared: dict):
+        settings = self.profileSettings(name)
+        model = settings[Settings.MODEL_PATH] or self.defaultModel
+        classifier = None
+        if model != self.modelPath:
+            if prepared.get("model") == model:
+                classifier = prepared.pop("classifier")
+            else:
+                # the profile changed since it was prepared
+                classifier = self.createClassifier(model)
+        self.discardProfile(prepared)
+
+        oldClassifier = None
+        with self.profileLock:
+            if classifier is not None:
+                oldClassifier = self.classifier
+                self.classifier = classifier
+                self.modelPath = model
+            # update in place, other components hold a reference to this dict
+            self.settings.update(settings)
+            self.updateDerivedSettings()
+        if oldClassifier is not None:
+            oldClassifier.close()
+
+    def currentThreshold(self, hour: int) -> float:
+        """Returns the calibrated threshold for `hour` if enabled and ready."""
+        if (
+            self.settings[Settings.AUTO_THRESHOLD]
+            and self.calibrator.samples(hour)
+            >= self.settings[Settings.AUTO_THRESHOLD_MIN_SAMPLES]
+        ):
+            suggested = self.calibrator.suggest(
+                hour, self.settings[Settings.AUTO_THRESHOLD_RATE]
+            )
+            if suggested is not None:
+                return min(
+                    max(suggested, self.settings[Settings.AUTO_THRESHOLD_MIN]),
+                    self.settings[Settings.AUTO_THRESHOLD_MAX],
+                )
+        return self.settings[Settings.BARK_THRESHOLD]
 
+    def updateDerivedSettings(self):
+        self.updateInferenceInterval()
+        bands = self.settings[Settings.FEATURE_BANDS]
+        if getattr(self, "features", None) is not None and self.features.bands != bands:
+            self.features.setBands(bands)
         self.listening_q_size = (
             self.settings[Settings.SAMPLE_RATE]
             * self.settings[Settings.PRE_BUFFER_TIME]
         )
 
-        self.runLoop = True
-
     def save_result(self, result: audio.AudioClassifierResult, timestamp_ms: int):
         result.timestamp_ms = timestamp_ms
         self.classification_result_list.append(result)
 
+        window = self.inference_started.pop(timestamp_ms, None)
+        if window is not None:
+            # the window's position, results arrive after the next read
+            (started, result.sample_count, result.captured_at) = window
+            # from classify_async to the result, on MediaPipe's thread
+            tracer.complete("inference", int(started * 1e9), time.perf_counter_ns())
+            self.loadMonitor.record(
+                time.perf_counter() - started, self.currentInterval()
+            )
+
+    def currentInterval(self):
+        return self.interval_between_inference * self.loadMonitor.hopMultiplier()
+
+    def maxQueuedSamples(self):
+        return int(
+            self.settings[Settings.SAMPLE_RATE] * self.settings[Settings.MAX_QUEUE_TIME]
+        )
+
+    def getStatus(self):
+        status = self.loadMonitor.status()
+        sampleRate = self.settings[Settings.SAMPLE_RATE]
+        status.update(
+            {
+                "inference_interval": round(self.currentInterval(), 4),
+                "capture_queue_seconds": self.record.queued_samples / sampleRate,
+                "capture_dropped_samples": self.record.dropped_samples,
+                "recording_queue_seconds": self.bufferSum / sampleRate,
+                "recording_dropped_samples": self.recording_dropped_samples,
+                "bytes_copied": self.record.bytes_copied,
+                "buffer_pool": self.record.pool_stats(),
+                "is_recording": self.is_recording,
+                "uplink": self.uplink.status(),
+                "profile": self.scheduler.current,
+                "bark_threshold": self.currentThreshold(datetime.datetime.now().hour),
+                "model": self.modelPath,
+                "features_cost": self.features.cost(),
+                "sample_clock": self.record.clock_status(),
+            }
+        )
+        return status
+
+    def handleProfile(self, data) -> Message:
+        """Starts a profiling session, or reports the current one.
+
+        {"seconds": s, "interval": i} starts a session, anything else returns
+        the state of the latest session and its result once it's done.
+        """
+        resp = Message().setMsgType(MsgType.RESPONSE).setRespType(MsgRespType.STATUS)
+        if isinstance(data, dict) and data.get("seconds"):
+            if self.profile is not None and self.profile.running:
+                return resp.setStatus(MsgStatus.ERROR).setData(
+                    "a profile is already running"
+                )
+            self.profile = ProfileSession(
+                float(data["seconds"]), float(data.get("interval") or 0.01)
+            )
+            self.profile.start()
+            return resp.setStatus(MsgStatus.SUCCESS).setData(self.profile.status())
+
+        if self.profile is None:
+            return resp.setStatus(MsgStatus.ERROR).setData("no profile was taken")
+        status = self.profile.status()
+        if self.profile.result is not None:
+            status["result"] = self.profile.result
+        return resp.setStatus(MsgStatus.SUCCESS).setData(status)
+
+    def updateInferenceInterval(self):
+        input_length_in_second = (
+            float(len(self.audio_data.buffer))
+            / self.audio_data.audio_format.sample_rate
+        )
+        overlap = min(max(float(self.settings[Settings.INFERENCE_OVERLAP]), 0.0), 0.95)
+        self.interval_between_inference = input_length_in_second * (1.0 - overlap)
+
     def loadSettings(self):
         loadedSettings = readSettings()
 
         if loadedSettings:
             for attr in Settings:
-                # if attr.value not in loadedSettings:
-                #     return  # settings file not valid
-
-                self.settings[attr] = loadedSettings[attr.value]
+                # settings added after the file was written fall back to defaults
+                self.settings[attr] = loadedSettings.get(
+                    attr.value, defaultSettings[attr.value]
+                )
+                error = checkSetting(attr, self.settings[attr])
+                if error:
+                    # edited by hand or saved by an older version
+                    print(f"{error}, using the default")
+                    self.settings[attr] = defaultSettings[attr.value]
+            for lower, upper in settingOrder:
+                if self.settings[lower] > self.settings[upper]:
+                    print(
+                        f"{lower.value} is larger than {upper.value}, using the defaults"
+                    )
+                    self.settings[lower] = defaultSettings[lower.value]
+                    self.settings[upper] = defaultSettings[upper.value]
 
         if (
             self.settings[Settings.RECORDING_FILE_PATH] != ""
@@ -161,8 +463,12 @@ class Detector:
 
         # Start audio recording in the background.
         self.record.start_recording()
+        self.retention.start()
+        self.uplink.start()
+        self.scheduler.start()
 
         detectListenThread = threading.Thread(
+            name="detectorListen",
             target=self.detectorListen,
             args=(
                 filteredListLock,
@@ -174,6 +480,7 @@ class Detector:
         detectListenThread.start()
 
         recordListenThread = threading.Thread(
+            name="recordingListen",
             target=self.recordingListen,
             args=(
                 recordingQLock,
@@ -190,13 +497,15 @@ class Detector:
                 if cmdMsg.checkCmd(MsgCmd.GET_RESULT):
                     filteredListLock.acquire()
                     if self.filtered_list:
+                        data = self.filtered_list.copy()
+                        data["features"] = self.latest_features
                         resp = (
                             Message()
                             .setMsgType(MsgType.RESPONSE)
                             .setRespType(MsgRespType.CLASS_DATA)
-                            .setData(self.filtered_list.copy())
+                            .setData(data)
                         )
-                        self.msgHandler.send(resp)
+                        self.msgHandler.reply(cmdMsg, resp)
                     else:
                         resp = (
                             Message()
@@ -204,25 +513,47 @@ class Detector:
                             .setRespType(MsgRespType.STATUS)
                             .setStatus(MsgStatus.ERROR)
                         )
-                        self.msgHandler.send(resp)
+                        self.msgHandler.reply(cmdMsg, resp)
                     filteredListLock.release()
                 elif cmdMsg.checkCmd(MsgCmd.UPDATE_SETTING):
                     data = cmdMsg.getData()
-                    if data is str:
+                    error = None
+                    if not isinstance(data, dict):
+                        error = "Setting request format invalid"
+                    else:
+                        # nothing is saved unless every value is valid
+                        candidate = dict(self.baseSettings)
+                        for key, value in data.items():
+                            for setting in Settings:
+                                if key == setting.value:
+                                    error = error or checkSetting(setting, value)
+                                    candidate[setting] = value
+                        # settings that bound each other, also under every profile
+                        error = error or checkSettingOrder(candidate)
+                        for name in candidate[Settings.PROFILES] if not error else ():
+                            profileError = checkSettingOrder(
+                                self.mergeProfile(name, candidate)
+                            )
+                            if profileError:
+                                error = f"profile {name}: {profileError}"
+                                break
+                    if error:
                         resp = (
                             Message()
                             .setMsgType(MsgType.RESPONSE)
                             .setRespType(MsgRespType.STATUS)
                             .setStatus(MsgStatus.ERROR)
-                            .setData("Setting request format invalid")
+                            .setData(error)
                         )
-                        self.msgHandler.send(resp)
+                        self.msgHandler.reply(cmdMsg, resp)
                         continue
                     for key, value in data.items():
                         for setting in Settings:
                             if key == setting.value:
-                                self.settings[setting] = value
+                                self.baseSettings[setting] = value
                                 updateSetting(setting, value)
+                    # the active profile's overrides still win
+                    self.applyProfile(self.scheduler.current, {})
                     resp = (
                         Message()
                         .setMsgType(MsgType.RESPONSE)
@@ -230,7 +561,7 @@ class Detector:
                         .setStatus(MsgStatus.SUCCESS)
                         .setData(self.settings)
                     )
-                    self.msgHandler.send(resp)
+                    self.msgHandler.reply(cmdMsg, resp)
                 elif cmdMsg.checkCmd(MsgCmd.GET_SETTINGS):
                     resp = (
                         Message()
@@ -239,19 +570,52 @@ class Detector:
                         .setStatus(MsgStatus.SUCCESS)
                         .setData(self.settings)
                     )
-                    self.msgHandler.send(resp)
+                    self.msgHandler.reply(cmdMsg, resp)
+                elif cmdMsg.checkCmd(MsgCmd.GET_STATUS):
+                    resp = (
+                        Message()
+                        .setMsgType(MsgType.RESPONSE)
+                        .setRespType(MsgRespType.STATUS)
+                        .setStatus(MsgStatus.SUCCESS)
+                        .setData(self.getStatus())
+                    )
+                    self.msgHandler.reply(cmdMsg, resp)
+                elif cmdMsg.checkCmd(MsgCmd.GET_CALIBRATION):
+                    data = cmdMsg.getData()
+                    rate = self.settings[Settings.AUTO_THRESHOLD_RATE]
+                    if isinstance(data, dict) and data.get("rate"):
+                        rate = float(data["rate"])
+                    resp = (
+                        Message()
+                        .setMsgType(MsgType.RESPONSE)
+                        .setRespType(MsgRespType.STATUS)
+                        .setStatus(MsgStatus.SUCCESS)
+                        .setData({"rate": rate, "hours": self.calibrator.report(rate)})
+                    )
+                    self.msgHandler.reply(cmdMsg, resp)
+                elif cmdMsg.checkCmd(MsgCmd.PROFILE):
+                    self.msgHandler.reply(cmdMsg, self.handleProfile(cmdMsg.getData()))
                 elif cmdMsg.checkCmd(MsgCmd.QUIT):
                     self.runLoop = False
+                    if self.heartbeat is not None:
+                        # a requested exit, not a stall
+                        self.heartbeat[Beat.QUITTING] = 1
                     resp = (
                         Message()
                         .setMsgType(MsgType.RESPONSE)
                         .setRespType(MsgRespType.STATUS)
                         .setStatus(MsgStatus.SUCCESS)
                     )
-                    self.msgHandler.send(resp)
+                    self.msgHandler.reply(cmdMsg, resp)
 
+        self.retention.stop()
+        self.uplink.stop()
+        self.scheduler.stop()
         detectListenThread.join()
         recordListenThread.join()
+        self.calibrator.save(calibrationPath)
+        if self.timeline is not None:
+            self.timeline.close()
         print("detector ended")
 
     def detectorListen(
@@ -260,13 +624,12 @@ class Detector:
         recordingQLock: threading.Lock,
         recordingBarrier: threading.Barrier,
     ):
-        pause_time = self.interval_between_inference * 0.1
         last_inference_time = time.time()
+        last_sample_count = 0
         last_heard_time = 0.0
-        fileWriteThread: threading.Thread
-        barking_started_at: int
-        barking_stopped_at: int
-        fake_timestamp = time.time()
+        fileWriteThread = None
+        barking_started_at = 0.0
+        last_hour = datetime.datetime.now().hour
 
         # wait for recording thread to flush the recorder
         recordingBarrier.wait()
@@ -274,80 +637,201 @@ class Detector:
 
         # Loop until the user close the classification results plot.
         while self.runLoop:
+            if self.heartbeat is not None:
+                beat(self.heartbeat, time.monotonic(), self.record.last_callback)
+
             # Wait until at least interval_between_inference seconds has passed since
-            # the last inference.
+            # the last inference. The interval widens when we fall behind.
+            interval = self.currentInterval()
             now = time.time()
             diff = now - last_inference_time
-            if diff < self.interval_between_inference:
-                time.sleep(pause_time)
+            if diff < interval:
+                time.sleep(interval * 0.1)
                 continue
             last_inference_time = now
+            cycleStart = time.perf_counter_ns()
 
             # Load the input audio from the AudioRecord instance and run classify.
-            (data, timestamp) = self.record.read_rolled_buffer(
-                self.settings[Settings.REC_BUFFER_SIZE]
-            )
-            self.audio_data.load_from_array(data.astype(float32))
-            # self.audio_data.load_from_array(data)
-            fake_timestamp += data.shape[0] / self.settings[Settings.SAMPLE_RATE]
-            self.classifier.classify_async(
-                self.audio_data, round(fake_timestamp * 1000)
+            with tracer.span("read_window"):
+                (data, timestamp, sample_count) = self.record.read_rolled_buffer(
+                    self.settings[Settings.REC_BUFFER_SIZE], self.window
+                )
+
+            # the silence gate only looks at the audio that arrived since the
+            # last window
+            new_samples = sample_count - last_sample_count
+            if new_samples <= 0:
+                continue
+            if new_samples > data.shape[0]:
+                # we fell behind by more than a window
+                self.loadMonitor.skipped_samples += new_samples - data.shape[0]
+                new_samples = data.shape[0]
+            last_sample_count = sample_count
+            with tracer.span("features"):
+                self.latest_features = self.features.compute(data)
+            if self.is_recording:
+                self.episodeFeatures.add(self.latest_features)
+
+            # capture-only profiles keep recording without spending any CPU
+            # on the model, windows louder than capture_level_dbfs start or
+            # extend a recording in place of detections
+            if not self.settings[Settings.INFERENCE_ENABLED]:
+                if (
+                    self.latest_features["rms_dbfs"]
+                    >= self.settings[Settings.CAPTURE_LEVEL_DBFS]
+                ):
+                    last_heard_time = timestamp.timestamp()
+                    if not self.is_recording:
+                        barking_started_at = last_heard_time
+                        fileWriteThread = self.startEpisode(
+                            recordingQLock, fileWriteThread
+                        )
+                self.checkEpisodeEnd(last_heard_time, barking_started_at, timestamp)
+                continue
+
+            # under load, skip inference on quiet or alternate windows. The
+            # recording path is untouched, only classification work is shed.
+            with tracer.span("gate"):
+                rms = np.sqrt(np.mean(np.square(data[-new_samples:])))
+                rmsDbfs = 20 * np.log10(max(rms, 1e-10))
+            if self.loadMonitor.shouldGate(
+                rmsDbfs, self.settings[Settings.SILENCE_GATE_DBFS]
+            ) or self.loadMonitor.shouldDrop():
+                continue
+
+            started = time.perf_counter()
+            # already float32, no conversion copy needed
+            self.audio_data.load_from_array(data)
+            # on the capture's sample clock, strictly increasing with the audio
+            timestamp_ms = round(
+                sample_count * 1000 / self.settings[Settings.SAMPLE_RATE]
             )
+            if len(self.inference_started) > 100:
+                # results that never came back, don't let them pile up
+                self.inference_started.clear()
+            self.inference_started[timestamp_ms] = (started, sample_count, timestamp)
+            with self.profileLock, tracer.span("classify_async"):
+                self.classifier.classify_async(self.audio_data, timestamp_ms)
 
             # filter the classification result
+            decideStart = time.perf_counter_ns()
             if self.classification_result_list:
                 filteredListLock.acquire()
                 self.filtered_list.clear()
                 self.filtered_list = getScoreByNames(self.classification_result_list[0])
                 filteredListLock.release()
+                result = self.classification_result_list[0]
                 self.classification_result_list.clear()
 
-                if (
-                    self.filtered_list[scoreNames[0]]
-                    >= self.settings[Settings.BARK_THRESHOLD]
-                ):
+                self.scoreHistory.push(
+                    scoreDictToList(self.filtered_list),
+                    self.settings[Settings.EMA_ALPHA],
+                )
+                hour = timestamp.hour
+                (detected, confidence) = self.scoreHistory.detect(
+                    self.currentThreshold(hour),
+                    CombineRule(self.settings[Settings.COMBINE_RULE]),
+                    Smoothing(self.settings[Settings.SMOOTHING_METHOD]),
+                    self.settings[Settings.SMOOTHING_WINDOW],
+                    self.settings[Settings.VOTE_K],
+                )
+                if self.timeline is not None and hasattr(result, "sample_count"):
+                    sampleRate = self.settings[Settings.SAMPLE_RATE]
+                    self.timeline.append(
+                        result.sample_count,
+                        result.captured_at.timestamp(),
+                        round(self.interval_between_inference * sampleRate),
+                        sampleRate,
+                        self.scoreHistory.latest(),
+                    )
+                # learn the distribution of the exact value compared above
+                self.calibrator.add(hour, self.scoreHistory.latest(), confidence)
+                if hour != last_hour:
+                    last_hour = hour
+                    self.calibrator.save(calibrationPath)
+
+                if detected:
                     print("dog detected")
+                    last_heard_time = timestamp.timestamp()
+                    if not self.is_recording:
+                        # print("start recording")
+                        barking_started_at = last_heard_time
+                        fileWriteThread = self.startEpisode(
+                            recordingQLock, fileWriteThread
+                        )
+
+                    # the result belongs to the window read before this one
+                    windowEnd = getattr(result, "sample_count", sample_count)
+                    windowLength = data.shape[0]
+                    bark = {"window": (windowEnd - windowLength, windowLength)}
                     insertBarkThread = threading.Thread(
+                        name="dbInsertBark",
                         target=self.dbInsertBark,
                         args=(
-                            timestamp,
-                            self.filtered_list[scoreNames[0]],
+                            getattr(result, "captured_at", timestamp),
+                            confidence,
+                            bark,
                         ),
                         daemon=True,
                     )
                     insertBarkThread.start()
-                    last_heard_time = timestamp.timestamp()
-
-                    if not self.is_recording:
-                        # print("start recording")
-                        self.is_recording = True
-                        barking_started_at = last_heard_time
+                    bark["thread"] = insertBarkThread
+                    # appended here, before the episode can end, so the
+                    # writer sees every bark of its episode
+                    self.episodeBarks.append(bark)
+            tracer.complete("decide", decideStart, time.perf_counter_ns())
 
-                        fileWriteThread = threading.Thread(
-                            target=self.saveRecording,
-                            args=(recordingQLock,),
-                            daemon=True,
-                        )
-                        fileWriteThread.start()
+            self.checkEpisodeEnd(last_heard_time, barking_started_at, timestamp)
 
-            # check if we have heard a bark within the timeout
-            if self.is_recording and (
-                time.time() - last_heard_time > self.settings[Settings.REC_TIMEOUT]
-            ):
-                print("barking stopped")
-                barking_stopped_at = timestamp.timestamp()
-                self.barking_stopped_at_q.put(barking_stopped_at)
-                print(
-                    "barking lasted for {} seconds".format(
-                        barking_stopped_at - barking_started_at
-                    )
-                )
-                self.is_recording = False
-                fileWriteThread.join()
+            tracer.complete("inference_cycle", cycleStart, time.perf_counter_ns())
 
             # if self.is_recording:
             #     print("time since last bark: ", time.time() - last_heard_time)
 
+    def startEpisode(
+        self, recordingQLock: threading.Lock, previousWriter: threading.Thread | None
+    ) -> threading.Thread:
+        """Starts recording a new episode and returns its file writer."""
+        if previousWriter is not None:
+            # the previous episode may still be draining
+            self.waitForWriter(previousWriter)
+        self.episodeFeatures = EpisodeFeatures()
+        self.episodeFeatures.add(self.latest_features)
+        self.episodeBarks = []
+        self.is_recording = True
+
+        writer = threading.Thread(
+            name="saveRecording",
+            target=self.saveRecording,
+            args=(recordingQLock,),
+            daemon=True,
+        )
+        writer.start()
+        return writer
+
+    def checkEpisodeEnd(
+        self, lastHeard: float, startedAt: float, timestamp: datetime.datetime
+    ):
+        """Ends the episode once nothing was heard for REC_TIMEOUT seconds."""
+        if not self.is_recording or (
+            time.time() - lastHeard <= self.settings[Settings.REC_TIMEOUT]
+        ):
+            return
+        print("barking stopped")
+        barking_stopped_at = timestamp.timestamp()
+        self.barking_stopped_at_q.put(barking_stopped_at)
+        print("barking lasted for {} seconds".format(barking_stopped_at - startedAt))
+        # the writer drains the backlog on its own, joining it here would
+        # stall the loop (and its heartbeat) for that long
+        self.is_recording = False
+
+    def waitForWriter(self, thread: threading.Thread):
+        """Joins a file writer while keeping the loop heartbeat fresh."""
+        while thread.is_alive():
+            if self.heartbeat is not None:
+                beat(self.heartbeat, time.monotonic(), self.record.last_callback)
+            thread.join(0.1)
+
     def recordingListen(
         self, recordingQLock: threading.Lock, recordingBarrier: threading.Barrier
     ):
@@ -360,22 +844,48 @@ class Detector:
         self.bufferSum = 0
         while self.runLoop:
             data = self.record.read_queue()
+            spanStart = time.perf_counter_ns()
 
+            # the block's reference moves on to recording_q, no copy
             self.recording_q.put(data)
-            self.bufferSum += data[0].shape[0]
+            self.bufferSum += data[0].frames
 
             if not self.is_recording and not self.is_writing:
                 recordingQLock.acquire()
                 while self.bufferSum > self.listening_q_size:
                     tmp = self.recording_q.get()[0]
-                    self.bufferSum -= tmp.shape[0]
+                    self.bufferSum -= tmp.frames
+                    tmp.release()
+                recordingQLock.release()
+            elif self.bufferSum > self.maxQueuedSamples():
+                # the file writer can't keep up, bound memory and count the loss
+                recordingQLock.acquire()
+                while self.bufferSum > self.maxQueuedSamples():
+                    tmp = self.recording_q.get()[0]
+                    self.bufferSum -= tmp.frames
+                    self.recording_dropped_samples += tmp.frames
+                    tmp.release()
                 recordingQLock.release()
+            tracer.complete("queue_block", spanStart, time.perf_counter_ns())
 
     def saveRecording(self, recordingQLock: threading.Lock):
-        db_conn = sqlite3.connect(db.dbname)
-        now = datetime.datetime.now()
-        nextDayId = db.getNextDayId(db_conn)
-        filename = f"{now.strftime('%b-%d-%Y_%I:%M%p')}_#{nextDayId}"
+        episode = self.episodeFeatures
+        barks = self.episodeBarks
+        channels = self.settings[Settings.NUM_CHANNELS]
+
+        # the file starts with the oldest pre-buffered block and is named
+        # after the capture time of its first sample
+        recordingQLock.acquire()
+        (block, tsobj) = self.recording_q.get()
+        self.bufferSum -= block.frames
+        recordingQLock.release()
+        firstIndex = block.index
+        startedAt = tsobj
+        latestTimestamp = tsobj.timestamp()
+
+        # no database access before the file is open, the id comes from memory
+        nextDayId = self.dayIds.allocate(startedAt)
+        filename = db.recordingName(startedAt, nextDayId)
         filepath = os.path.join(
             self.settings[Settings.RECORDING_FILE_PATH], f"{filename}.wav"
         )
@@ -383,78 +893,106 @@ class Detector:
             filepath,
             "w",
             samplerate=self.settings[Settings.SAMPLE_RATE],
-            channels=self.settings[Settings.NUM_CHANNELS],
+            channels=channels,
             subtype="PCM_16",
             format="WAV",
         )
+        # removed once the row is written, see recovery.py
+        marker = writeMarker(
+            self.settings[Settings.RECORDING_FILE_PATH], filename, startedAt, nextDayId
+        )
 
+        # samples are converted to PCM_16 into one batch and written (and
+        # flushed) every WRITE_BUFFER_LENGTH seconds
         maxChunkSize = (
             self.settings[Settings.SAMPLE_RATE]
             * self.settings[Settings.WRITE_BUFFER_LENGTH]
         )
-        curChunkSize = 0
+        writer = Pcm16BatchWriter(sf, maxChunkSize, channels)
 
-        firstTimestamp = None
-        latestTimestamp = time.time()
-        totalSampleCount = 0
+        # sample index just past the last written frame, file offset + firstIndex
+        nextIndex = firstIndex
         barking_stopped_at = maxTimestamp
-        tsobj: datetime.datetime = None
 
         self.is_writing = True
 
-        while latestTimestamp < barking_stopped_at:
+        while True:
+            with tracer.span("write_block"):
+                if block.index > nextIndex:
+                    # blocks were dropped while the writer lagged, pad with
+                    # silence so every later sample stays at its offset
+                    writer.write(
+                        np.zeros([block.index - nextIndex, channels], dtype=np.float32)
+                    )
+                writer.write(block.view())
+            nextIndex = block.index + block.frames
+            block.release()
+
             if (
                 barking_stopped_at == maxTimestamp
                 and not self.barking_stopped_at_q.empty()
             ):
                 barking_stopped_at = self.barking_stopped_at_q.get()
+            if latestTimestamp >= barking_stopped_at:
+                break
 
             recordingQLock.acquire()
 
-            (sample, tsobj) = self.recording_q.get()
+            (block, tsobj) = self.recording_q.get()
             latestTimestamp = tsobj.timestamp()
-            self.bufferSum -= sample.shape[0]
+            self.bufferSum -= block.frames
 
             recordingQLock.release()
 
-            if sample is not None:
-                sf.write(sample)
-                curChunkSize += sample.shape[0]
-                totalSampleCount += sample.shape[0]
-                if firstTimestamp is None:
-                    firstTimestamp = latestTimestamp
-
-            if curChunkSize >= maxChunkSize:
-                sf.flush()
-                curChunkSize = 0
-
-            # if (
-            #     not self.is_recording
-            #     and barking_stopped_at is not maxTimestamp
-            #     and latestTimestamp < barking_stopped_at
-            # ):
-            #     print(
-            #         "still recording... difference: ",
-            #         barking_stopped_at - latestTimestamp,
-            #     )
-
+        writer.flush()
         sf.close()
         self.is_writing = False
 
+        # barks whose window overlaps the file, clipped to it, in seconds
+        sampleRate = self.settings[Settings.SAMPLE_RATE]
+        positions = []
+        for bark in barks:
+            # its row may still be being inserted
+            bark["thread"].join()
+            (windowStart, windowLength) = bark["window"]
+            first = max(windowStart, firstIndex)
+            last = min(windowStart + windowLength, nextIndex)
+            if "id" in bark and last > first:
+                positions.append(
+                    (
+                        bark["id"],
+                        (first - firstIndex) / sampleRate,
+                        (last - first) / sampleRate,
+                    )
+                )
+
+        # the recording row goes last, so an export snapshot that has it also
+        # has its features and bark positions
+        db_conn = sqlite3.connect(db.dbname)
+        if episode.windows:
+            db.insertRecordingFeatures(db_conn, filename, episode.summary())
+        if positions:
+            db.setBarkPositions(db_conn, filename, positions)
         db.insertRecording(
-            db_conn, filename, now, latestTimestamp - firstTimestamp, nextDayId
+            db_conn,
+            filename,
+            startedAt,
+            (nextIndex - firstIndex) / sampleRate,
+            nextDayId,
         )
 
         db_conn.close()
+        removeMarker(marker)
 
-        # print("duration: ", latestTimestamp - firstTimestamp)
-        # print("number of samples: ", totalSampleCount)
-        # print("duration by samples: ", totalSampleCount / self.sample_rate)
-        # print("first timestamp: ", firstTimestamp)
-        # print("last timestamp: ", latestTimestamp)
-        # print("barking stopped at: ", barking_stopped_at)
+        # peaks and spectrogram are built once, off the capture path
+        self.thumbnailWorker.submit(filename, filepath)
 
-    def dbInsertBark(self, timestamp: datetime.datetime, confidence: float):
+    def dbInsertBark(
+        self, timestamp: datetime.datetime, confidence: float, bark: dict = None
+    ):
         dbConn = sqlite3.connect(db.dbname)
-        db.insertBark(dbConn, timestamp, confidence)
+        barkId = db.insertBark(dbConn, timestamp, confidence)
         dbConn.close()
+        if bark is not None:
+            # located in the file by saveRecording, once it knows the file
+            bark["id"] = barkId
@@ -0,0 +1,90 @@
+"""A module to share the detector message pipe between server threads."""
+
+import itertools
+import threading
+import time
+
+from message import Message, MsgAttr, MsgHandler
+
+
+class DetectorClient(object):
+    """Serializes request/response round trips over a single MsgHandler.
+
+    A pipe carries one conversation at a time, so concurrent server workers
+    take turns. Every request carries a new id that the detector echoes, and
+    replies with any other id, e.g. one arriving after its request timed
+    out, are dropped so they can't be mistaken for the current reply.
+    """
+
+    def __init__(self, msgHandler: MsgHandler, timeout: float = 1.0) -> None:
+        self._msgHandler = msgHandler
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._requestIds = itertools.count(1)
+
+    def setHandler(self, msgHandler: MsgHandler) -> None:
+        """Switches to the pipe of a restarted detector."""
+        with self._lock:
+            self._msgHandler = msgHandler
+
+    def request(self, msg: Message) -> Message:
+        """Sends `msg` and returns its reply, an empty Message on timeout."""
+        with self._lock:
+            requestId = next(self._requestIds)
+            msg.setRequestId(requestId)
+            self._msgHandler.send(msg, False)
+            deadline = time.monotonic() + self._timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return Message()
+                resp = self._msgHandler.recv(False, remaining)
+                if resp.getRequestId() == requestId:
+                    return resp
+                if resp.hasAttr(MsgAttr.MSG_TYPE):
+                    print(f"dropping stale detector reply {resp.getRequestId()}")
+
+
+class ResponseCache(object):
+    """A small thread-safe cache for read-only route responses.
+
+    Entries stored with a `ttl` expire on their own, entries without one live
+    until they are invalidated. A reader takes the key's `generation` before
+    fetching a value and passes it to `set`, so a value fetched before an
+    invalidation is never stored after it.
+    """
+
+    def __init__(self) -> None:
+        self._entries = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, key: str) -> int:
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            (value, expires) = entry
+            if expires is not None and time.monotonic() >= expires:
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key: str, value, ttl: float = None, generation: int = None) -> None:
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            if generation is not None and generation != self._generations.get(key, 0):
+                # invalidated while the value was being fetched
+                return
+            self._entries[key] = (value, expires)
+
+    def invalidate(self, key: str = None) -> None:
+        with self._lock:
+            keys = list(self._entries) + list(self._generations) if key is None else [key]
+            for k in keys:
+                self._generations[k] = self._generations.get(k, 0) + 1
+                self._entries.pop(k, None)
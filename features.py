@@ -0,0 +1,173 @@
+"""A module to compute cheap acoustic features of an inference window.
+
+One real FFT of the (mono) window gives the spectral centroid and the
+energy in a few frequency bands; level and peak come from the samples. The
+analysis window, the band weights and the scratch buffers are built once,
+and scipy.fft keeps its FFT plan cached between calls.
+"""
+
+import math
+import time
+import numpy as np
+
+try:
+    from scipy import fft as fftpack
+except ImportError:
+    fftpack = np.fft
+
+# floor for the dB values of silent windows
+minDb = -120.0
+
+
+class SpectralFeatures(object):
+    """Level, peak, spectral centroid and band energies of fixed-size windows."""
+
+    def __init__(self, window_size: int, sampling_rate: int, bands: list) -> None:
+        """Creates a SpectralFeatures instance.
+
+        Args:
+          window_size: Samples per window, as read from the recorder.
+          sampling_rate: Sample rate of the windows.
+          bands: [low_hz, high_hz] pairs to report the energy of.
+        """
+        self._window_size = window_size
+        self._sampling_rate = sampling_rate
+        if hasattr(fftpack, "next_fast_len"):
+            self._fft_length = fftpack.next_fast_len(window_size, real=True)
+        else:
+            self._fft_length = window_size
+        num_bins = self._fft_length // 2 + 1
+
+        self._window = np.hanning(window_size).astype(np.float32)
+        self._mono = np.zeros(self._fft_length, dtype=np.float32)
+        self._power = np.empty(num_bins, dtype=np.float32)
+        self._scratch = np.empty(num_bins, dtype=np.float32)
+        self._freqs = np.fft.rfftfreq(self._fft_length, 1.0 / sampling_rate).astype(
+            np.float32
+        )
+        # one-sided power spectrum scaled so bins sum to the mean square of
+        # the window (Parseval), i.e. the same scale as the RMS level
+        self._scale = np.full(
+            num_bins,
+            2.0 / (self._fft_length * float(np.sum(self._window**2))),
+            dtype=np.float32,
+        )
+        # DC, and Nyquist for an even length, have no mirrored negative bin
+        self._scale[0] /= 2.0
+        if self._fft_length % 2 == 0:
+            self._scale[-1] /= 2.0
+        self.setBands(bands)
+
+        self.calls = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def setBands(self, bands: list) -> None:
+        self._bands = [(float(low), float(high)) for low, high in bands]
+        # [bins, bands] 0/1 weights, so every band is summed in one matmul
+        self._band_weights = np.zeros(
+            (self._power.shape[0], len(self._bands)), dtype=np.float32
+        )
+        for i, (low, high) in enumerate(self._bands):
+            self._band_weights[(self._freqs >= low) & (self._freqs < high), i] = 1.0
+
+    def compute(self, window: np.ndarray) -> dict:
+        """Returns the features of a [window_size, channels] float32 window."""
+        started = time.perf_counter_ns()
+        mono = self._mono[: self._window_size]
+        if window.shape[1] == 1:
+            mono[:] = window[:, 0]
+        else:
+            np.mean(window, axis=1, out=mono)
+
+        meanSquare = float(np.dot(mono, mono)) / self._window_size
+        peak = float(np.max(np.abs(mono)))
+
+        np.multiply(mono, self._window, out=mono)
+        spectrum = fftpack.rfft(self._mono)
+        np.square(spectrum.real, out=self._power)
+        np.square(spectrum.imag, out=self._scratch)
+        np.add(self._power, self._scratch, out=self._power)
+        np.multiply(self._power, self._scale, out=self._power)
+
+        total = float(np.sum(self._power))
+        centroid = float(np.dot(self._freqs, self._power)) / total if total > 0 else 0.0
+        bandEnergies = self._power @ self._band_weights
+
+        features = {
+            "rms_dbfs": toDb(meanSquare),
+            "peak_dbfs": toDb(peak * peak),
+            "centroid_hz": round(centroid, 1),
+            "bands_db": [toDb(float(e)) for e in bandEnergies],
+        }
+
+        elapsed = time.perf_counter_ns() - started
+        self.calls += 1
+        self.total_ns += elapsed
+        self.max_ns = max(self.max_ns, elapsed)
+        return features
+
+    @property
+    def bands(self) -> list:
+        return [list(b) for b in self._bands]
+
+    def cost(self) -> dict:
+        """Time spent per window so far, in microseconds."""
+        return {
+            "windows": self.calls,
+            "mean_us": round(self.total_ns / self.calls / 1000, 1) if self.calls else None,
+            "max_us": round(self.max_ns / 1000, 1),
+        }
+
+
+def toDb(power: float) -> float:
+    return round(max(10.0 * math.log10(power), minDb), 2) if power > 0 else minDb
+
+
+class EpisodeFeatures(object):
+    """Running summary of the features over one recording episode."""
+
+    def __init__(self) -> None:
+        self.windows = 0
+        self._sums = None
+        self._maxima = None
+
+    def add(self, features: dict) -> None:
+        values = self._flatten(features)
+        if self._sums is None or self._sums.shape != values.shape:
+            # first window, or the bands changed mid-episode
+            self.windows = 0
+            self._sums = values.copy()
+            self._maxima = values.copy()
+        else:
+            self._sums += values
+            np.maximum(self._maxima, values, out=self._maxima)
+        self.windows += 1
+
+    def summary(self) -> dict:
+        """Mean and max of every feature, or an empty dict without windows."""
+        if self.windows == 0:
+            return {}
+        mean = self._sums / self.windows
+        return {
+            "windows": self.windows,
+            "mean": self._unflatten(mean),
+            "max": self._unflatten(self._maxima),
+        }
+
+    @staticmethod
+    def _flatten(features: dict) -> np.ndarray:
+        return np.array(
+            [features["rms_dbfs"], features["peak_dbfs"], features["centroid_hz"]]
+            + features["bands_db"],
+            dtype=np.float64,
+        )
+
+    @staticmethod
+    def _unflatten(values: np.ndarray) -> dict:
+        return {
+            "rms_dbfs": round(float(values[0]), 2),
+            "peak_dbfs": round(float(values[1]), 2),
+            "centroid_hz": round(float(values[2]), 1),
+            "bands_db": [round(float(v), 2) for v in values[3:]],
+        }
@@ -0,0 +1,175 @@
+"""A module to compute log-mel frames of audio read block by block.
+
+thumbnails.py uses it to build recording spectrograms without loading the
+whole file. The detector does not, its classifier computes its own features
+from the raw window.
+"""
+
+import math
+import numpy as np
+
+
+def hertzToMel(freq):
+    return 1127.0 * np.log1p(np.asarray(freq, dtype=np.float64) / 700.0)
+
+
+def melMatrix(
+    num_mel_bins: int,
+    num_spectrogram_bins: int,
+    sampling_rate: int,
+    lower_hz: float,
+    upper_hz: float,
+) -> np.ndarray:
+    """Builds a [num_spectrogram_bins, num_mel_bins] triangular mel weight matrix.
+
+    Follows the construction used by the YAMNet/VGGish feature extractor.
+    """
+    nyquist = sampling_rate / 2.0
+    upper_hz = min(upper_hz, nyquist)
+    spectrogram_mels = hertzToMel(np.linspace(0.0, nyquist, num_spectrogram_bins))
+    band_edges = np.linspace(
+        hertzToMel(lower_hz), hertzToMel(upper_hz), num_mel_bins + 2
+    )
+
+    weights = np.empty((num_spectrogram_bins, num_mel_bins), dtype=np.float32)
+    for i in range(num_mel_bins):
+        lower, center, upper = band_edges[i : i + 3]
+        lower_slope = (spectrogram_mels - lower) / (center - lower)
+        upper_slope = (upper - spectrogram_mels) / (upper - center)
+        weights[:, i] = np.maximum(0.0, np.minimum(lower_slope, upper_slope))
+
+    # the DC bin never contributes
+    weights[0, :] = 0.0
+    return weights
+
+
+class StreamingLogMel(object):
+    """Computes log-mel frames incrementally and keeps the latest in a ring.
+
+    Every call to `push` transforms only the new samples, carrying the tail
+    that doesn't fill a frame yet over to the next call, so a file can be
+    fed in blocks of any size. The ring holds the last `num_frames` frames,
+    callers read the new ones with `latest` after each push.
+    """
+
+    def __init__(
+        self,
+        sampling_rate: int,
+        num_frames: int = 96,
+        window_ms: float = 25.0,
+        hop_ms: float = 10.0,
+        num_mel_bins: int = 64,
+        lower_hz: float = 125.0,
+        upper_hz: float = 7500.0,
+        log_offset: float = 0.001,
+    ) -> None:
+        """Creates a StreamingLogMel instance.
+
+        Args:
+          sampling_rate: Sampling rate of the pushed audio in Hertz.
+          num_frames: Number of most recent frames kept in the ring.
+          window_ms: STFT window length in milliseconds.
+          hop_ms: STFT hop length in milliseconds.
+          num_mel_bins: Number of mel bands per frame.
+          lower_hz: Lower edge of the lowest mel band.
+          upper_hz: Upper edge of the highest mel band.
+          log_offset: Offset added before taking the log.
+
+        Raises:
+          ValueError: if any of the sizes is non-positive.
+        """
+        if sampling_rate <= 0:
+            raise ValueError("sampling_rate must be positive.")
+        if num_frames <= 0:
+            raise ValueError("num_frames must be positive.")
+
+        self._sampling_rate = sampling_rate
+        self._num_frames = num_frames
+        self._window_length = int(round(sampling_rate * window_ms / 1000.0))
+        self._hop_length = int(round(sampling_rate * hop_ms / 1000.0))
+        if self._window_length <= 0 or self._hop_length <= 0:
+            raise ValueError("window_ms and hop_ms must be positive.")
+
+        self._fft_length = 2 ** int(math.ceil(math.log2(self._window_length)))
+        self._log_offset = log_offset
+
+        # periodic hann window, computed once
+        self._window = (
+            0.5
+            - 0.5
+            * np.cos(
+                2 * np.pi * np.arange(self._window_length) / self._window_length
+            )
+        ).astype(np.float32)
+        self._mel_matrix = melMatrix(
+            num_mel_bins,
+            self._fft_length // 2 + 1,
+            sampling_rate,
+            lower_hz,
+            upper_hz,
+        )
+
+        self._frames = np.zeros((num_frames, num_mel_bins), dtype=np.float32)
+        self._write_index = 0
+        self._frame_count = 0
+        self._pending = np.zeros(0, dtype=np.float32)
+
+    @property
+    def window_length(self) -> int:
+        return self._window_length
+
+    @property
+    def frame_count(self) -> int:
+        """Total number of frames computed so far."""
+        return self._frame_count
+
+    def push(self, samples: np.ndarray) -> int:
+        """Transforms newly captured samples into log-mel frames.
+
+        Args:
+          samples: New audio, either [n] or [n, channels]. Channels are mixed
+            down to mono.
+
+        Returns:
+          The number of new frames added to the ring.
+        """
+        if samples.ndim > 1:
+            samples = samples.mean(axis=1)
+
+        buf = np.concatenate((self._pending, samples.astype(np.float32, copy=False)))
+        if buf.shape[0] < self._window_length:
+            self._pending = buf
+            return 0
+
+        num_new = 1 + (buf.shape[0] - self._window_length) // self._hop_length
+        frames = np.lib.stride_tricks.as_strided(
+            buf,
+            shape=(num_new, self._window_length),
+            strides=(buf.strides[0] * self._hop_length, buf.strides[0]),
+            writeable=False,
+        )
+        spectrum = np.abs(np.fft.rfft(frames * self._window, n=self._fft_length))
+        logmel = np.log(spectrum @ self._mel_matrix + self._log_offset)
+
+        # only the last num_frames can survive in the ring anyway
+        logmel = logmel[-self._num_frames :]
+        count = logmel.shape[0]
+        end = self._write_index + count
+        if end <= self._num_frames:
+            self._frames[self._write_index : end] = logmel
+        else:
+            split = self._num_frames - self._write_index
+            self._frames[self._write_index :] = logmel[:split]
+            self._frames[: count - split] = logmel[split:]
+        self._write_index = end % self._num_frames
+        self._frame_count += num_new
+
+        self._pending = buf[num_new * self._hop_length :].copy()
+        return num_new
+
+    def latest(self, count: int) -> np.ndarray:
+        """Returns the `count` most recent frames, oldest first."""
+        count = min(count, self._frame_count, self._num_frames)
+        if count <= 0:
+            return self._frames[:0]
+        return np.roll(self._frames, -self._write_index, axis=0)[-count:]
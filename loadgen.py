@@ -0,0 +1,377 @@
+"""Load generator for the server and detector IPC layer.
+
+Starts N fake detectors, each capturing from its own synthetic audio source
+(no microphone or model needed) and answering the same pipe protocol as
+detector.py, behind its own copy of the server on consecutive ports. M client
+threads then poll the HTTP routes the way dashboards do, and the run reports
+request latency percentiles, throughput and errors next to capture stalls
+seen on the detector side.
+
+    python loadgen.py --detectors 4 --clients 32 --seconds 30 [--production]
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import multiprocessing as mp
+import random
+import threading
+import time
+import numpy as np
+
+from audio_record import AudioRecord
+from audio_source import AudioSource, SynthSource, createSource, defaultBlockSize
+from message import MsgAttr, MsgCmd, MsgHandler, Message, MsgRespType, MsgStatus, MsgType
+from utils import Settings, defaultSettings, scoreNames
+
+sampleRate = 16000
+windowSize = 15600
+basePort = 5200
+# request mix of the client threads, as (weight, method, path)
+routeMix = [
+    (80, "GET", "/detectresult"),
+    (10, "GET", "/detectorsetting"),
+    (5, "GET", "/detectorstatus"),
+    (5, "POST", "/detectorsetting"),
+]
+
+
+class TimedSource(AudioSource):
+    """Wraps a source and records gaps between its callbacks.
+
+    A gap of more than twice the block period means the capture callback
+    was held up, e.g. by the GIL or a lock shared with the IPC loop.
+    """
+
+    def __init__(self, source: AudioSource) -> None:
+        super().__init__(source._channels, source._sampling_rate, source._block_size)
+        self._source = source
+        self._period = source._block_size / source._sampling_rate
+        self._last = None
+        self.blocks = 0
+        self.stalls = 0
+        self.max_gap = 0.0
+
+    def setCallback(self, callback) -> None:
+        def timed(data):
+            now = time.monotonic()
+            if self._last is not None:
+                gap = now - self._last
+                self.max_gap = max(self.max_gap, gap)
+                if gap > 2 * self._period:
+                    self.stalls += 1
+            self._last = now
+            self.blocks += 1
+            callback(data)
+
+        self._source.setCallback(timed)
+
+    def start(self) -> None:
+        self._source.start()
+
+    def stop(self) -> None:
+        self._source.stop()
+
+
+class FakeDetector(object):
+    """Captures synthetic audio and answers detector commands with RMS scores."""
+
+    def __init__(self, msgHandler: MsgHandler, spec: str, index: int) -> None:
+        self.msgHandler = msgHandler
+        self.settings = {
+            setting: defaultSettings[setting.value] for setting in Settings
+        }
+        self.settings[Settings.SAMPLE_RATE] = sampleRate
+        self.settings[Settings.REC_BUFFER_SIZE] = windowSize
+        self.settings[Settings.AUDIO_SOURCE] = spec
+
+        kind, _, arg = spec.partition(":")
+        if kind == "synth":
+            # every device hears different noise
+            source = SynthSource(1, sampleRate, defaultBlockSize, arg or "bark", seed=index)
+        else:
+            source = createSource(spec, 1, sampleRate, defaultBlockSize, -1)
+        self.source = TimedSource(source)
+        self.record = AudioRecord(
+            1, sampleRate, windowSize, -1, sampleRate * 60, source=self.source
+        )
+        self.window = np.zeros([windowSize, 1], dtype=np.float32)
+        self.scores = None
+        self.scoresLock = threading.Lock()
+        self.inferences = 0
+        self.commands = 0
+        self.max_command_time = 0.0
+
+    def inferenceLoop(self, running: threading.Event) -> None:
+        hop = windowSize / sampleRate / 2
+        while running.wait(hop) is False:
+            self.record.read_rolled_buffer(windowSize, self.window)
+            # nothing is recorded, hand the queued blocks back to the pool
+            self.record.flush_queue()
+
+            rms = float(np.sqrt(np.mean(np.square(self.window))))
+            dbfs = 20 * np.log10(max(rms, 1e-10))
+            score = min(max((dbfs + 60.0) / 60.0, 0.0), 1.0)
+            with self.scoresLock:
+                self.scores = {name: score / (i + 1) for i, name in enumerate(scoreNames)}
+            self.inferences += 1
+
+    def getStatus(self) -> dict:
+        return {
+            "capture_blocks": self.source.blocks,
+            "capture_stalls": self.source.stalls,
+            "capture_max_gap_ms": round(self.source.max_gap * 1000, 3),
+            "capture_dropped_samples": self.record.dropped_samples,
+            "inferences": self.inferences,
+            "commands": self.commands,
+            "max_command_ms": round(self.max_command_time * 1000, 3),
+        }
+
+    def respond(self, cmdMsg: Message) -> tuple[Message, bool]:
+        """Builds the reply to one command, and whether to keep running."""
+        resp = Message().setMsgType(MsgType.RESPONSE).setRespType(MsgRespType.STATUS)
+        if cmdMsg.checkCmd(MsgCmd.GET_RESULT):
+            with self.scoresLock:
+                scores = None if self.scores is None else self.scores.copy()
+            if scores is None:
+                return (resp.setStatus(MsgStatus.ERROR), True)
+            return (
+                Message()
+                .setMsgType(MsgType.RESPONSE)
+                .setRespType(MsgRespType.CLASS_DATA)
+                .setData(scores),
+                True,
+            )
+        elif cmdMsg.checkCmd(MsgCmd.UPDATE_SETTING):
+            for key, value in cmdMsg.getData().items():
+                for setting in Settings:
+                    if key == setting.value:
+                        self.settings[setting] = value
+            return (resp.setStatus(MsgStatus.SUCCESS).setData(self.settings), True)
+        elif cmdMsg.checkCmd(MsgCmd.GET_SETTINGS):
+            return (resp.setStatus(MsgStatus.SUCCESS).setData(self.settings), True)
+        elif cmdMsg.checkCmd(MsgCmd.GET_STATUS):
+            return (resp.setStatus(MsgStatus.SUCCESS).setData(self.getStatus()), True)
+        elif cmdMsg.checkCmd(MsgCmd.QUIT):
+            return (resp.setStatus(MsgStatus.SUCCESS), False)
+
+        return (resp.setStatus(MsgStatus.ERROR).setData("unknown command"), True)
+
+    def run(self) -> None:
+        running = threading.Event()
+        self.record.start_recording()
+        inferenceThread = threading.Thread(
+            target=self.inferenceLoop, args=(running,), daemon=True
+        )
+        inferenceThread.start()
+
+        keepRunning = True
+        while keepRunning:
+            cmdMsg = self.msgHandler.recv()
+            start = time.monotonic()
+            if cmdMsg.hasAttr(MsgAttr.MSG_TYPE) and cmdMsg.checkMsgType(MsgType.CMD):
+                (resp, keepRunning) = self.respond(cmdMsg)
+                self.msgHandler.reply(cmdMsg, resp)
+            self.commands += 1
+            self.max_command_time = max(self.max_command_time, time.monotonic() - start)
+
+        running.set()
+        self.record.stop()
+
+
+def runFakeDetector(msgHandler: MsgHandler, spec: str, index: int) -> None:
+    FakeDetector(msgHandler, spec, index).run()
+
+
+def runNode(port: int, spec: str, index: int, production: bool, threads: int) -> None:
+    """One server process with its own fake detector, like a real deployment."""
+    import logging
+    import server
+
+    # one access log line per request would dominate the run
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server.detectorProcess = mp.Process(
+        target=runFakeDetector,
+        args=(server.detectorMsgHandler, spec, index),
+        daemon=True,
+    )
+    server.detectorProcess.start()
+    server.serve(
+        argparse.Namespace(
+            production=production, host="127.0.0.1", port=port, threads=threads
+        )
+    )
+
+
+class Client(object):
+    """Keeps one connection per node and records every request."""
+
+    def __init__(self, ports: list, seed: int) -> None:
+        self.ports = ports
+        self.rng = random.Random(seed)
+        self.connections = {}
+        self.latencies = {f"{method} {path}": [] for _, method, path in routeMix}
+        self.errors = {f"{method} {path}": 0 for _, method, path in routeMix}
+
+    def pickRoute(self) -> tuple[str, str]:
+        (_, method, path) = self.rng.choices(
+            routeMix, weights=[w for w, _, _ in routeMix]
+        )[0]
+        return (method, path)
+
+    def request(self, port: int, method: str, path: str) -> None:
+        body = None
+        headers = {}
+        if method == "POST":
+            body = json.dumps(
+                {
+                    "settingName": Settings.BARK_THRESHOLD.value,
+                    "settingVal": round(self.rng.uniform(0.1, 0.2), 3),
+                }
+            )
+            headers["Content-Type"] = "application/json"
+
+        key = f"{method} {path}"
+        start = time.perf_counter()
+        try:
+            conn = self.connections.get(port)
+            if conn is None:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+                self.connections[port] = conn
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            payload = resp.read()
+            ok = resp.status == 200 and not payload.startswith(b"detector ")
+        except (OSError, http.client.HTTPException):
+            self.connections.pop(port, None)
+            ok = False
+
+        if ok:
+            self.latencies[key].append(time.perf_counter() - start)
+        else:
+            self.errors[key] += 1
+
+    def run(self, deadline: float) -> None:
+        while time.monotonic() < deadline:
+            (method, path) = self.pickRoute()
+            self.request(self.rng.choice(self.ports), method, path)
+
+
+def waitForNodes(ports: list, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    for port in ports:
+        while True:
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+                conn.request("GET", "/detectresult")
+                if conn.getresponse().read() not in (b"no data", b"detector not started"):
+                    break
+            except (OSError, http.client.HTTPException):
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"node on port {port} did not come up")
+            time.sleep(0.2)
+
+
+def fetchStatus(port: int) -> dict:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("GET", "/detectorstatus")
+    return json.loads(conn.getresponse().read())
+
+
+def stopNode(port: int) -> None:
+    """Quits the fake detector so it doesn't outlive its server."""
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request("GET", "/quit")
+        conn.getresponse().read()
+    except (OSError, http.client.HTTPException):
+        pass
+
+
+def percentile(values: list, p: float) -> float:
+    return float(np.percentile(values, p)) * 1000 if values else float("nan")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--detectors", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--port", type=int, default=basePort, help="port of the first node")
+    parser.add_argument(
+        "--source", default="synth:bark", help="audio_source spec for every detector"
+    )
+    parser.add_argument("--production", action="store_true", help="serve with waitress")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    # spawned, so every node imports its own server module and pipe
+    ctx = mp.get_context("spawn")
+    ports = [args.port + i for i in range(args.detectors)]
+    nodes = [
+        ctx.Process(
+            target=runNode,
+            args=(port, args.source, i, args.production, args.threads),
+        )
+        for i, port in enumerate(ports)
+    ]
+    for node in nodes:
+        node.start()
+    try:
+        waitForNodes(ports)
+
+        clients = [Client(ports, seed) for seed in range(args.clients)]
+        deadline = time.monotonic() + args.seconds
+        threads = [threading.Thread(target=c.run, args=(deadline,)) for c in clients]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        report = {
+            "started": datetime.datetime.now().isoformat(),
+            "detectors": args.detectors,
+            "clients": args.clients,
+            "seconds": elapsed,
+            "routes": {},
+            "nodes": {},
+        }
+        print(f"{'route':<22}{'req/s':>9}{'errors':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+        for _, method, path in routeMix:
+            name = f"{method} {path}"
+            latencies = [l for c in clients for l in c.latencies[name]]
+            errors = sum(c.errors[name] for c in clients)
+            row = {
+                "requests_per_second": len(latencies) / elapsed,
+                "errors": errors,
+                "p50_ms": percentile(latencies, 50),
+                "p90_ms": percentile(latencies, 90),
+                "p99_ms": percentile(latencies, 99),
+                "max_ms": max(latencies) * 1000 if latencies else float("nan"),
+            }
+            report["routes"][name] = row
+            print(
+                f"{name:<22}{row['requests_per_second']:9.1f}{errors:8d}"
+                f"{row['p50_ms']:9.2f}{row['p90_ms']:9.2f}{row['p99_ms']:9.2f}{row['max_ms']:9.2f}"
+            )
+
+        print()
+        for port in ports:
+            status = fetchStatus(port)
+            report["nodes"][port] = status
+            print(f"node {port}: {json.dumps(status)}")
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    finally:
+        for port in ports:
+            stopNode(port)
+        for node in nodes:
+            node.terminate()
+            node.join()
@@ -8,6 +8,7 @@ class MsgAttr(Enum):
     DATA = "data"
     STATUS = "status"
     CMD = "command"
+    REQUEST_ID = "request_id"
 
 
 class MsgType(Enum):
@@ -26,6 +27,9 @@ class MsgCmd(Enum):
     QUIT = "end"
     UPDATE_SETTING = "update_setting"
     GET_SETTINGS = "get_settings"
+    GET_STATUS = "get_status"
+    GET_CALIBRATION = "get_calibration"
+    PROFILE = "profile"
 
 
 class MsgStatus(Enum):
@@ -116,6 +120,16 @@ class Message(object):
 
         return ""
 
+    def setRequestId(self, requestId: int):
+        self.msg[MsgAttr.REQUEST_ID.value] = requestId
+        return self
+
+    def getRequestId(self):
+        if self.hasAttr(MsgAttr.REQUEST_ID):
+            return self.msg[MsgAttr.REQUEST_ID.value]
+
+        return None
+
     def buildDict(self):
         if MsgAttr.STATUS.value not in self.msg:
             self.msg[MsgAttr.STATUS.value] = MsgStatus.SUCCESS.value
@@ -152,13 +166,19 @@ class MsgHandler:
         self.sendPipe.send(msg)
 
         if wait and timeout != 0:
-            return self.recvPipe.recv()
-        elif wait:
             if self.recvPipe.poll(timeout):
                 return self.recvPipe.recv()
+        elif wait:
+            return self.recvPipe.recv()
 
         return Message()
 
+    def reply(self, request: Message, resp: Message) -> None:
+        """Sends the response to `request`, tagged with its request id."""
+        if request.getRequestId() is not None:
+            resp.setRequestId(request.getRequestId())
+        self.sendPipe.send(resp)
+
     def recv(self, wait: bool = True, timeout: int = 0) -> Message:
         if wait:
             return self.recvPipe.recv()
@@ -0,0 +1,106 @@
+"""A module to track real-time factor and step the detector down under load."""
+
+from enum import IntEnum
+import threading
+
+
+class LoadLevel(IntEnum):
+    NORMAL = 0
+    WIDE_HOP = 1  # inference hop is doubled
+    SILENCE_GATE = 2  # windows quieter than the gate are not classified
+    DROP_WINDOWS = 3  # only every other window is classified
+
+
+# widen the hop this much from WIDE_HOP upwards
+hopFactor = 2.0
+# real-time factor above which we step down / below which we step back up
+escalateRtf = 0.8
+recoverRtf = 0.4
+# consecutive cycles needed before changing level, avoids flapping
+escalateCycles = 5
+recoverCycles = 50
+
+
+class LoadMonitor(object):
+    """Keeps a running real-time factor of inference and the current level.
+
+    The real-time factor is the time spent producing a classification divided
+    by the audio time it covers (the hop). Above 1.0 the detector can't keep up.
+    Recorded audio is never dropped by this class; it only controls how much
+    inference work is done.
+    """
+
+    def __init__(self, alpha: float = 0.2) -> None:
+        self._alpha = alpha
+        self._lock = threading.Lock()
+        self._rtf = 0.0
+        self._level = LoadLevel.NORMAL
+        self._above = 0
+        self._below = 0
+        self._cycle = 0
+        self.gated_windows = 0
+        self.dropped_windows = 0
+        self.skipped_samples = 0
+
+    @property
+    def level(self) -> LoadLevel:
+        return self._level
+
+    @property
+    def rtf(self) -> float:
+        return self._rtf
+
+    def hopMultiplier(self) -> float:
+        return hopFactor if self._level >= LoadLevel.WIDE_HOP else 1.0
+
+    def record(self, workSeconds: float, hopSeconds: float) -> None:
+        """Adds one inference cycle and updates the level with hysteresis."""
+        if hopSeconds <= 0:
+            return
+        rtf = workSeconds / hopSeconds
+
+        with self._lock:
+            self._rtf += self._alpha * (rtf - self._rtf)
+
+            if self._rtf > escalateRtf:
+                self._above += 1
+                self._below = 0
+            elif self._rtf < recoverRtf:
+                self._below += 1
+                self._above = 0
+            else:
+                self._above = 0
+                self._below = 0
+
+            if self._above >= escalateCycles and self._level < LoadLevel.DROP_WINDOWS:
+                self._level = LoadLevel(self._level + 1)
+                self._above = 0
+                print(f"detector overloaded (rtf {self._rtf:.2f}), level {self._level.name}")
+            elif self._below >= recoverCycles and self._level > LoadLevel.NORMAL:
+                self._level = LoadLevel(self._level - 1)
+                self._below = 0
+                print(f"detector load recovered, level {self._level.name}")
+
+    def shouldGate(self, rmsDbfs: float, gateDbfs: float) -> bool:
+        """Returns True if a quiet window should be skipped at this level."""
+        if self._level >= LoadLevel.SILENCE_GATE and rmsDbfs < gateDbfs:
+            self.gated_windows += 1
+            return True
+        return False
+
+    def shouldDrop(self) -> bool:
+        """Returns True if this window should be dropped at this level."""
+        self._cycle += 1
+        if self._level >= LoadLevel.DROP_WINDOWS and self._cycle % 2 == 0:
+            self.dropped_windows += 1
+            return True
+        return False
+
+    def status(self) -> dict:
+        return {
+            "level": self._level.name,
+            "rtf": round(self._rtf, 3),
+            "gated_windows": self.gated_windows,
+            "dropped_windows": self.dropped_windows,
+            "skipped_samples": self.skipped_samples,
+        }
@@ -0,0 +1,238 @@
+"""A module for on-demand profiling inside the detector process.
+
+A session samples the Python stacks of every thread at a fixed interval
+into collapsed stacks ("thread;outer;inner count", the input format of
+flamegraph.pl and speedscope), and records spans of the inference cycle
+stages into a Chrome trace (chrome://tracing, Perfetto). Both are off
+outside a session; then a span costs one attribute check.
+
+A finished session's results are written to files in `resultDir`, only
+their paths travel over the pipe.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+# sessions are cut off after this long
+maxSessionSeconds = 120.0
+# spans kept per session, later ones are counted but dropped
+maxSpans = 200000
+# the latest session's collapsed stacks and trace, replaced by the next one
+resultDir = os.path.join(tempfile.gettempdir(), "barking_detector_profile")
+
+
+class _Span(object):
+    __slots__ = ("_tracer", "_name", "_start")
+
+    def __init__(self, tracer: "SpanTracer", name: str) -> None:
+        self._tracer = tracer
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *_):
+        self._tracer.complete(self._name, self._start, time.perf_counter_ns())
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return None
+
+
+_noSpan = _NoSpan()
+
+
+class SpanTracer(object):
+    """Collects named spans per thread while a session is active."""
+
+    def __init__(self) -> None:
+        self.active = False
+        self._spans = []
+        self._dropped = 0
+        self._threadNames = {}
+
+    def span(self, name: str):
+        """Times a `with` block as a span on the calling thread."""
+        if not self.active:
+            return _noSpan
+        return _Span(self, name)
+
+    def complete(self, name: str, startNs: int, endNs: int) -> None:
+        """Adds a span measured by the caller, e.g. across a callback."""
+        if not self.active:
+            return
+        if len(self._spans) >= maxSpans:
+            self._dropped += 1
+            return
+        tid = threading.get_ident()
+        if tid not in self._threadNames:
+            self._threadNames[tid] = threading.current_thread().name
+        # list.append is atomic, no lock on the hot path
+        self._spans.append((name, tid, startNs, endNs - startNs))
+
+    def begin(self) -> None:
+        self._spans = []
+        self._dropped = 0
+        self._threadNames = {}
+        self.active = True
+
+    def end(self) -> dict:
+        """Stops collecting and returns the spans in Chrome trace format."""
+        self.active = False
+        # threads that passed the active check may still be adding
+        threadNames = self._threadNames.copy()
+        spans = self._spans[:]
+        pid = os.getpid()
+        events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in threadNames.items()
+        ]
+        events += [
+            {
+                "name": name,
+                "ph": "X",
+                "pid": pid,
+                "tid": tid,
+                "ts": start / 1000,
+                "dur": duration / 1000,
+            }
+            for name, tid, start, duration in spans
+        ]
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"dropped_spans": self._dropped},
+        }
+
+
+tracer = SpanTracer()
+
+
+def frameLabel(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler(object):
+    """Samples every thread's Python stack from a background thread."""
+
+    def __init__(self, interval: float) -> None:
+        self._interval = interval
+        self._counts = Counter()
+        self._samples = 0
+        self._cpu = 0.0
+
+    def run(self, stop: threading.Event, deadline: float) -> None:
+        """Samples until `stop` is set or time.perf_counter() passes `deadline`."""
+        me = threading.get_ident()
+        cpuStart = time.thread_time()
+        while not stop.wait(self._interval) and time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frameLabel(frame))
+                    frame = frame.f_back
+                # threads started outside Python (PortAudio, MediaPipe) have
+                # no threading name
+                thread = names.get(tid, f"native-{tid}")
+                stack.append(thread)
+                self._counts[";".join(reversed(stack))] += 1
+            self._samples += 1
+        self._cpu = time.thread_time() - cpuStart
+
+    def collapsed(self) -> str:
+        return "\n".join(
+            f"{stack} {count}" for stack, count in self._counts.most_common()
+        )
+
+    def stats(self) -> dict:
+        return {"samples": self._samples, "sampler_cpu_seconds": round(self._cpu, 4)}
+
+
+def writeResult(path: str, write) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+class ProfileSession(object):
+    """One time-bounded profiling run, stack samples plus spans."""
+
+    def __init__(self, seconds: float, interval: float = 0.01) -> None:
+        self.seconds = min(max(seconds, 0.1), maxSessionSeconds)
+        self.interval = max(interval, 0.001)
+        self.startedAt = None
+        self.result = None
+        self._stop = threading.Event()
+        self._sampler = StackSampler(self.interval)
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    @property
+    def running(self) -> bool:
+        return self.startedAt is not None and self.result is None
+
+    def start(self) -> None:
+        self.startedAt = time.time()
+        tracer.begin()
+        self._thread.start()
+
+    def cancel(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        started = time.perf_counter()
+        self._sampler.run(self._stop, started + self.seconds)
+        trace = tracer.end()
+        wall = time.perf_counter() - started
+
+        stats = self._sampler.stats()
+        stats.update(
+            {
+                "seconds": round(wall, 3),
+                "interval": self.interval,
+                # share of one core spent taking samples
+                "sampler_overhead": round(stats["sampler_cpu_seconds"] / wall, 4),
+                "spans": sum(1 for e in trace["traceEvents"] if e["ph"] == "X"),
+            }
+        )
+        os.makedirs(resultDir, exist_ok=True)
+        collapsedPath = os.path.join(resultDir, "collapsed.txt")
+        writeResult(collapsedPath, lambda f: f.write(self._sampler.collapsed() + "\n"))
+        tracePath = os.path.join(resultDir, "trace.json")
+        writeResult(tracePath, lambda f: json.dump(trace, f))
+        self.result = {
+            "started_at": self.startedAt,
+            "stats": stats,
+            "collapsed_path": collapsedPath,
+            "trace_path": tracePath,
+        }
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "started_at": self.startedAt,
+            "seconds": self.seconds,
+            "interval": self.interval,
+        }
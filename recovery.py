@@ -0,0 +1,116 @@
+"""A module to finish recordings that a crashed detector left open.
+
+While a recording is written a small marker file sits next to it. A clean
+finish removes the marker; markers found at startup belong to recordings
+whose WAV header was never finalized and whose database row was never
+written.
+"""
+
+import datetime
+import glob
+import json
+import os
+import sqlite3
+import struct
+
+import db
+
+
+def getMarkerPath(recordingPath: str) -> str:
+    return os.path.join(recordingPath, ".inprogress")
+
+
+def writeMarker(recordingPath: str, name: str, timestamp: datetime.datetime, dayId: int) -> str:
+    markerDir = getMarkerPath(recordingPath)
+    os.makedirs(markerDir, exist_ok=True)
+    path = os.path.join(markerDir, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump({"name": name, "timestamp": timestamp.timestamp(), "day_id": dayId}, f)
+    return path
+
+
+def removeMarker(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def repairWav(path: str) -> tuple[int, int]:
+    """Fixes the RIFF and data chunk sizes of a WAV cut off while writing.
+
+    The header is only rewritten on flush, so the data chunk size may be
+    behind (or a placeholder) and the file may end in a partial frame.
+
+    Returns:
+      The number of frames and the sample rate of the repaired file.
+    """
+    with open(path, "r+b") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            raise ValueError(f"{path} is not a RIFF/WAVE file")
+
+        fileSize = os.fstat(f.fileno()).st_size
+        blockAlign = 0
+        sampleRate = 0
+        offset = 12
+        while offset + 8 <= fileSize:
+            f.seek(offset)
+            chunkId, chunkSize = struct.unpack("<4sI", f.read(8))
+            if chunkId == b"fmt ":
+                fmt = f.read(16)
+                (_, _, sampleRate, _, blockAlign) = struct.unpack("<HHIIH", fmt[:14])
+            elif chunkId == b"data":
+                if blockAlign == 0:
+                    break
+                dataStart = offset + 8
+                dataSize = fileSize - dataStart
+                dataSize -= dataSize % blockAlign
+                f.seek(offset + 4)
+                f.write(struct.pack("<I", dataSize))
+                f.seek(4)
+                f.write(struct.pack("<I", dataStart + dataSize - 8))
+                f.truncate(dataStart + dataSize)
+                return (dataSize // blockAlign, sampleRate)
+            offset += 8 + chunkSize + (chunkSize & 1)
+
+    raise ValueError(f"{path} has no data chunk")
+
+
+def recoverRecordings(recordingPath: str, dbConn: sqlite3.Connection) -> list:
+    """Finishes every recording with a leftover marker.
+
+    Returns:
+      (name, path) of the recordings that were recovered.
+    """
+    recovered = []
+    for markerPath in sorted(glob.glob(os.path.join(getMarkerPath(recordingPath), "*.json"))):
+        try:
+            with open(markerPath, "r") as f:
+                marker = json.load(f)
+        except (OSError, ValueError):
+            removeMarker(markerPath)
+            continue
+
+        name = marker["name"]
+        wavPath = os.path.join(recordingPath, f"{name}.wav")
+        try:
+            (frames, sampleRate) = repairWav(wavPath)
+        except (OSError, ValueError) as e:
+            print(f"could not recover recording {name}: {e}")
+            removeMarker(markerPath)
+            continue
+
+        if frames > 0 and db.getRecordingByName(dbConn, name) is None:
+            db.insertRecording(
+                dbConn,
+                name,
+                datetime.datetime.fromtimestamp(marker["timestamp"]),
+                frames / sampleRate,
+                marker["day_id"],
+            )
+            recovered.append((name, wavPath))
+            print(f"recovered recording {name} ({frames / sampleRate:.1f}s)")
+        removeMarker(markerPath)
+
+    return recovered
@@ -0,0 +1,288 @@
+"""Replays labeled recordings through the detection pipeline and scores it.
+
+Each configuration (a set of setting overrides) is run over every labeled
+recording faster than real time, in its own process, and reported with
+precision, recall and onset latency next to its CPU cost and peak memory.
+
+Labels are a CSV file with a header `name,onset,offset`: the recording name as
+stored in `audio_files`, and the bark start/end in seconds from the start of
+the file (offset may be empty). Recordings without a label row count as
+bark-free.
+
+    python replay.py --labels labels.csv --sweep bark_threshold=0.1,0.15,0.2 \\
+        --sweep inference_overlap=0.5,0.75
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing as mp
+import os
+import resource
+import sqlite3
+import time
+import numpy as np
+import yaml
+
+import db
+from soundfile import SoundFile
+from scoring import CombineRule, ScoreHistory, Smoothing
+from utils import (
+    Settings,
+    defaultSettings,
+    getScoreByNames,
+    readSettings,
+    resolveRecordingPath,
+    scoreDictToList,
+    scoreHistorySize,
+    scoreNames,
+)
+
+# a detection within this many seconds of a labeled bark counts as a hit
+matchTolerance = 1.0
+# detections closer together than this are merged into one event
+eventGap = 2.0
+
+
+def loadLabels(path: str) -> dict:
+    labels = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            onset = float(row["onset"])
+            offset = float(row["offset"]) if row.get("offset") else onset
+            labels.setdefault(row["name"], []).append((onset, offset))
+    return labels
+
+
+def loadCorpus(recordingPath: str, labels: dict) -> list:
+    """Returns (name, path, labels) for every recording known to audio_files."""
+    dbConn = sqlite3.connect(db.dbname)
+    db.createTables(dbConn)
+    rows = db.getRecordingsSince(dbConn, 0.0)
+    dbConn.close()
+
+    corpus = []
+    for name, *_ in rows:
+        path = os.path.join(recordingPath, f"{name}.wav")
+        if os.path.isfile(path):
+            corpus.append((name, path, sorted(labels.get(name, []))))
+    return corpus
+
+
+def baseSettings() -> dict:
+    loaded = readSettings()
+    return {
+        setting: loaded.get(setting.value, defaultSettings[setting.value])
+        for setting in Settings
+    }
+
+
+def detectFile(classifier, path: str, settings: dict) -> tuple[list, float]:
+    """Runs the window/score/decision loop over one file.
+
+    Returns:
+      The times (seconds from file start) of windows that detected a bark,
+      and the audio duration in seconds.
+    """
+    from mediapipe.tasks.python.components import containers
+
+    with SoundFile(path) as f:
+        sampleRate = f.samplerate
+        audio = f.read(dtype="float32", always_2d=True)
+
+    size = settings[Settings.REC_BUFFER_SIZE]
+    overlap = min(max(float(settings[Settings.INFERENCE_OVERLAP]), 0.0), 0.95)
+    hop = max(1, int(size * (1.0 - overlap)))
+    channels = audio.shape[1]
+
+    audioData = containers.AudioData(
+        size, containers.AudioDataFormat(channels, sampleRate)
+    )
+    window = np.zeros([size, channels], dtype=np.float32)
+    history = ScoreHistory(len(scoreNames), scoreHistorySize)
+    detections = []
+
+    for end in range(hop, audio.shape[0] + 1, hop):
+        # same left zero padding as the live ring buffer after startup
+        start = max(0, end - size)
+        window.fill(0)
+        window[size - (end - start) :] = audio[start:end]
+        audioData.load_from_array(window)
+
+        results = classifier.classify(audioData)
+        if not results:
+            continue
+        history.push(
+            scoreDictToList(getScoreByNames(results[-1])),
+            settings[Settings.EMA_ALPHA],
+        )
+        (detected, _) = history.detect(
+            settings[Settings.BARK_THRESHOLD],
+            CombineRule(settings[Settings.COMBINE_RULE]),
+            Smoothing(settings[Settings.SMOOTHING_METHOD]),
+            settings[Settings.SMOOTHING_WINDOW],
+            settings[Settings.VOTE_K],
+        )
+        if detected:
+            detections.append(end / sampleRate)
+
+    return (detections, audio.shape[0] / sampleRate)
+
+
+def toEvents(detections: list) -> list:
+    events = []
+    for t in detections:
+        if events and t - events[-1][1] <= eventGap:
+            events[-1][1] = t
+        else:
+            events.append([t, t])
+    return events
+
+
+def scoreFile(detections: list, labels: list) -> dict:
+    events = toEvents(detections)
+    matchedEvents = 0
+    for start, end in events:
+        if any(
+            start <= offset + matchTolerance and end >= onset - matchTolerance
+            for onset, offset in labels
+        ):
+            matchedEvents += 1
+
+    hits = 0
+    latencies = []
+    for onset, offset in labels:
+        first = next(
+            (
+                t
+                for t in detections
+                # t is the window end, a window that saw the onset ends after it
+                if onset <= t <= offset + matchTolerance
+            ),
+            None,
+        )
+        if first is not None:
+            hits += 1
+            latencies.append(first - onset)
+
+    return {
+        "events": len(events),
+        "matched_events": matchedEvents,
+        "labels": len(labels),
+        "hits": hits,
+        "latencies": latencies,
+    }
+
+
+def runConfig(job: tuple) -> dict:
+    """Replays the whole corpus with one configuration, in a worker process."""
+    from mediapipe.tasks import python
+    from mediapipe.tasks.python import audio
+
+    (overrides, corpus, model) = job
+    settings = baseSettings()
+    for key, value in overrides.items():
+        settings[Settings(key)] = value
+
+    options = audio.AudioClassifierOptions(
+        base_options=python.BaseOptions(
+            model_asset_path=settings[Settings.MODEL_PATH] or model
+        ),
+        running_mode=audio.RunningMode.AUDIO_CLIPS,
+        max_results=4,
+        score_threshold=0.0,
+    )
+
+    totals = {"events": 0, "matched_events": 0, "labels": 0, "hits": 0}
+    latencies = []
+    audioSeconds = 0.0
+    cpuStart = time.process_time()
+    with audio.AudioClassifier.create_from_options(options) as classifier:
+        for _, path, labels in corpus:
+            (detections, duration) = detectFile(classifier, path, settings)
+            audioSeconds += duration
+            result = scoreFile(detections, labels)
+            latencies += result.pop("latencies")
+            for key in totals:
+                totals[key] += result[key]
+    cpuSeconds = time.process_time() - cpuStart
+
+    return {
+        "config": overrides,
+        "precision": totals["matched_events"] / totals["events"]
+        if totals["events"]
+        else None,
+        "recall": totals["hits"] / totals["labels"] if totals["labels"] else None,
+        "median_onset_latency": float(np.median(latencies)) if latencies else None,
+        "cpu_seconds_per_audio_hour": cpuSeconds / audioSeconds * 3600
+        if audioSeconds
+        else None,
+        # ru_maxrss is in KiB on Linux
+        "peak_memory_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "audio_hours": audioSeconds / 3600,
+    }
+
+
+def parseSweep(sweeps: list) -> list:
+    """Turns ["key=a,b", ...] into the cartesian product of override dicts."""
+    axes = []
+    for sweep in sweeps:
+        key, values = sweep.split("=", 1)
+        Settings(key)  # fail early on unknown settings
+        axes.append([(key, yaml.safe_load(v)) for v in values.split(",")])
+    return [dict(combo) for combo in itertools.product(*axes)] or [{}]
+
+
+def formatValue(value) -> str:
+    if value is None:
+        return "-"
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay labeled recordings")
+    parser.add_argument("--labels", required=True, help="CSV with name,onset,offset")
+    parser.add_argument("--recordings", help="recording directory (default from settings)")
+    parser.add_argument("--model", default="yamnet.tflite")
+    parser.add_argument(
+        "--sweep", action="append", default=[], help="setting=v1,v2 (repeatable)"
+    )
+    parser.add_argument("--configs", help="YAML list of setting override dicts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    configs = parseSweep(args.sweep)
+    if args.configs:
+        with open(args.configs) as f:
+            configs = yaml.safe_load(f)
+
+    recordingPath = args.recordings or resolveRecordingPath(
+        baseSettings()[Settings.RECORDING_FILE_PATH]
+    )
+    corpus = loadCorpus(recordingPath, loadLabels(args.labels))
+    print(f"replaying {len(corpus)} recordings with {len(configs)} configurations")
+
+    # a fresh spawned process per configuration, so peak memory and the
+    # classifier are never shared between configurations
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(min(args.workers, len(configs)), maxtasksperchild=1) as pool:
+        report = pool.map(
+            runConfig, [(c, corpus, args.model) for c in configs], chunksize=1
+        )
+
+    columns = [
+        "precision",
+        "recall",
+        "median_onset_latency",
+        "cpu_seconds_per_audio_hour",
+        "peak_memory_mib",
+    ]
+    print("\t".join(["config"] + columns))
+    for row in sorted(report, key=lambda r: r["cpu_seconds_per_audio_hour"] or 0):
+        print("\t".join([json.dumps(row["config"])] + [formatValue(row[c]) for c in columns]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
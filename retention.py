@@ -0,0 +1,241 @@
+"""A module to enforce age and disk quota policies on recordings and barks."""
+
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+import db
+from soundfile import SoundFile
+from utils import Settings
+
+# pause between individual deletions/transcodes so the job never saturates I/O
+stepPause = 0.5
+# rows folded per compaction step and pages freed per incremental vacuum step
+compactBatch = 5000
+vacuumPages = 256
+secondsPerDay = 24 * 60 * 60
+# frames read per downsampling step
+readBlockSize = 64 * 1024
+
+
+def downsampleRecording(wavPath: str, targetRate: int) -> bool:
+    """Rewrites a recording in place at `targetRate`, mono, block by block.
+
+    Every block is resampled together with enough neighbouring input for the
+    filter to settle, and only the part that input fully covers is kept, so
+    the output matches resampling the whole file at once while memory stays
+    at a few blocks.
+
+    Returns:
+      False if the recording is already at or below the target rate.
+    """
+    from scipy.signal import resample_poly
+
+    tmpPath = wavPath + ".tmp"
+    with SoundFile(wavPath) as f:
+        if f.samplerate <= targetRate:
+            return False
+        gcd = np.gcd(f.samplerate, targetRate)
+        (up, down) = (targetRate // gcd, f.samplerate // gcd)
+        # input samples the resample_poly filter reaches on either side,
+        # rounded to whole output samples
+        context = down * -(-10 * max(up, down) // (up * down))
+        step = down * max(1, readBlockSize // down)
+
+        with SoundFile(
+            tmpPath,
+            "w",
+            samplerate=targetRate,
+            channels=1,
+            subtype="PCM_16",
+            format="WAV",
+        ) as out:
+
+            def emit(segment: np.ndarray, inputFrames: int) -> None:
+                resampled = resample_poly(segment, up, down)
+                start = context * up // down
+                count = -(-inputFrames * up // down)
+                out.write(np.clip(resampled[start : start + count], -1.0, 1.0))
+
+            # the file is zero padded on both ends, as resample_poly does
+            pending = np.zeros(context, dtype=np.float32)
+            for block in f.blocks(blocksize=step, dtype="float32", always_2d=True):
+                pending = np.concatenate((pending, block.mean(axis=1)))
+                n = (pending.shape[0] - 2 * context) // step * step
+                if n > 0:
+                    emit(pending[: n + 2 * context], n)
+                    pending = pending[n:]
+
+            remaining = pending.shape[0] - context
+            if remaining > 0:
+                emit(np.pad(pending, (0, context + -remaining % down)), remaining)
+    os.replace(tmpPath, wavPath)
+    return True
+
+
+class RetentionManager(object):
+    """Runs the retention policies in a throttled background thread.
+
+    Policies, all read from the settings on every pass:
+      - recordings older than `retain_raw_days` are downsampled to
+        `retain_downsample_rate`.
+      - recordings older than `retain_delete_days` are deleted.
+      - the oldest recordings are deleted while the directory is above
+        `recording_quota_bytes`.
+      - barks older than `bark_compact_days` are folded into per-minute rows
+        of `bark_aggregates`.
+    A value of 0 disables a policy.
+    """
+
+    def __init__(
+        self,
+        settings: dict,
+        isBusy=lambda: False,
+        recordingChanged=lambda name, wavPath: None,
+    ) -> None:
+        """Creates a RetentionManager instance.
+
+        Args:
+          settings: The detector's live settings dict.
+          isBusy: Callable returning True while capture is writing to disk.
+            The job waits between steps until it returns False.
+          recordingChanged: Called with the name and path of a recording
+            after it was downsampled, and with a None path after it was
+            deleted, so its thumbnails can be refreshed.
+        """
+        self._settings = settings
+        self._isBusy = isBusy
+        self._recordingChanged = recordingChanged
+        self._vacuumWarned = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _wait(self, seconds: float) -> bool:
+        """Sleeps, then blocks while capture is busy. Returns False on stop."""
+        if self._stop.wait(seconds):
+            return False
+        while self._isBusy():
+            if self._stop.wait(1.0):
+                return False
+        return True
+
+    def _run(self) -> None:
+        try:
+            # lowest CPU priority for this thread only (Linux per-thread nice)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while self._wait(self._settings[Settings.RETENTION_INTERVAL]):
+            try:
+                self.runOnce()
+            except Exception as e:
+                print(f"retention pass failed: {e}")
+
+    def runOnce(self) -> None:
+        # the detector created the tables before it started this job
+        dbConn = sqlite3.connect(db.dbname)
+        try:
+            self.applyAgePolicies(dbConn)
+            self.enforceQuota(dbConn)
+            self.compactBarks(dbConn)
+            self.vacuum(dbConn)
+        finally:
+            dbConn.close()
+
+    def recordingPath(self, name: str) -> str:
+        return os.path.join(self._settings[Settings.RECORDING_FILE_PATH], f"{name}.wav")
+
+    def removeRecording(self, dbConn: sqlite3.Connection, name: str) -> None:
+        try:
+            os.remove(self.recordingPath(name))
+        except FileNotFoundError:
+            pass
+        db.deleteRecording(dbConn, name)
+        self._recordingChanged(name, None)
+
+    def applyAgePolicies(self, dbConn: sqlite3.Connection) -> None:
+        now = time.time()
+        deleteDays = self._settings[Settings.RETAIN_DELETE_DAYS]
+        if deleteDays > 0:
+            for name, *_ in db.getRecordingsBefore(
+                dbConn, now - deleteDays * secondsPerDay
+            ):
+                if not self._wait(stepPause):
+                    return
+                self.removeRecording(dbConn, name)
+
+        rawDays = self._settings[Settings.RETAIN_RAW_DAYS]
+        targetRate = self._settings[Settings.RETAIN_DOWNSAMPLE_RATE]
+        if rawDays > 0 and targetRate > 0:
+            for name, *_ in db.getRecordingsBefore(dbConn, now - rawDays * secondsPerDay):
+                path = self.recordingPath(name)
+                if not os.path.isfile(path):
+                    continue
+                if not self._wait(0):
+                    return
+                if downsampleRecording(path, targetRate):
+                    self._recordingChanged(name, path)
+                    if not self._wait(stepPause):
+                        return
+
+    def enforceQuota(self, dbConn: sqlite3.Connection) -> None:
+        quota = self._settings[Settings.RECORDING_QUOTA_BYTES]
+        if quota <= 0:
+            return
+
+        recordings = db.getRecordingsBefore(dbConn, time.time())
+        sizes = []
+        for name, *_ in recordings:
+            try:
+                sizes.append(os.path.getsize(self.recordingPath(name)))
+            except OSError:
+                sizes.append(0)
+
+        total = sum(sizes)
+        # oldest first, getRecordingsBefore is ordered by timestamp
+        for (name, *_), size in zip(recordings, sizes):
+            if total <= quota:
+                break
+            if not self._wait(stepPause):
+                return
+            self.removeRecording(dbConn, name)
+            total -= size
+
+    def compactBarks(self, dbConn: sqlite3.Connection) -> None:
+        compactDays = self._settings[Settings.BARK_COMPACT_DAYS]
+        if compactDays <= 0:
+            return
+
+        before = time.time() - compactDays * secondsPerDay
+        while db.compactBarks(dbConn, before, compactBatch) > 0:
+            if not self._wait(stepPause):
+                return
+
+    def vacuum(self, dbConn: sqlite3.Connection) -> None:
+        cur = dbConn.cursor()
+        if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # switching needs a full VACUUM, which holds the write lock long
+            # enough for the detector's inserts to fail, so it is left to an
+            # offline run. Until then freed pages are reused, not released.
+            if not self._vacuumWarned:
+                print(
+                    "database is not in incremental auto_vacuum mode, run "
+                    "`PRAGMA auto_vacuum = INCREMENTAL; VACUUM;` while the "
+                    "detector is stopped to let retention shrink it"
+                )
+                self._vacuumWarned = True
+            return
+
+        while cur.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+            if not self._wait(stepPause):
+                return
+            cur.execute(f"PRAGMA incremental_vacuum({vacuumPages})").fetchall()
@@ -0,0 +1,126 @@
+"""A module to switch between settings profiles on a time schedule."""
+
+import datetime
+import threading
+
+dayNames = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+# how often the schedule is checked, and how early a profile is prepared
+checkInterval = 15.0
+prepareLead = 60.0
+
+
+def parseTime(value: str) -> int:
+    """Parses "HH:MM" into minutes after midnight ("24:00" is allowed)."""
+    hours, minutes = str(value).split(":")
+    total = int(hours) * 60 + int(minutes)
+    if not 0 <= total <= 24 * 60:
+        raise ValueError(f"invalid time of day {value!r}")
+    return total
+
+
+def entryActive(entry: dict, now: datetime.datetime) -> bool:
+    """Checks one schedule entry.
+
+    An entry has optional "start"/"end" ("HH:MM", default all day) and
+    optional "days" (e.g. ["sat", "sun"]). A window whose end is before its
+    start runs past midnight and belongs to the day it started on.
+    """
+    start = parseTime(entry.get("start", "00:00"))
+    end = parseTime(entry.get("end", "24:00"))
+    days = entry.get("days")
+    minute = now.hour * 60 + now.minute
+
+    def onDay(weekday: int) -> bool:
+        return not days or dayNames[weekday] in [d.lower()[:3] for d in days]
+
+    if start < end:
+        return start <= minute < end and onDay(now.weekday())
+    if minute >= start:
+        return onDay(now.weekday())
+    if minute < end:
+        return onDay((now.weekday() - 1) % 7)
+    return False
+
+
+def activeProfile(schedule: list, now: datetime.datetime) -> str | None:
+    """Returns the profile of the first matching entry, or None for the base settings."""
+    for entry in schedule or []:
+        try:
+            if entryActive(entry, now):
+                return entry.get("profile")
+        except (ValueError, AttributeError) as e:
+            print(f"ignoring invalid schedule entry {entry}: {e}")
+    return None
+
+
+class ProfileScheduler(object):
+    """Switches the active profile when the schedule says so.
+
+    The upcoming profile is prepared `prepareLead` seconds before its window
+    opens, so expensive resources (e.g. a different model) are already built
+    when the switch happens and capture never waits on them.
+    """
+
+    def __init__(self, getSchedule, prepare, apply, discard=None) -> None:
+        """Creates a ProfileScheduler instance.
+
+        Args:
+          getSchedule: Callable returning the current schedule list.
+          prepare: Callable taking a profile name (None for the base settings)
+            and returning an opaque prepared object.
+          apply: Callable taking the profile name and the prepared object.
+          discard: Callable releasing a prepared object that is dropped
+            without being applied (the schedule changed, or on stop).
+        """
+        self._getSchedule = getSchedule
+        self._prepare = prepare
+        self._apply = apply
+        self._discard = discard
+        self._current = None
+        self._prepared = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def current(self) -> str | None:
+        return self._current
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.check(datetime.datetime.now())
+            except Exception as e:
+                print(f"profile switch failed: {e}")
+            if self._stop.wait(checkInterval):
+                self._discardPrepared()
+                return
+
+    def _discardPrepared(self, keep: tuple = ()) -> None:
+        for name in [n for n in self._prepared if n not in keep]:
+            prepared = self._prepared.pop(name)
+            if self._discard is not None:
+                self._discard(prepared)
+
+    def check(self, now: datetime.datetime) -> None:
+        schedule = self._getSchedule()
+        target = activeProfile(schedule, now)
+        upcoming = activeProfile(schedule, now + datetime.timedelta(seconds=prepareLead))
+
+        # anything prepared for a window the schedule no longer has
+        self._discardPrepared(keep=(target, upcoming))
+        if upcoming != target and upcoming not in self._prepared:
+            self._prepared[upcoming] = self._prepare(upcoming)
+
+        if target != self._current:
+            prepared = self._prepared.pop(target, None)
+            if prepared is None:
+                prepared = self._prepare(target)
+            self._apply(target, prepared)
+            print(f"switched to settings profile {target or 'default'}")
+            self._current = target
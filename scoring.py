@@ -0,0 +1,149 @@
+"""A module to smooth and combine classifier scores over time."""
+
+from enum import Enum
+import numpy as np
+
+
+class Smoothing(Enum):
+    NONE = "none"
+    EMA = "ema"
+    MEDIAN = "median"
+    VOTE = "vote"
+
+
+class CombineRule(Enum):
+    FIRST = "first"  # only the first tracked class ("Dog")
+    MAX = "max"
+    MEAN = "mean"
+    NOISY_OR = "noisy_or"  # 1 - prod(1 - p), any class can push it up
+
+
+def combineScores(scores: np.ndarray, rule: CombineRule) -> np.ndarray:
+    """Combines per-class scores along the last axis into one score.
+
+    Args:
+      scores: Array of shape [..., num_classes].
+      rule: How to combine the tracked classes.
+
+    Returns:
+      An array of shape [...] holding the combined scores.
+    """
+    if rule == CombineRule.FIRST:
+        return scores[..., 0]
+    elif rule == CombineRule.MAX:
+        return scores.max(axis=-1)
+    elif rule == CombineRule.MEAN:
+        return scores.mean(axis=-1)
+    elif rule == CombineRule.NOISY_OR:
+        return 1.0 - np.prod(1.0 - np.clip(scores, 0.0, 1.0), axis=-1)
+
+    raise ValueError(f"unknown combine rule {rule}")
+
+
+class ScoreHistory(object):
+    """A fixed-size ring of the most recent per-class score vectors."""
+
+    def __init__(self, num_classes: int, size: int) -> None:
+        """Creates a ScoreHistory instance.
+
+        Args:
+          num_classes: Number of classes in each score vector.
+          size: Number of score vectors kept in the ring.
+
+        Raises:
+          ValueError: if any of the arguments is non-positive.
+        """
+        if num_classes <= 0:
+            raise ValueError("num_classes must be positive.")
+        if size <= 0:
+            raise ValueError("size must be positive.")
+
+        self._history = np.zeros([size, num_classes], dtype=np.float32)
+        self._ema = np.zeros(num_classes, dtype=np.float32)
+        self._size = size
+        self._index = 0
+        self._count = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return min(self._count, self._size)
+
+    def clear(self) -> None:
+        self._history.fill(0)
+        self._ema.fill(0)
+        self._index = 0
+        self._count = 0
+
+    def push(self, scores, ema_alpha: float = 0.5) -> None:
+        """Adds the score vector of the newest window.
+
+        Args:
+          scores: Sequence of per-class scores.
+          ema_alpha: Weight of the newest window in the running EMA.
+        """
+        scores = np.asarray(scores, dtype=np.float32)
+        self._history[self._index] = scores
+        self._index = (self._index + 1) % self._size
+
+        if self._count == 0:
+            self._ema[:] = scores
+        else:
+            self._ema += ema_alpha * (scores - self._ema)
+        self._count += 1
+
+    def window(self, n: int = 0) -> np.ndarray:
+        """Returns the last `n` score vectors, oldest first.
+
+        A non-positive `n` returns everything currently held.
+        """
+        held = len(self)
+        if n <= 0 or n > held:
+            n = held
+        idx = (self._index - n + np.arange(n)) % self._size
+        return self._history[idx]
+
+    def latest(self) -> np.ndarray:
+        return self._history[(self._index - 1) % self._size]
+
+    def smoothed(self, method: Smoothing, n: int) -> np.ndarray:
+        """Returns the per-class smoothed scores over the last `n` windows."""
+        if self._count == 0:
+            return np.zeros(self._history.shape[1], dtype=np.float32)
+
+        if method == Smoothing.EMA:
+            return self._ema.copy()
+        elif method == Smoothing.MEDIAN:
+            return np.median(self.window(n), axis=0)
+
+        return self.latest().copy()
+
+    def detect(
+        self,
+        threshold: float,
+        rule: CombineRule = CombineRule.FIRST,
+        method: Smoothing = Smoothing.NONE,
+        n: int = 1,
+        k: int = 1,
+    ) -> tuple[bool, float]:
+        """Decides whether the recent windows contain the target sound.
+
+        For `Smoothing.VOTE` at least `k` of the last `n` windows must have a
+        combined score at or above `threshold`. Every other method smooths
+        the per-class scores first and compares the combined result.
+
+        Returns:
+          A tuple of the decision and the confidence that was compared.
+        """
+        if self._count == 0:
+            return (False, 0.0)
+
+        if method == Smoothing.VOTE:
+            combined = combineScores(self.window(n), rule)
+            hits = combined >= threshold
+            return (int(hits.sum()) >= k, float(combined[-1]))
+
+        confidence = float(combineScores(self.smoothed(method, n), rule))
+        return (confidence >= threshold, confidence)
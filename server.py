@@ -1,10 +1,39 @@
+import argparse
+import datetime
+import json
 import math
 import multiprocessing as mp
-import sounddevice as sd
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 
-from detector import runDetector
-from flask import Flask, request
-from utils import checkSettingsFile, readSettings, updateSetting, Settings
+import db
+from archive import streamTar, readTar
+from clips import (
+    dayBounds,
+    defaultAfter,
+    defaultBefore,
+    encodeWav,
+    extractBarks,
+    readClip,
+)
+from detector_client import DetectorClient, ResponseCache
+from flask import Flask, Response, abort, request, send_file, stream_with_context
+from soundfile import SoundFile
+from thumbnails import ThumbnailCache, ThumbnailWorker
+from timeline import TimelineStore
+from supervisor import DetectorSupervisor
+from utils import (
+    checkSettingsFile,
+    readSettings,
+    updateSetting,
+    Settings,
+    resolveRecordingPath,
+    getThumbnailPath,
+    defaultSettings,
+)
 from message import (
     MsgAttr,
     Message,
@@ -18,6 +47,19 @@ from message import (
 
 serverMsgHandler, detectorMsgHandler = createMsgHandlers()
 detectorProcess = mp.Process
+supervisor = None
+detectorClient = DetectorClient(serverMsgHandler)
+responseCache = ResponseCache()
+# builds thumbnails missing from the cache off the request threads
+thumbnailWorker = None
+thumbnailWorkerLock = threading.Lock()
+
+# /detectresult changes every inference, but many clients polling at once
+# can share one answer for a fraction of the inference interval
+resultCacheTtl = 0.1
+# the detector also changes its settings on its own when a scheduled profile
+# switches, so cached settings are only trusted for a few seconds
+settingsCacheTtl = 5.0
 
 app = Flask(__name__)
 
@@ -25,14 +67,19 @@ app = Flask(__name__)
 @app.route("/detectresult")
 def hello_world():
     if detectorProcess.is_alive():
+        cached = responseCache.get("detectresult")
+        if cached is not None:
+            return cached
+
         msg = Message().setMsgType(MsgType.CMD).setCmd(MsgCmd.GET_RESULT)
-        resp = serverMsgHandler.send(msg, True, 1)
-        print(resp)
+        resp = detectorClient.request(msg)
+        app.logger.debug(resp.msg)
         if (
             resp.hasAttr(MsgAttr.MSG_TYPE)
             and resp.checkMsgType(MsgType.RESPONSE)
             and resp.checkRespType(MsgRespType.CLASS_DATA)
         ):
+            responseCache.set("detectresult", resp.getData(), resultCacheTtl)
             return resp.getData()
         else:
             return "no data"
@@ -43,9 +90,10 @@ def hello_world():
 @app.route("/quit")
 def quit_detector():
     if detectorProcess.is_alive():
+        responseCache.invalidate()
         msg = Message().setMsgType(MsgType.CMD).setCmd(MsgCmd.QUIT)
-        resp = serverMsgHandler.send(msg, True, 1)
-        print(resp)
+        resp = detectorClient.request(msg)
+        app.logger.debug(resp.msg)
         if (
             resp.hasAttr(MsgAttr.MSG_TYPE)
             and resp.checkMsgType(MsgType.RESPONSE)
@@ -62,16 +110,23 @@ def quit_detector():
 @app.route("/detectorsetting", methods=["GET"])
 def get_detector_settings():
     if detectorProcess.is_alive():
+        cached = responseCache.get("detectorsetting")
+        if cached is not None:
+            return cached
+
+        generation = responseCache.generation("detectorsetting")
         msg = Message().setMsgType(MsgType.CMD).setCmd(MsgCmd.GET_SETTINGS)
-        resp = serverMsgHandler.send(msg, True, 1)
-        print(resp)
+        resp = detectorClient.request(msg)
+        app.logger.debug(resp.msg)
         if (
             resp.hasAttr(MsgAttr.MSG_TYPE)
             and resp.checkMsgType(MsgType.RESPONSE)
             and resp.checkRespType(MsgRespType.STATUS)
             and resp.checkStatus(MsgStatus.SUCCESS)
         ):
-            return convertSettingDict(resp.getData())
+            settings = convertSettingDict(resp.getData())
+            responseCache.set("detectorsetting", settings, settingsCacheTtl, generation)
+            return settings
         else:
             return "detector get settings failed"
     else:
@@ -88,8 +143,11 @@ def set_detector_setting():
             .setCmd(MsgCmd.UPDATE_SETTING)
             .setData({data.get("settingName"): data.get("settingVal")})
         )
-        resp = serverMsgHandler.send(msg, True, 1)
-        print(resp)
+        resp = detectorClient.request(msg)
+        # after the round trip, so a read racing the update can't cache the
+        # old settings again
+        responseCache.invalidate("detectorsetting")
+        app.logger.debug(resp.msg)
         if (
             resp.hasAttr(MsgAttr.MSG_TYPE)
             and resp.checkMsgType(MsgType.RESPONSE)
@@ -97,16 +155,504 @@ def set_detector_setting():
             and resp.checkStatus(MsgStatus.SUCCESS)
         ):
             return convertSettingDict(resp.getData())
+        elif resp.hasAttr(MsgAttr.STATUS) and resp.checkStatus(MsgStatus.ERROR):
+            # rejected by the detector's validation
+            return f"detector setting failed: {resp.getData()}", 400
         else:
             return "detector setting failed"
     else:
         return "detector not started"
 
 
+@app.route("/detectorstatus", methods=["GET"])
+def get_detector_status():
+    if detectorProcess.is_alive():
+        msg = Message().setMsgType(MsgType.CMD).setCmd(MsgCmd.GET_STATUS)
+        resp = detectorClient.request(msg)
+        app.logger.debug(resp.msg)
+        if (
+            resp.hasAttr(MsgAttr.MSG_TYPE)
+            and resp.checkMsgType(MsgType.RESPONSE)
+            and resp.checkRespType(MsgRespType.STATUS)
+            and resp.checkStatus(MsgStatus.SUCCESS)
+        ):
+            return resp.getData()
+        else:
+            return "detector get status failed"
+    else:
+        return "detector not started"
+
+
+@app.route("/profile", methods=["POST"])
+def start_profile():
+    """Starts profiling the detector for `seconds` (at most 120).
+
+    `interval` is the stack sampling period in seconds, default 0.01.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get("seconds", 10))
+        interval = float(data.get("interval", 0.01))
+    except (TypeError, ValueError):
+        return {"status": "error", "message": "seconds and interval must be numbers"}, 400
+    # NaN fails every comparison, inf would never end the session
+    if not (0 < seconds < math.inf and 0 < interval < math.inf):
+        return {"status": "error", "message": "seconds and interval must be positive"}, 400
+
+    if detectorProcess.is_alive():
+        msg = (
+            Message()
+            .setMsgType(MsgType.CMD)
+            .setCmd(MsgCmd.PROFILE)
+            .setData({"seconds": seconds, "interval": interval})
+        )
+        resp = detectorClient.request(msg)
+        app.logger.debug(resp.msg)
+        if resp.checkRespType(MsgRespType.STATUS) and resp.checkStatus(MsgStatus.SUCCESS):
+            return resp.getData()
+        else:
+            return {"status": "error", "message": resp.getData() or "profile failed"}, 409
+    else:
+        return "detector not started"
+
+
+@app.route("/profile", methods=["GET"])
+def get_profile():
+    """The latest profile: `format=collapsed` for flamegraph.pl/speedscope,
+    `format=trace` for chrome://tracing or Perfetto, JSON with both by default.
+    """
+    if detectorProcess.is_alive():
+        msg = Message().setMsgType(MsgType.CMD).setCmd(MsgCmd.PROFILE)
+        resp = detectorClient.request(msg)
+        if not (
+            resp.checkRespType(MsgRespType.STATUS) and resp.checkStatus(MsgStatus.SUCCESS)
+        ):
+            return {"status": "error", "message": resp.getData() or "no profile"}, 404
+
+        # the detector only sends the paths of the result files
+        status = resp.getData()
+        result = status.get("result")
+        fmt = request.args.get("format")
+        if result is None:
+            return status, 202 if status["running"] else 404
+        collapsedPath = result.pop("collapsed_path")
+        tracePath = result.pop("trace_path")
+        if not (os.path.isfile(collapsedPath) and os.path.isfile(tracePath)):
+            return {"status": "error", "message": "profile result is gone"}, 404
+        if fmt == "collapsed":
+            return send_file(collapsedPath, mimetype="text/plain")
+        if fmt == "trace":
+            return send_file(
+                tracePath,
+                mimetype="application/json",
+                as_attachment=True,
+                download_name="detector-trace.json",
+            )
+        with open(collapsedPath, "r") as f:
+            result["collapsed"] = f.read().rstrip("\n")
+        with open(tracePath, "r") as f:
+            result["trace"] = json.load(f)
+        return status
+    else:
+        return "detector not started"
+
+
+@app.route("/detectorsupervisor", methods=["GET"])
+def get_detector_supervisor():
+    """Restart counts and recovery times, also while the detector is down."""
+    if supervisor is None:
+        return "detector not supervised"
+    return supervisor.status()
+
+
+@app.route("/calibration", methods=["GET"])
+def get_calibration():
+    if detectorProcess.is_alive():
+        msg = (
+            Message()
+            .setMsgType(MsgType.CMD)
+            .setCmd(MsgCmd.GET_CALIBRATION)
+            .setData({"rate": request.args.get("rate", type=float)})
+        )
+        resp = detectorClient.request(msg)
+        app.logger.debug(resp.msg)
+        if (
+            resp.hasAttr(MsgAttr.MSG_TYPE)
+            and resp.checkMsgType(MsgType.RESPONSE)
+            and resp.checkRespType(MsgRespType.STATUS)
+            and resp.checkStatus(MsgStatus.SUCCESS)
+        ):
+            return resp.getData()
+        else:
+            return "detector get calibration failed"
+    else:
+        return "detector not started"
+
+
+def getRecordingPath():
+    settings = readSettings()
+    return resolveRecordingPath(settings.get(Settings.RECORDING_FILE_PATH.value, ""))
+
+
+@app.route("/export", methods=["GET"])
+def export_data():
+    """Streams every bark and recording added after the `since` watermark.
+
+    The watermark is "<last audio_files id>:<last barks id>" of the previous
+    export, taken from the snapshot the rows were read from, so a row
+    written after a snapshot is part of the next export whatever its
+    timestamp. The archive starts with `export.json`, holding the rows, the
+    positions of the barks in the exported recordings, their features, all
+    bark aggregates and the new watermark, followed by the recordings under
+    `recordings/`.
+    """
+    try:
+        (recordingsAfter, barksAfter) = (
+            int(part) for part in request.args.get("since", "0:0").split(":")
+        )
+    except ValueError:
+        return {
+            "status": "error",
+            "message": "since must be <recording id>:<bark id>",
+        }, 400
+    includeAudio = request.args.get("audio", "1") != "0"
+    recordingPath = getRecordingPath()
+
+    # take a consistent snapshot, the detector may be writing right now
+    fd, snapshotPath = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    dbConn = sqlite3.connect(db.dbname)
+    snapshotConn = db.snapshot(dbConn, snapshotPath)
+    dbConn.close()
+    (recordingsUpTo, barksUpTo) = db.getExportWatermark(snapshotConn)
+    recordings = db.getRecordingsAfterIdUpTo(snapshotConn, recordingsAfter, recordingsUpTo)
+    barks = db.getBarksAfterIdUpTo(snapshotConn, barksAfter, barksUpTo)
+    names = [name for name, *_ in recordings]
+    # barks exported while their recording was still being written had no
+    # position yet
+    positions = db.getBarkPositionsOf(snapshotConn, names)
+    features = db.getRecordingFeaturesOf(snapshotConn, names)
+    aggregates = db.getBarkAggregates(snapshotConn)
+    snapshotConn.close()
+    os.remove(snapshotPath)
+
+    watermark = f"{max(recordingsUpTo, recordingsAfter)}:{max(barksUpTo, barksAfter)}"
+    meta = {
+        "since": f"{recordingsAfter}:{barksAfter}",
+        "watermark": watermark,
+        "exported_at": time.time(),
+        "audio_files": recordings,
+        "barks": barks,
+        "bark_positions": positions,
+        "recording_features": features,
+        "bark_aggregates": aggregates,
+    }
+
+    def entries():
+        yield ("export.json", json.dumps(meta).encode())
+        if includeAudio:
+            for name, *_ in recordings:
+                yield (
+                    f"recordings/{name}.wav",
+                    os.path.join(recordingPath, f"{name}.wav"),
+                )
+
+    return Response(
+        stream_with_context(streamTar(entries())),
+        mimetype="application/x-tar",
+        headers={
+            "Content-Disposition": "attachment; filename=export-{}.tar".format(
+                watermark.replace(":", "-")
+            ),
+            "X-Export-Watermark": str(watermark),
+        },
+    )
+
+
+@app.route("/import", methods=["POST"])
+def import_data():
+    """Bulk loads an archive produced by `/export` into this instance."""
+    recordingPath = getRecordingPath()
+    os.makedirs(recordingPath, exist_ok=True)
+    meta = None
+    filesWritten = 0
+
+    for member, f in readTar(request.stream):
+        if member.name == "export.json":
+            meta = json.load(f)
+        elif member.name.startswith("recordings/"):
+            name = os.path.basename(member.name)
+            target = os.path.join(recordingPath, name)
+            if os.path.exists(target):
+                continue
+            # write to a temp name first so a broken upload leaves nothing behind
+            with open(target + ".part", "wb") as out:
+                while chunk := f.read(64 * 1024):
+                    out.write(chunk)
+            os.replace(target + ".part", target)
+            filesWritten += 1
+
+    if meta is None:
+        return {"status": "error", "message": "export.json missing"}, 400
+
+    dbConn = sqlite3.connect(db.dbname)
+    recordingsAdded = db.bulkInsertRecordings(dbConn, meta["audio_files"])
+    barksAdded = db.bulkInsertBarks(dbConn, meta["barks"])
+    # archives from before these were exported don't have them
+    db.bulkSetBarkPositions(dbConn, meta.get("bark_positions", []))
+    db.bulkInsertRecordingFeatures(dbConn, meta.get("recording_features", []))
+    db.mergeBarkAggregates(dbConn, meta.get("bark_aggregates", []))
+    dbConn.close()
+
+    return {
+        "status": "success",
+        "watermark": meta["watermark"],
+        "audio_files": recordingsAdded,
+        "barks": barksAdded,
+        "files": filesWritten,
+    }
+
+
+@app.route("/timeline", methods=["GET"])
+def get_timeline():
+    """Scores of every window between `start` and `end` (timestamps).
+
+    `points` downsamples to at most that many buckets with `method` (max or
+    mean), `names` is a comma separated subset of the tracked classes. Up to
+    a minute of the newest scores may still be buffered by the detector.
+    """
+    settings = readSettings()
+    path = settings.get(
+        Settings.TIMELINE_PATH.value, defaultSettings[Settings.TIMELINE_PATH.value]
+    )
+    end = request.args.get("end", time.time(), type=float)
+    start = request.args.get("start", end - 3600, type=float)
+    names = request.args.get("names")
+    method = request.args.get("method", "max")
+    if not path:
+        return {"status": "error", "message": "timeline is off"}, 404
+    if method not in ("max", "mean"):
+        return {"status": "error", "message": "method must be max or mean"}, 400
+    points = request.args.get("points", 0, type=int)
+    if points < 0:
+        return {"status": "error", "message": "points must not be negative"}, 400
+
+    (names, times, scores) = TimelineStore(path).query(
+        start,
+        end,
+        names.split(",") if names else None,
+        points,
+        method,
+    )
+    # NaN marks windows that were not classified, JSON has no NaN
+    return {
+        "names": names,
+        "times": times.tolist(),
+        "scores": [
+            [None if math.isnan(v) else round(v, 4) for v in row]
+            for row in scores.tolist()
+        ],
+    }
+
+
+def getThumbnailCache():
+    settings = readSettings()
+    return ThumbnailCache(
+        getThumbnailPath(getRecordingPath()),
+        settings.get(
+            Settings.THUMBNAIL_CACHE_SIZE.value,
+            defaultSettings[Settings.THUMBNAIL_CACHE_SIZE.value],
+        ),
+    )
+
+
+def getThumbnailWorker(cache: ThumbnailCache) -> ThumbnailWorker:
+    """The worker for `cache`, started again if the recording path moved."""
+    global thumbnailWorker
+    with thumbnailWorkerLock:
+        if thumbnailWorker is None or thumbnailWorker.cache.cache_dir != cache.cache_dir:
+            thumbnailWorker = ThumbnailWorker(cache)
+        return thumbnailWorker
+
+
+def lookupRecording(name: str):
+    """Returns the audio_files row for `name`, or aborts with 404.
+
+    Only names known to the database are served, which also keeps
+    requests from reaching outside the recording directory.
+    """
+    dbConn = sqlite3.connect(db.dbname)
+    row = db.getRecordingByName(dbConn, name)
+    dbConn.close()
+    if row is None:
+        abort(404)
+    return row
+
+
+@app.route("/recordings", methods=["GET"])
+def list_recordings():
+    """Lists a day's recordings (`day=YYYY-MM-DD`, default today)."""
+    day = request.args.get("day")
+    try:
+        start = (
+            datetime.datetime.strptime(day, "%Y-%m-%d")
+            if day
+            else datetime.datetime.combine(datetime.date.today(), datetime.time())
+        )
+    except ValueError:
+        return {"status": "error", "message": "day must be YYYY-MM-DD"}, 400
+    end = start + datetime.timedelta(days=1)
+
+    dbConn = sqlite3.connect(db.dbname)
+    rows = db.getRecordingsBetween(dbConn, start.timestamp(), end.timestamp())
+    dbConn.close()
+
+    cache = getThumbnailCache()
+    return {
+        "audio_files": [
+            {
+                "name": name,
+                "timestamp": timestamp,
+                "length": length,
+                "day_id": dayId,
+                "thumbnails": cache.has(name),
+            }
+            for name, timestamp, length, dayId in rows
+        ]
+    }
+
+
+@app.route("/recordings/<name>/features", methods=["GET"])
+def get_recording_features(name):
+    """Mean and max spectral features over the recording's episode."""
+    lookupRecording(name)
+    dbConn = sqlite3.connect(db.dbname)
+    features = db.getRecordingFeatures(dbConn, name)
+    dbConn.close()
+    if features is None:
+        abort(404)
+    return features
+
+
+@app.route("/recordings/<name>/audio", methods=["GET"])
+def get_recording_audio(name):
+    lookupRecording(name)
+    path = os.path.join(getRecordingPath(), f"{name}.wav")
+    if not os.path.isfile(path):
+        abort(404)
+    # conditional=True answers Range requests with 206 partial content, the
+    # file is handed to the WSGI server's file wrapper (sendfile if supported)
+    return send_file(path, mimetype="audio/wav", conditional=True)
+
+
+def sendThumbnail(cache: ThumbnailCache, name: str, path: str, mimetype: str):
+    lookupRecording(name)
+    if not os.path.isfile(path):
+        # evicted or never generated, the worker builds it once and keeps it
+        # cached, the client asks again
+        wavPath = os.path.join(getRecordingPath(), f"{name}.wav")
+        if not os.path.isfile(wavPath):
+            abort(404)
+        getThumbnailWorker(cache).submit(name, wavPath)
+        return {"status": "pending"}, 202, {"Retry-After": "2"}
+    cache.touch(path)
+    return send_file(path, mimetype=mimetype, conditional=True)
+
+
+@app.route("/recordings/<name>/peaks", methods=["GET"])
+def get_recording_peaks(name):
+    cache = getThumbnailCache()
+    return sendThumbnail(cache, name, cache.peaksPath(name), "application/json")
+
+
+@app.route("/recordings/<name>/spectrogram", methods=["GET"])
+def get_recording_spectrogram(name):
+    cache = getThumbnailCache()
+    return sendThumbnail(cache, name, cache.spectrogramPath(name), "image/png")
+
+
+@app.route("/barks/<int:barkId>/clip", methods=["GET"])
+def get_bark_clip(barkId):
+    """A WAV clip from `before` seconds before the bark's onset to `after`
+    seconds after it. `refine=0` uses the start of the inference window.
+
+    The onset's offset in the recording is returned in X-Clip-Onset (seconds).
+    """
+    dbConn = sqlite3.connect(db.dbname)
+    row = db.getBark(dbConn, barkId)
+    dbConn.close()
+    if row is None or row[3] is None:
+        # unknown, or not part of a saved recording
+        abort(404)
+    (_, _, _, name, offset, length) = row
+    path = os.path.join(getRecordingPath(), f"{name}.wav")
+    if not os.path.isfile(path):
+        abort(404)
+
+    with SoundFile(path) as f:
+        (clip, onset) = readClip(
+            f,
+            offset,
+            length,
+            request.args.get("before", defaultBefore, type=float),
+            request.args.get("after", defaultAfter, type=float),
+            request.args.get("refine", "1") != "0",
+        )
+        samplerate = f.samplerate
+    return Response(
+        encodeWav(clip, samplerate),
+        mimetype="audio/wav",
+        headers={
+            "X-Clip-Recording": name,
+            "X-Clip-Onset": str(onset / samplerate),
+        },
+    )
+
+
+@app.route("/clips", methods=["GET"])
+def export_clips():
+    """Streams a tar of every bark clip of a day (`day=YYYY-MM-DD`, default
+    today), cut in parallel, with `clips.json` indexing them at the end.
+    """
+    day = request.args.get("day", datetime.date.today().isoformat())
+    try:
+        (start, end) = dayBounds(day)
+    except ValueError:
+        return {"status": "error", "message": "day must be YYYY-MM-DD"}, 400
+    before = request.args.get("before", defaultBefore, type=float)
+    after = request.args.get("after", defaultAfter, type=float)
+    workers = request.args.get("workers", os.cpu_count() or 1, type=int)
+
+    dbConn = sqlite3.connect(db.dbname)
+    barks = db.getBarkPositionsBetween(dbConn, start, end)
+    dbConn.close()
+    recordingPath = getRecordingPath()
+
+    def entries():
+        index = []
+        for clipFile, data, entry in extractBarks(
+            recordingPath, barks, before, after, workers
+        ):
+            index.append(entry)
+            yield (f"clips/{clipFile}", data)
+        index.sort(key=lambda e: e["timestamp"])
+        yield ("clips.json", json.dumps(index).encode())
+
+    return Response(
+        stream_with_context(streamTar(entries())),
+        mimetype="application/x-tar",
+        headers={"Content-Disposition": f"attachment; filename=clips-{day}.tar"},
+    )
+
+
 def chooseDevice():
     settings = readSettings()
     if settings[Settings.REC_DEVICE_ID.value] != -1:
         return
+    if settings.get(Settings.AUDIO_SOURCE.value, "device") != "device":
+        return
+
+    import sounddevice as sd
 
     deviceList = sd.query_devices()
     print("### Select a recording device to use as a microphone ###")
@@ -114,6 +660,8 @@ def chooseDevice():
     devId = int(input("device id: "))
     settings[Settings.REC_DEVICE_ID.value] = devId
     updateSetting(Settings.REC_DEVICE_ID, devId)
+    # device ids change when devices are plugged in, the name doesn't
+    updateSetting(Settings.REC_DEVICE_NAME, deviceList[devId]["name"])
 
     sampleRate = math.trunc(deviceList[devId]["default_samplerate"])
 
@@ -126,25 +674,68 @@ def chooseDevice():
         updateSetting(Settings.SAMPLE_RATE, sampleRate)
 
 
+def initDatabase():
+    """Creates and migrates the tables once, the routes only read and write rows."""
+    dbConn = sqlite3.connect(db.dbname)
+    db.createTables(dbConn)
+    dbConn.close()
+
+
+def serve(args):
+    initDatabase()
+    if not args.production:
+        app.run(host=args.host, port=args.port)
+        return
+
+    # waitress runs a pool of worker threads in this process, which all share
+    # the detector pipe through detectorClient
+    from waitress import serve as waitressServe
+
+    waitressServe(app, host=args.host, port=args.port, threads=args.threads)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Barking detection server")
+    parser.add_argument(
+        "--production",
+        action="store_true",
+        help="serve with a multi-threaded production WSGI server",
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--threads", type=int, default=8, help="worker threads in production mode"
+    )
+    args = parser.parse_args()
+
     checkSettingsFile()
     chooseDevice()
 
-    detectorProcess = mp.Process(
-        target=runDetector,
-        args=("yamnet.tflite", detectorMsgHandler),
-        daemon=True,
-    )
-    detectorProcess.start()
+    # imported here so the routes can be loaded (e.g. by loadgen.py) without
+    # mediapipe and an audio device
+    from detector import runDetector
 
-    app.run(host="0.0.0.0")
+    def useHandler(msgHandler):
+        responseCache.invalidate()
+        detectorClient.setHandler(msgHandler)
 
-    if detectorProcess.is_alive():
-        detectorProcess.terminate()
+    settings = readSettings()
+    supervisor = DetectorSupervisor(
+        runDetector,
+        ("yamnet.tflite",),
+        useHandler,
+        settings.get(
+            Settings.WATCHDOG_TIMEOUT.value,
+            defaultSettings[Settings.WATCHDOG_TIMEOUT.value],
+        ),
+        preload=["__main__", "detector"],
+    )
+    # the routes only ask whether a detector is running
+    detectorProcess = supervisor
+    supervisor.start()
 
-        while detectorProcess.is_alive():
-            continue
+    serve(args)
 
-        detectorProcess.close()
+    supervisor.stop()
 
     print("done")
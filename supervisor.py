@@ -0,0 +1,233 @@
+"""A module to keep the detector process running.
+
+The detector writes heartbeats into shared memory: one from its inference
+loop and one from the audio callback (through the loop). The supervisor
+restarts the process when it exits unexpectedly or a heartbeat goes stale,
+with a fresh message pipe each time, and reports restarts and time to
+recovery.
+
+Processes are started from a forkserver that already imported the detector
+module, so a restart doesn't pay for importing MediaPipe again and doesn't
+fork the multi-threaded web server.
+"""
+
+import multiprocessing as mp
+import threading
+import time
+from enum import IntEnum
+
+from message import createMsgHandlers
+
+# how often the process and its heartbeats are checked
+checkInterval = 0.05
+# restart delays after consecutive failures, the first restart is immediate
+backoffDelays = (0.0, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+# a process that stays healthy this long resets the backoff
+stableAfter = 60.0
+# recent recoveries kept for the status report
+historySize = 20
+
+
+class Beat(IntEnum):
+    """Slots of the shared heartbeat array, times are time.monotonic()."""
+
+    LOOP = 0
+    CAPTURE = 1
+    QUITTING = 2
+
+
+def createHeartbeat():
+    return mp.RawArray("d", len(Beat))
+
+
+def beat(heartbeat, loopTime: float, captureTime: float) -> None:
+    heartbeat[Beat.LOOP] = loopTime
+    heartbeat[Beat.CAPTURE] = captureTime
+
+
+class DetectorSupervisor(object):
+    """Starts the detector process and restarts it when it fails."""
+
+    def __init__(
+        self,
+        target,
+        args: tuple,
+        onHandler,
+        watchdogTimeout: float = 2.0,
+        startupTimeout: float = 60.0,
+        preload: list = None,
+    ) -> None:
+        """Creates a DetectorSupervisor instance.
+
+        Args:
+          target: Process entry point, called as target(*args, msgHandler,
+            heartbeat).
+          args: Leading arguments for `target`.
+          onHandler: Called with the server side MsgHandler of every new
+            process, before the process starts.
+          watchdogTimeout: Seconds without a heartbeat before a restart.
+          startupTimeout: Seconds a new process may take to send its first
+            heartbeat (loading the model, opening the device).
+          preload: Modules the forkserver imports once up front.
+        """
+        self._target = target
+        self._args = args
+        self._onHandler = onHandler
+        self._watchdogTimeout = watchdogTimeout
+        self._startupTimeout = startupTimeout
+        self._ctx = mp.get_context("forkserver")
+        if preload:
+            self._ctx.set_forkserver_preload(preload)
+
+        self._lock = threading.Lock()
+        self._process = None
+        self._heartbeat = None
+        self._startedAt = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        self._restarts = 0
+        self._failures = 0
+        self._lastFailure = None
+        self._failedAt = None
+        self._recovering = False
+        self._recoveries = []
+
+    def start(self) -> None:
+        self._spawn()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._lock:
+            process = self._process
+        if process is not None and process.is_alive():
+            process.terminate()
+            process.join(2.0)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    def is_alive(self) -> bool:
+        with self._lock:
+            return self._process is not None and self._process.is_alive()
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            heartbeat = self._heartbeat
+            recoveries = list(self._recoveries)
+            status = {
+                "alive": self._process is not None and self._process.is_alive(),
+                "pid": self._process.pid if self._process is not None else None,
+                "uptime": round(now - self._startedAt, 3),
+                "restarts": self._restarts,
+                "consecutive_failures": self._failures,
+                "last_failure": self._lastFailure,
+                "recovering": self._recovering,
+            }
+        if heartbeat is not None:
+            for slot in (Beat.LOOP, Beat.CAPTURE):
+                age = now - heartbeat[slot] if heartbeat[slot] else None
+                status[f"{slot.name.lower()}_heartbeat_age"] = (
+                    round(age, 3) if age is not None else None
+                )
+        recoveryTimes = [r["recovery_seconds"] for r in recoveries]
+        status["recoveries"] = recoveries
+        status["max_recovery_seconds"] = max(recoveryTimes) if recoveryTimes else None
+        return status
+
+    def _spawn(self) -> None:
+        serverHandler, detectorHandler = createMsgHandlers()
+        heartbeat = createHeartbeat()
+        process = self._ctx.Process(
+            target=self._target,
+            args=self._args + (detectorHandler, heartbeat),
+            daemon=True,
+        )
+        # the old pipe may hold half a message from the killed process
+        self._onHandler(serverHandler)
+        process.start()
+        with self._lock:
+            self._process = process
+            self._heartbeat = heartbeat
+            self._startedAt = time.monotonic()
+
+    def _checkHealth(self, process, heartbeat) -> str | None:
+        """Returns why the process must be restarted, or None."""
+        if not process.is_alive():
+            if process.exitcode == 0 or heartbeat[Beat.QUITTING]:
+                return None
+            return f"exited with code {process.exitcode}"
+        if heartbeat[Beat.QUITTING]:
+            return None
+
+        now = time.monotonic()
+        if heartbeat[Beat.LOOP] == 0 or heartbeat[Beat.CAPTURE] == 0:
+            if now - self._startedAt > self._startupTimeout:
+                return "no heartbeat after startup"
+            return None
+        if now - heartbeat[Beat.LOOP] > self._watchdogTimeout:
+            return "inference loop stalled"
+        if now - heartbeat[Beat.CAPTURE] > self._watchdogTimeout:
+            return "audio capture stalled"
+        return None
+
+    def _run(self) -> None:
+        while not self._stop.wait(checkInterval):
+            with self._lock:
+                process = self._process
+                heartbeat = self._heartbeat
+
+            if self._recovering and heartbeat[Beat.LOOP] and heartbeat[Beat.CAPTURE]:
+                self._recovered()
+            if (
+                self._failures
+                and not self._recovering
+                and time.monotonic() - self._startedAt > stableAfter
+            ):
+                self._failures = 0
+
+            reason = self._checkHealth(process, heartbeat)
+            if reason is None:
+                if not process.is_alive() and not self._recovering:
+                    # quit on request, nothing to supervise any more
+                    return
+                continue
+
+            self._restart(process, reason)
+
+    def _restart(self, process, reason: str) -> None:
+        print(f"detector {reason}, restarting")
+        if not self._recovering:
+            self._failedAt = time.monotonic()
+            self._recovering = True
+        self._lastFailure = {"reason": reason, "time": time.time()}
+
+        if process.is_alive():
+            process.terminate()
+            process.join(0.5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+        delay = backoffDelays[min(self._failures, len(backoffDelays) - 1)]
+        self._failures += 1
+        if self._stop.wait(delay):
+            return
+        self._restarts += 1
+        self._spawn()
+
+    def _recovered(self) -> None:
+        seconds = time.monotonic() - self._failedAt
+        with self._lock:
+            self._recovering = False
+            self._recoveries.append(
+                {
+                    "reason": self._lastFailure["reason"],
+                    "failed_at": self._lastFailure["time"],
+                    "recovery_seconds": round(seconds, 3),
+                }
+            )
+            del self._recoveries[:-historySize]
+        print(f"detector recovered in {seconds:.3f}s")
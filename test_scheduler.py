@@ -0,0 +1,61 @@
+import datetime
+import unittest
+
+import scheduler
+from scheduler import ProfileScheduler
+
+
+class ProfileSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.schedule = [{"profile": "night", "start": "22:00", "end": "06:00"}]
+        self.prepared = []
+        self.applied = []
+        self.discarded = []
+        self.scheduler = ProfileScheduler(
+            lambda: self.schedule,
+            self.prepare,
+            lambda name, prepared: self.applied.append((name, prepared)),
+            self.discarded.append,
+        )
+
+    def prepare(self, name):
+        self.prepared.append(name)
+        return f"prepared-{name}"
+
+    def at(self, hour, minute, second=0):
+        return datetime.datetime(2024, 5, 1, hour, minute, second)
+
+    def test_upcoming_profile_survives_checks(self):
+        self.scheduler.check(self.at(21, 59, 10))
+        self.assertIn("night", self.prepared)
+        # the checks before the window opens keep the prepared profile
+        self.scheduler.check(self.at(21, 59, 25))
+        self.scheduler.check(self.at(21, 59, 40))
+        self.assertIn("night", self.scheduler._prepared)
+        self.assertEqual(self.discarded, [])
+        self.assertEqual(self.prepared.count("night"), 1)
+
+    def test_switch_uses_prepared_profile(self):
+        self.scheduler.check(self.at(21, 59, 30))
+        self.prepared.clear()
+        self.scheduler.check(self.at(22, 0, 0))
+        self.assertEqual(self.applied[-1], ("night", "prepared-night"))
+        # nothing is built on the switch path
+        self.assertNotIn("night", self.prepared)
+        self.assertEqual(self.scheduler.current, "night")
+
+    def test_dropped_window_is_discarded(self):
+        self.scheduler.check(self.at(21, 59, 30))
+        self.schedule = []
+        self.scheduler.check(self.at(21, 59, 45))
+        self.assertEqual(self.discarded, ["prepared-night"])
+        self.assertEqual(self.scheduler._prepared, {})
+
+    def test_prepare_lead(self):
+        before = self.at(22, 0) - datetime.timedelta(seconds=scheduler.prepareLead + 15)
+        self.scheduler.check(before)
+        self.assertNotIn("night", self.prepared)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+"""A module to precompute and cache waveform peaks and spectrograms."""
+
+import json
+import os
+import queue
+import threading
+import numpy as np
+
+from soundfile import SoundFile
+from frontend import StreamingLogMel
+
+peakBuckets = 1000
+spectrogramWidth = 1024
+readBlockSize = 64 * 1024
+
+
+def computePeaks(wavPath: str, buckets: int = peakBuckets) -> dict:
+    """Computes per-bucket min/max of a recording, reading it in blocks."""
+    with SoundFile(wavPath) as f:
+        frames = f.frames
+        samplerate = f.samplerate
+        bucketSize = max(1, -(-frames // buckets))
+        count = -(-frames // bucketSize) if frames else 0
+        mins = np.zeros(count, dtype=np.float32)
+        maxs = np.zeros(count, dtype=np.float32)
+
+        # read whole buckets per block so no bucket spans two blocks
+        blockSize = max(1, readBlockSize // bucketSize) * bucketSize
+        bucket = 0
+        for block in f.blocks(blocksize=blockSize, dtype="float32", always_2d=True):
+            mono = block.mean(axis=1)
+            n = -(-mono.shape[0] // bucketSize)
+            padded = np.pad(mono, (0, n * bucketSize - mono.shape[0]), mode="edge")
+            shaped = padded.reshape(n, bucketSize)
+            mins[bucket : bucket + n] = shaped.min(axis=1)
+            maxs[bucket : bucket + n] = shaped.max(axis=1)
+            bucket += n
+
+    return {
+        "sample_rate": samplerate,
+        "frames": frames,
+        "samples_per_bucket": bucketSize,
+        "min": np.round(mins, 4).tolist(),
+        "max": np.round(maxs, 4).tolist(),
+    }
+
+
+def computeSpectrogram(wavPath: str, width: int = spectrogramWidth) -> np.ndarray:
+    """Computes a log-mel spectrogram image, at most `width` columns wide.
+
+    Frames are averaged into their column as they are computed, so memory
+    stays at one read block and the image however long the recording is.
+    """
+    with SoundFile(wavPath) as f:
+        # the ring only has to hold the frames of one block
+        hopLength = int(round(f.samplerate * 0.01))
+        frontend = StreamingLogMel(
+            f.samplerate, num_frames=readBlockSize // hopLength + 1
+        )
+        windowLength = frontend.window_length
+        totalFrames = (
+            1 + (f.frames - windowLength) // hopLength if f.frames >= windowLength else 0
+        )
+        if totalFrames == 0:
+            return np.zeros((64, 1), dtype=np.float32)
+
+        # neighbouring frames are averaged down to the target width
+        step = -(-totalFrames // width)
+        sums = np.zeros((-(-totalFrames // step), 64), dtype=np.float64)
+        counts = np.zeros(sums.shape[0], dtype=np.int64)
+        for block in f.blocks(blocksize=readBlockSize, dtype="float32", always_2d=True):
+            first = frontend.frame_count
+            added = frontend.push(block)
+            if added == 0:
+                continue
+            columns = np.arange(first, first + added) // step
+            np.add.at(sums, columns, frontend.latest(added))
+            counts += np.bincount(columns, minlength=counts.shape[0])
+
+    image = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+    # low frequencies at the bottom
+    return image.T[::-1]
+
+
+class ThumbnailCache(object):
+    """Disk cache of peaks and spectrogram images, evicted LRU by total size."""
+
+    def __init__(self, cacheDir: str, maxBytes: int) -> None:
+        self._cacheDir = cacheDir
+        self._maxBytes = maxBytes
+        self._lock = threading.Lock()
+        os.makedirs(cacheDir, exist_ok=True)
+
+    @property
+    def cache_dir(self) -> str:
+        return self._cacheDir
+
+    def peaksPath(self, name: str) -> str:
+        return os.path.join(self._cacheDir, f"{name}.peaks.json")
+
+    def spectrogramPath(self, name: str) -> str:
+        return os.path.join(self._cacheDir, f"{name}.spec.png")
+
+    def has(self, name: str) -> bool:
+        return os.path.isfile(self.peaksPath(name)) and os.path.isfile(
+            self.spectrogramPath(name)
+        )
+
+    def invalidate(self, name: str) -> None:
+        """Removes the cached thumbnails of a recording."""
+        for path in (self.peaksPath(name), self.spectrogramPath(name)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def touch(self, path: str) -> None:
+        """Marks a cached file as recently used."""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def generate(self, name: str, wavPath: str) -> None:
+        # import here so the detector only pays for matplotlib when needed
+        from matplotlib import image as mpimg
+
+        peaks = computePeaks(wavPath)
+        tmp = self.peaksPath(name) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(peaks, f)
+        os.replace(tmp, self.peaksPath(name))
+
+        tmp = self.spectrogramPath(name) + ".tmp"
+        mpimg.imsave(tmp, computeSpectrogram(wavPath), cmap="magma", format="png")
+        os.replace(tmp, self.spectrogramPath(name))
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Removes least recently used entries until the cache fits."""
+        with self._lock:
+            entries = []
+            total = 0
+            with os.scandir(self._cacheDir) as it:
+                for entry in it:
+                    if not entry.is_file() or entry.name.endswith(".tmp"):
+                        continue
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self._maxBytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+
+class ThumbnailWorker(object):
+    """Generates thumbnails for finished recordings in a background thread."""
+
+    def __init__(self, cache: ThumbnailCache) -> None:
+        self._cache = cache
+        self._queue = queue.Queue()
+        # names waiting in the queue, a name is only queued once
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def cache(self) -> ThumbnailCache:
+        return self._cache
+
+    def submit(self, name: str, wavPath: str) -> None:
+        with self._lock:
+            if name in self._pending:
+                return
+            self._pending.add(name)
+        self._queue.put((name, wavPath))
+
+    def refresh(self, name: str, wavPath: str = None) -> None:
+        """Drops a recording's stale thumbnails and, if it still exists,
+        regenerates them."""
+        self._cache.invalidate(name)
+        if wavPath:
+            self.submit(name, wavPath)
+
+    def _run(self) -> None:
+        while True:
+            (name, wavPath) = self._queue.get()
+            # a change to the recording from here on queues it again
+            with self._lock:
+                self._pending.discard(name)
+            try:
+                self._cache.generate(name, wavPath)
+            except Exception as e:
+                print(f"thumbnail generation failed for {name}: {e}")
@@ -0,0 +1,335 @@
+"""A module to store the score of every inference window.
+
+Scores are appended to one file per day as rows of float16 values, one column
+per tracked class. Timestamps are not stored: a small JSON file next to it
+lists segments, each with the wall time of its first row and the hop between
+rows, and a row's time follows from its index. Rows are buffered and written
+in large blocks, and the files can be memory mapped for reads.
+
+A window takes the row after the previous window's, as many hops apart as
+their sample indexes are, so the inference loop's jitter never leaves a slot
+empty. A segment's hop is the mean hop measured over the previous segment, as
+the loop's real hop runs a little longer than the nominal one. Windows that
+were not classified (e.g. shed under load) are stored as NaN rows, so a
+segment only ends when the hop changes, capture restarts, a gap is too long
+to fill or a window drifts half a hop from its row's time.
+"""
+
+import datetime
+import json
+import math
+import os
+import time
+import numpy as np
+
+# rows buffered in memory before they are appended to the day file
+blockRows = 4096
+# buffered rows are written at least this often, so readers see recent scores
+flushInterval = 60.0
+# gaps longer than this many rows start a new segment instead of NaN rows
+maxGapRows = 4096
+
+
+def dayName(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+
+def readMeta(path: str, day: str) -> dict | None:
+    try:
+        with open(os.path.join(path, f"{day}.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class TimelineWriter(object):
+    """Appends score rows for the detector, one writer per timeline directory."""
+
+    def __init__(self, path: str, names: list) -> None:
+        self._path = path
+        self._names = list(names)
+        self._width = len(self._names)
+        self._rowBytes = 2 * self._width
+        self._buffer = np.empty([blockRows, self._width], dtype=np.float16)
+        self._buffered = 0
+        self._lastFlush = time.monotonic()
+        self._day = None
+        self._meta = None
+        self._fileRows = 0
+        # current segment: sample index and wall time of its first row, hop
+        # (nominal and measured, in samples)
+        self._anchor = None
+        self._hopSamples = 0
+        self._rowHop = 0.0
+        self._sampleRate = 0
+        self._segmentRow = 0
+        # sample index and row of the latest window
+        self._lastIndex = 0
+        self._lastRow = 0
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def rows(self) -> int:
+        """Rows in the current day file, including buffered ones."""
+        return self._fileRows + self._buffered
+
+    def append(
+        self,
+        sampleIndex: int,
+        wallTime: float,
+        hopSamples: int,
+        sampleRate: int,
+        scores: list,
+    ) -> None:
+        """Adds the scores of the window ending at `sampleIndex`.
+
+        Args:
+          sampleIndex: Total samples captured when the window was read.
+          wallTime: Wall clock time (seconds) of that sample, only used when a
+            new segment starts.
+          hopSamples: Nominal samples between windows.
+          sampleRate: Capture sample rate.
+          scores: One score per name.
+        """
+        if self._anchor is not None and sampleIndex == self._lastIndex:
+            # the same window as the previous call
+            return
+        if (
+            self._anchor is None
+            or hopSamples != self._hopSamples
+            or sampleRate != self._sampleRate
+            or sampleIndex < self._lastIndex
+        ):
+            self._startSegment(sampleIndex, wallTime, hopSamples, sampleRate)
+            gap = 0
+        else:
+            # windows skipped since the previous one become NaN rows
+            gap = max(1, round((sampleIndex - self._lastIndex) / self._rowHop)) - 1
+            if gap > maxGapRows or abs(self._drift(sampleIndex, self.rows + gap)) > 0.5:
+                self._startSegment(sampleIndex, wallTime, hopSamples, sampleRate)
+                gap = 0
+            elif dayName(self._rowTime(self.rows + gap)) != self._day:
+                self._startSegment(sampleIndex, wallTime, hopSamples, sampleRate)
+                gap = 0
+
+        for _ in range(gap):
+            self._push(None)
+        self._lastIndex = sampleIndex
+        self._lastRow = self.rows
+        self._push(scores)
+
+        if time.monotonic() - self._lastFlush > flushInterval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffered and self._day is not None:
+            with open(self._dataPath(self._day), "ab") as f:
+                f.write(self._buffer[: self._buffered].tobytes())
+            self._fileRows += self._buffered
+            self._buffered = 0
+        self._lastFlush = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+
+    def _drift(self, sampleIndex: int, row: int) -> float:
+        """How many hops `sampleIndex` is off the time of `row`."""
+        return (sampleIndex - self._anchor[0]) / self._rowHop - (row - self._segmentRow)
+
+    def _rowTime(self, row: int) -> float:
+        (_, wallTime) = self._anchor
+        return wallTime + (row - self._segmentRow) * self._rowHop / self._sampleRate
+
+    def _push(self, scores: list | None) -> None:
+        if scores is None:
+            self._buffer[self._buffered] = np.nan
+        else:
+            self._buffer[self._buffered] = scores
+        self._buffered += 1
+        if self._buffered == blockRows:
+            self.flush()
+
+    def _dataPath(self, day: str) -> str:
+        return os.path.join(self._path, f"{day}.f16")
+
+    def _openDay(self, day: str) -> None:
+        self.flush()
+        self._day = day
+        dataPath = self._dataPath(day)
+        size = os.path.getsize(dataPath) if os.path.exists(dataPath) else 0
+        if size % self._rowBytes:
+            # a torn row from a crash
+            size -= size % self._rowBytes
+            os.truncate(dataPath, size)
+        self._fileRows = size // self._rowBytes
+
+        meta = readMeta(self._path, day)
+        if meta is None or meta.get("names") != self._names:
+            if size:
+                # the columns changed, keep the old file aside
+                os.replace(dataPath, dataPath + f".{int(time.time())}")
+                self._fileRows = 0
+            meta = {"names": self._names, "segments": []}
+        # segments past the end of the data were never written
+        meta["segments"] = [s for s in meta["segments"] if s["row"] < self._fileRows]
+        self._meta = meta
+
+    def _startSegment(
+        self, sampleIndex: int, wallTime: float, hopSamples: int, sampleRate: int
+    ) -> None:
+        day = dayName(wallTime)
+        if day != self._day:
+            self._openDay(day)
+
+        if (
+            self._anchor is not None
+            and hopSamples == self._hopSamples
+            and sampleRate == self._sampleRate
+            and self._lastRow > self._segmentRow
+            and sampleIndex > self._lastIndex
+        ):
+            # the previous segment measured the loop's real hop
+            self._rowHop = (self._lastIndex - self._anchor[0]) / (
+                self._lastRow - self._segmentRow
+            )
+        else:
+            self._rowHop = float(hopSamples)
+        self._anchor = (sampleIndex, wallTime)
+        self._hopSamples = hopSamples
+        self._sampleRate = sampleRate
+        self._segmentRow = self.rows
+        self._lastIndex = sampleIndex
+        self._lastRow = self._segmentRow
+        self._meta["segments"].append(
+            {
+                "row": self._segmentRow,
+                "start": wallTime,
+                "hop": self._rowHop / sampleRate,
+            }
+        )
+        self._saveMeta()
+
+    def _saveMeta(self) -> None:
+        tmp = os.path.join(self._path, f"{self._day}.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self._meta, f)
+        os.replace(tmp, os.path.join(self._path, f"{self._day}.json"))
+
+
+class TimelineStore(object):
+    """Reads the timeline through memory maps."""
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+
+    def days(self, start: float, end: float) -> list:
+        first = datetime.date.fromtimestamp(start)
+        last = datetime.date.fromtimestamp(end)
+        return [
+            (first + datetime.timedelta(days=i)).isoformat()
+            for i in range((last - first).days + 1)
+        ]
+
+    def query(
+        self,
+        start: float,
+        end: float,
+        names: list = None,
+        maxPoints: int = 0,
+        method: str = "max",
+    ) -> tuple[list, np.ndarray, np.ndarray]:
+        """Returns the scores between two timestamps.
+
+        Args:
+          start: First timestamp (seconds) to include.
+          end: Last timestamp to include.
+          names: Classes to return, all stored classes by default.
+          maxPoints: Downsample to at most this many points (0 = all rows).
+          method: "max" or "mean" per downsampled bucket.
+
+        Returns:
+          A tuple of the class names, a float64 array of timestamps and a
+          [rows, names] float32 array of scores (NaN for unclassified windows).
+        """
+        timeParts = []
+        scoreParts = []
+        columns = None
+        for day in self.days(start, end):
+            meta = readMeta(self._path, day)
+            dataPath = os.path.join(self._path, f"{day}.f16")
+            if meta is None or not os.path.exists(dataPath):
+                continue
+
+            stored = meta["names"]
+            if columns is None:
+                names = names or stored
+                columns = [stored.index(n) for n in names if n in stored]
+                names = [stored[c] for c in columns]
+            rows = os.path.getsize(dataPath) // (2 * len(stored))
+            if rows == 0:
+                continue
+            data = np.memmap(
+                dataPath, dtype=np.float16, mode="r", shape=(rows, len(stored))
+            )
+
+            segments = meta["segments"]
+            for i, segment in enumerate(segments):
+                segmentEnd = segments[i + 1]["row"] if i + 1 < len(segments) else rows
+                segmentEnd = min(segmentEnd, rows)
+                hop = segment["hop"]
+                lo = segment["row"] + max(0, math.ceil((start - segment["start"]) / hop))
+                hi = min(
+                    segmentEnd,
+                    segment["row"] + math.floor((end - segment["start"]) / hop) + 1,
+                )
+                if lo >= hi:
+                    continue
+                timeParts.append(
+                    segment["start"] + (np.arange(lo, hi) - segment["row"]) * hop
+                )
+                scoreParts.append(data[lo:hi, columns].astype(np.float32))
+
+        if not timeParts:
+            names = names or []
+            return (names, np.empty(0), np.empty([0, len(names)], np.float32))
+
+        times = np.concatenate(timeParts)
+        scores = np.concatenate(scoreParts)
+        if np.any(np.diff(times) < 0):
+            # the wall clock was set back between segments
+            order = np.argsort(times, kind="stable")
+            times = times[order]
+            scores = scores[order]
+        if maxPoints and times.shape[0] > maxPoints:
+            (times, scores) = downsample(times, scores, maxPoints, method)
+        return (names, times, scores)
+
+
+def downsample(
+    times: np.ndarray, scores: np.ndarray, maxPoints: int, method: str = "max"
+) -> tuple[np.ndarray, np.ndarray]:
+    """Reduces rows into at most `maxPoints` equal time buckets.
+
+    "max" keeps short peaks visible in a plot, "mean" shows the level. NaN
+    rows are ignored, buckets without any row are left out.
+    """
+    edges = np.linspace(times[0], times[-1], maxPoints + 1)
+    edges[-1] = np.inf
+    starts = np.searchsorted(times, edges[:-1], side="left")
+    ends = np.searchsorted(times, edges[1:], side="left")
+    nonEmpty = starts < ends
+    starts = starts[nonEmpty]
+    centers = ((edges[:-1] + np.minimum(edges[1:], times[-1])) / 2)[nonEmpty]
+
+    if method == "max":
+        reduced = np.fmax.reduceat(scores, starts, axis=0)
+    elif method == "mean":
+        valid = ~np.isnan(scores)
+        sums = np.add.reduceat(np.where(valid, scores, 0), starts, axis=0)
+        counts = np.add.reduceat(valid, starts, axis=0)
+        reduced = np.full(sums.shape, np.nan, dtype=np.float32)
+        np.divide(sums, counts, out=reduced, where=counts > 0)
+    else:
+        raise ValueError(f"unknown downsampling method {method!r}")
+
+    return (centers, reduced.astype(np.float32))
@@ -0,0 +1,194 @@
+"""A module to push bark events from a detector node to a central aggregator."""
+
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import urllib.error
+import urllib.request
+
+import db
+from utils import Settings
+
+batchLimit = 5000
+maxBackoff = 300.0
+stateFileName = "uplink_state.json"
+# batches the aggregator refused are kept here instead of blocking the spool
+rejectedDirName = "rejected"
+# client errors that can still succeed later
+retryableStatus = (408, 429)
+
+
+class Uplink(object):
+    """Batches new barks and recordings into a local spool and pushes them.
+
+    New rows are read by id so nothing is missed or sent twice, compressed
+    into batch files in the spool directory, and only then is the read
+    position advanced. Spooled batches are posted in order and removed once
+    the aggregator accepted them; while the link is down they stay on disk
+    and delivery is retried with exponential backoff.
+    """
+
+    def __init__(self, settings: dict) -> None:
+        self._settings = settings
+        self._spoolPath = settings[Settings.UPLINK_SPOOL_PATH]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._backoff = 0.0
+        # the spool directory is only created once the uplink is turned on
+        self._state = self.loadState()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def statePath(self) -> str:
+        return os.path.join(self._spoolPath, stateFileName)
+
+    def loadState(self) -> dict:
+        try:
+            with open(self.statePath(), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"last_bark_id": 0, "last_recording_id": 0, "next_batch": 1}
+
+    def saveState(self) -> None:
+        tmp = self.statePath() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._state, f)
+        os.replace(tmp, self.statePath())
+
+    def spoolNewRows(self) -> int:
+        """Writes rows added since the last call into a spooled batch file.
+
+        Returns:
+          The number of rows spooled.
+        """
+        dbConn = sqlite3.connect(db.dbname)
+        barks = db.getBarksAfterId(dbConn, self._state["last_bark_id"], batchLimit)
+        recordings = db.getRecordingsAfterId(
+            dbConn, self._state["last_recording_id"], batchLimit
+        )
+        dbConn.close()
+
+        if not barks and not recordings:
+            return 0
+
+        os.makedirs(self._spoolPath, exist_ok=True)
+        batchId = self._state["next_batch"]
+        batch = {
+            "node_id": self._settings[Settings.NODE_ID],
+            "batch_id": batchId,
+            "barks": barks,
+            "audio_files": recordings,
+        }
+        path = os.path.join(self._spoolPath, f"batch-{batchId:012d}.json.gz")
+        with gzip.open(path + ".tmp", "wt") as f:
+            json.dump(batch, f)
+        os.replace(path + ".tmp", path)
+
+        # only advance once the batch is safely on disk
+        if barks:
+            self._state["last_bark_id"] = barks[-1][0]
+        if recordings:
+            self._state["last_recording_id"] = recordings[-1][0]
+        self._state["next_batch"] = batchId + 1
+        self.saveState()
+        return len(barks) + len(recordings)
+
+    def spooledBatches(self) -> list:
+        try:
+            names = os.listdir(self._spoolPath)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            os.path.join(self._spoolPath, name)
+            for name in names
+            if name.startswith("batch-") and name.endswith(".json.gz")
+        )
+
+    def rejectedBatches(self) -> int:
+        try:
+            return len(os.listdir(os.path.join(self._spoolPath, rejectedDirName)))
+        except FileNotFoundError:
+            return 0
+
+    def pushBatch(self, path: str) -> bool:
+        """Posts a spooled batch and removes it once it is dealt with.
+
+        A batch the aggregator refuses with a client error would be refused
+        again on every retry, so it is moved to the rejected directory.
+
+        Returns:
+          False if the push should be retried later.
+        """
+        with open(path, "rb") as f:
+            body = f.read()
+
+        req = urllib.request.Request(
+            self._settings[Settings.UPLINK_URL].rstrip("/") + "/ingest",
+            data=body,
+            headers={
+                "Content-Type": "application/json",
+                "Content-Encoding": "gzip",
+            },
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                if not 200 <= resp.status < 300:
+                    return False
+        except urllib.error.HTTPError as e:
+            if not 400 <= e.code < 500 or e.code in retryableStatus:
+                print(f"uplink push failed: {e}")
+                return False
+            rejectedPath = os.path.join(self._spoolPath, rejectedDirName)
+            os.makedirs(rejectedPath, exist_ok=True)
+            os.replace(path, os.path.join(rejectedPath, os.path.basename(path)))
+            print(f"aggregator rejected {os.path.basename(path)}, moved aside: {e}")
+            return True
+        except (urllib.error.URLError, OSError) as e:
+            print(f"uplink push failed: {e}")
+            return False
+        os.remove(path)
+        return True
+
+    def flush(self) -> bool:
+        """Pushes spooled batches oldest first. Returns False on failure."""
+        for path in self.spooledBatches():
+            if self._stop.is_set():
+                return False
+            if not self.pushBatch(path):
+                return False
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._backoff or self._settings[Settings.UPLINK_INTERVAL]):
+            if not self._settings[Settings.UPLINK_URL]:
+                continue
+
+            try:
+                while self.spoolNewRows() >= batchLimit:
+                    pass
+            except sqlite3.Error as e:
+                print(f"uplink spooling failed: {e}")
+
+            if self.flush():
+                self._backoff = 0.0
+            else:
+                self._backoff = min(
+                    maxBackoff,
+                    max(self._backoff * 2, self._settings[Settings.UPLINK_INTERVAL]),
+                )
+
+    def status(self) -> dict:
+        return {
+            "node_id": self._settings[Settings.NODE_ID],
+            "spooled_batches": len(self.spooledBatches()),
+            "rejected_batches": self.rejectedBatches(),
+            "backoff": self._backoff,
+            **self._state,
+        }
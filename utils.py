@@ -4,8 +4,11 @@ from enum import Enum
 from pathlib import Path
 import os
 import datetime
+import socket
 import yaml
 
+from scoring import CombineRule, Smoothing
+
 
 maxTimestamp = datetime.datetime(3000, 1, 1).timestamp()
 
@@ -26,9 +29,118 @@ class Settings(Enum):
     WRITE_BUFFER_LENGTH = "write_buffer_length"
     RECORDING_FILE_PATH = "recording_file_path"
     REC_DEVICE_ID = "rec_device_id"
+    REC_DEVICE_NAME = "rec_device_name"
+    INFERENCE_OVERLAP = "inference_overlap"
+    SMOOTHING_METHOD = "smoothing_method"
+    SMOOTHING_WINDOW = "smoothing_window"
+    EMA_ALPHA = "ema_alpha"
+    VOTE_K = "vote_k"
+    COMBINE_RULE = "combine_rule"
+    THUMBNAIL_CACHE_SIZE = "thumbnail_cache_size"
+    RETENTION_INTERVAL = "retention_interval"
+    RETAIN_RAW_DAYS = "retain_raw_days"
+    RETAIN_DOWNSAMPLE_RATE = "retain_downsample_rate"
+    RETAIN_DELETE_DAYS = "retain_delete_days"
+    RECORDING_QUOTA_BYTES = "recording_quota_bytes"
+    BARK_COMPACT_DAYS = "bark_compact_days"
+    MAX_QUEUE_TIME = "max_queue_time"
+    SILENCE_GATE_DBFS = "silence_gate_dbfs"
+    UPLINK_URL = "uplink_url"
+    UPLINK_INTERVAL = "uplink_interval"
+    UPLINK_SPOOL_PATH = "uplink_spool_path"
+    NODE_ID = "node_id"
+    MODEL_PATH = "model_path"
+    INFERENCE_ENABLED = "inference_enabled"
+    CAPTURE_LEVEL_DBFS = "capture_level_dbfs"
+    PROFILES = "profiles"
+    SCHEDULE = "schedule"
+    AUTO_THRESHOLD = "auto_threshold"
+    AUTO_THRESHOLD_RATE = "auto_threshold_rate"
+    AUTO_THRESHOLD_MIN = "auto_threshold_min"
+    AUTO_THRESHOLD_MAX = "auto_threshold_max"
+    AUTO_THRESHOLD_MIN_SAMPLES = "auto_threshold_min_samples"
+    AUDIO_SOURCE = "audio_source"
+    TIMELINE_PATH = "timeline_path"
+    WATCHDOG_TIMEOUT = "watchdog_timeout"
+    FEATURE_BANDS = "feature_bands"
+
+
+# settings that size the audio stream, these need a restart to change and
+# are ignored in profiles
+fixedSettings = (
+    Settings.REC_BUFFER_SIZE,
+    Settings.SAMPLE_RATE,
+    Settings.NUM_CHANNELS,
+    Settings.REC_DEVICE_ID,
+    Settings.REC_DEVICE_NAME,
+    Settings.AUDIO_SOURCE,
+    Settings.RECORDING_FILE_PATH,
+    Settings.PROFILES,
+    Settings.SCHEDULE,
+)
+
+# allowed values of settings that select a behavior
+settingChoices = {
+    Settings.SMOOTHING_METHOD: [s.value for s in Smoothing],
+    Settings.COMBINE_RULE: [c.value for c in CombineRule],
+}
+
+# settings that must be whole numbers, even though a float would parse
+integerSettings = (
+    Settings.REC_BUFFER_SIZE,
+    Settings.SAMPLE_RATE,
+    Settings.NUM_CHANNELS,
+    Settings.REC_DEVICE_ID,
+    Settings.SMOOTHING_WINDOW,
+    Settings.VOTE_K,
+    Settings.THUMBNAIL_CACHE_SIZE,
+    Settings.RETAIN_DOWNSAMPLE_RATE,
+    Settings.RECORDING_QUOTA_BYTES,
+    Settings.AUTO_THRESHOLD_MIN_SAMPLES,
+)
+
+# windows of scores kept for smoothing, the longest smoothing_window
+scoreHistorySize = 64
+
+# (min, max) of numeric settings, None leaves a side open
+settingRanges = {
+    Settings.BARK_THRESHOLD: (0, 1),
+    Settings.REC_TIMEOUT: (0, None),
+    Settings.PRE_BUFFER_TIME: (0, None),
+    Settings.REC_BUFFER_SIZE: (1, None),
+    Settings.SAMPLE_RATE: (1, None),
+    Settings.NUM_CHANNELS: (1, None),
+    Settings.WRITE_BUFFER_LENGTH: (1, None),
+    Settings.INFERENCE_OVERLAP: (0, 0.95),
+    Settings.SMOOTHING_WINDOW: (1, scoreHistorySize),
+    Settings.EMA_ALPHA: (0, 1),
+    Settings.VOTE_K: (1, scoreHistorySize),
+    Settings.THUMBNAIL_CACHE_SIZE: (0, None),
+    Settings.RETENTION_INTERVAL: (1, None),
+    Settings.RETAIN_RAW_DAYS: (0, None),
+    Settings.RETAIN_DOWNSAMPLE_RATE: (1, None),
+    Settings.RETAIN_DELETE_DAYS: (0, None),
+    Settings.RECORDING_QUOTA_BYTES: (0, None),
+    Settings.BARK_COMPACT_DAYS: (0, None),
+    Settings.MAX_QUEUE_TIME: (0, None),
+    Settings.UPLINK_INTERVAL: (1, None),
+    Settings.AUTO_THRESHOLD_RATE: (0, 1),
+    Settings.AUTO_THRESHOLD_MIN: (0, 1),
+    Settings.AUTO_THRESHOLD_MAX: (0, 1),
+    Settings.AUTO_THRESHOLD_MIN_SAMPLES: (0, None),
+    Settings.WATCHDOG_TIMEOUT: (0.1, None),
+}
 
+# (lower, upper) pairs of settings where lower must not exceed upper
+settingOrder = (
+    # more votes than windows can never pass
+    (Settings.VOTE_K, Settings.SMOOTHING_WINDOW),
+    # the calibrated threshold is clamped to [min, max]
+    (Settings.AUTO_THRESHOLD_MIN, Settings.AUTO_THRESHOLD_MAX),
+)
 
 settingsPath = os.path.join(os.getcwd(), "settings.yaml")
+calibrationPath = os.path.join(os.getcwd(), "calibration.json")
 defaultSettings = {
     Settings.BARK_THRESHOLD.value: 0.15,  # number between 0 and 1, threshold confidence of a bark to trigger a recording
     Settings.REC_TIMEOUT.value: 30,  # stop recorder after X seconds of not hearing a bark
@@ -39,9 +151,126 @@ defaultSettings = {
     Settings.WRITE_BUFFER_LENGTH.value: 3,  # number of seconds (in samples) between file flush() calls (shouldn't need to edit this)
     Settings.RECORDING_FILE_PATH.value: "",  # path to save recordings to
     Settings.REC_DEVICE_ID.value: -1,  # microphone device ID, will be prompted to choose on first startup
+    Settings.REC_DEVICE_NAME.value: "",  # name of the chosen device, used to find it again when its ID changes
+    Settings.INFERENCE_OVERLAP.value: 0.5,  # fraction of each inference window shared with the previous one (0 to <1)
+    Settings.SMOOTHING_METHOD.value: "none",  # score smoothing over recent windows: none, ema, median or vote
+    Settings.SMOOTHING_WINDOW.value: 3,  # number of recent windows used by median and vote smoothing
+    Settings.EMA_ALPHA.value: 0.5,  # weight of the newest window for ema smoothing (0 to 1)
+    Settings.VOTE_K.value: 2,  # vote smoothing triggers when k of the last smoothing_window windows pass the threshold
+    Settings.COMBINE_RULE.value: "first",  # how tracked classes are combined: first (Dog only), max, mean or noisy_or
+    Settings.THUMBNAIL_CACHE_SIZE.value: 256 * 1024 * 1024,  # max bytes of cached waveform/spectrogram thumbnails
+    Settings.RETENTION_INTERVAL.value: 3600,  # seconds between retention passes
+    Settings.RETAIN_RAW_DAYS.value: 0,  # downsample recordings older than X days (0 = never)
+    Settings.RETAIN_DOWNSAMPLE_RATE.value: 8000,  # sample rate old recordings are downsampled to
+    Settings.RETAIN_DELETE_DAYS.value: 0,  # delete recordings older than X days (0 = never)
+    Settings.RECORDING_QUOTA_BYTES.value: 0,  # delete oldest recordings above this many bytes (0 = no quota)
+    Settings.BARK_COMPACT_DAYS.value: 0,  # fold barks older than X days into per-minute aggregates (0 = never)
+    Settings.MAX_QUEUE_TIME.value: 60,  # seconds of audio the capture and recording queues may hold before dropping
+    Settings.SILENCE_GATE_DBFS.value: -50,  # under load, windows quieter than this (dBFS) are not classified
+    Settings.UPLINK_URL.value: "",  # aggregator base url to push bark events to, e.g. http://hub:5100 (empty = off)
+    Settings.UPLINK_INTERVAL.value: 30,  # seconds between uplink batches
+    Settings.UPLINK_SPOOL_PATH.value: os.path.join(os.getcwd(), "uplink_spool"),  # batches waiting to be pushed
+    Settings.NODE_ID.value: socket.gethostname(),  # name of this detector in the aggregator
+    Settings.MODEL_PATH.value: "",  # classifier model file (empty = the model the server starts with)
+    Settings.INFERENCE_ENABLED.value: True,  # False runs no classification, recordings are then triggered by capture_level_dbfs
+    Settings.CAPTURE_LEVEL_DBFS.value: -30,  # with inference off, windows at least this loud (dBFS) start or extend a recording
+    Settings.PROFILES.value: {},  # named sets of setting overrides, e.g. {"night": {"inference_overlap": 0.75}}
+    Settings.SCHEDULE.value: [],  # e.g. [{"profile": "night", "start": "22:00", "end": "06:00", "days": ["mon"]}]
+    Settings.AUTO_THRESHOLD.value: False,  # use the calibrated per-hour threshold instead of bark_threshold
+    Settings.AUTO_THRESHOLD_RATE.value: 0.001,  # target fraction of windows that trigger without a bark
+    Settings.AUTO_THRESHOLD_MIN.value: 0.05,  # lower bound for the calibrated threshold
+    Settings.AUTO_THRESHOLD_MAX.value: 0.6,  # upper bound for the calibrated threshold
+    Settings.AUTO_THRESHOLD_MIN_SAMPLES.value: 1000,  # windows seen in an hour of day before its calibration is used
+    Settings.TIMELINE_PATH.value: "",  # directory for daily files with the scores of every window, never pruned (empty = off)
+    Settings.FEATURE_BANDS.value: [[0, 300], [300, 1000], [1000, 3000], [3000, 8000]],  # [low_hz, high_hz] bands whose energy is published with each result
+    Settings.WATCHDOG_TIMEOUT.value: 2.0,  # seconds without a detector heartbeat before it is restarted
+    Settings.AUDIO_SOURCE.value: "device",  # device, wav:<path>, synth:<tone|noise|bark> or socket:<path> (for testing without a microphone)
 }
 
 
+def resolveRecordingPath(path: str) -> str:
+    """Returns the configured recording directory, or the default one."""
+    if path != "" and Path(path).is_dir():
+        return path
+
+    return os.path.join(os.getcwd(), "recordings/")
+
+
+def getThumbnailPath(recordingPath: str) -> str:
+    return os.path.join(recordingPath, ".thumbnails")
+
+
+def isNumber(value) -> bool:
+    # bool is an int subclass, but True is not a sample rate
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def checkSetting(setting: Settings, value) -> str | None:
+    """Returns why `value` is not valid for `setting`, or None if it is.
+
+    Values are checked before they are saved, since the detector reloads
+    the settings file on every start and a bad value would break each one.
+    """
+    default = defaultSettings[setting.value]
+    if isinstance(default, bool):
+        if not isinstance(value, bool):
+            return f"{setting.value} must be true or false"
+    elif isNumber(default):
+        if not isNumber(value):
+            return f"{setting.value} must be a number"
+        if setting in integerSettings and value != int(value):
+            return f"{setting.value} must be a whole number"
+        (low, high) = settingRanges.get(setting, (None, None))
+        if low is not None and value < low:
+            return f"{setting.value} must be at least {low}"
+        if high is not None and value > high:
+            return f"{setting.value} must be at most {high}"
+    elif isinstance(default, str):
+        if not isinstance(value, str):
+            return f"{setting.value} must be a string"
+        if setting in settingChoices and value not in settingChoices[setting]:
+            return f"{setting.value} must be one of {', '.join(settingChoices[setting])}"
+    elif isinstance(default, list) and not isinstance(value, list):
+        return f"{setting.value} must be a list"
+
+    if setting == Settings.FEATURE_BANDS:
+        for band in value:
+            if (
+                not isinstance(band, (list, tuple))
+                or len(band) != 2
+                or not all(isNumber(edge) for edge in band)
+                or not 0 <= band[0] < band[1]
+            ):
+                return "feature_bands must be [low_hz, high_hz] pairs with low < high"
+
+    if setting == Settings.PROFILES:
+        if not isinstance(value, dict):
+            return "profiles must map names to setting overrides"
+        for name, overrides in value.items():
+            if not isinstance(overrides, dict):
+                return f"profile {name} must be a dict of settings"
+            for key, override in overrides.items():
+                try:
+                    error = checkSetting(Settings(key), override)
+                except ValueError:
+                    error = f"unknown setting {key}"
+                if error:
+                    return f"profile {name}: {error}"
+    return None
+
+
+def checkSettingOrder(settings: dict) -> str | None:
+    """Returns why a complete settings dict breaks `settingOrder`, or None.
+
+    checkSetting only sees one value, this checks the settings that bound
+    each other.
+    """
+    for lower, upper in settingOrder:
+        if settings[lower] > settings[upper]:
+            return f"{lower.value} must not be larger than {upper.value}"
+    return None
+
+
 def checkSettingsFile():
     settingsFile = Path(settingsPath)
     if not settingsFile.is_file():
@@ -66,7 +295,7 @@ def updateSetting(id: Settings, val):
         with settingsFile.open("r") as f:
             data = yaml.safe_load(f)
 
-        if id.value in data:
+        if id.value in data or id.value in defaultSettings:
             data[id.value] = val
 
             with settingsFile.open("w") as f:
@@ -89,7 +318,7 @@ def getScoreByNames(result):
 
 
 def scoreDictToList(scoreDict):
-    res = []
+    res = [0.0] * len(scoreNames)
 
     for idx, name in enumerate(scoreNames):
         res[idx] = scoreDict[name]